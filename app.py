@@ -1,11 +1,27 @@
 import os
+import asyncio
+import time
+from contextlib import contextmanager
 import chainlit as cl
 from chainlit.input_widget import Select, Slider, TextInput
 from pdf_processor import PDFProcessor
-from problem_generator import MathProblemGenerator
+from problem_generator import MathProblemGenerator, MathProblem
 from vectorstore_manager import VectorStoreManager
+from ingestion_cache import IngestionCache
+from problem_pool import ProblemPool
+from retrieval_cache import RetrievalCache, CachedQueryEmbeddings
+from semantic_cache import SemanticExplainCache
+from store_services import StoreServicePool
+from store_janitor import StoreJanitor
+from federated_retriever import FederatedRetriever
+from lexical_index import LexicalIndex
+from ingestion_jobs import IngestionJobQueue
+from page_renderer import AdaptiveRenderPolicy
+from llm_client import RateLimitedChatModel, RateLimitedEmbeddings, rate_limiters
+from metrics import metrics, format_stats, mount_prometheus_endpoint, track_request
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 import fitz  # PyMuPDF
+from chainlit.server import app as chainlit_app
 import traceback
 import sys
 
@@ -17,33 +33,226 @@ if not os.getenv("OPENAI_API_KEY"):
     print("2. 環境変数として設定: export OPENAI_API_KEY=your_api_key_here")
     sys.exit(1)
 
+# 削除したストアのディレクトリの片付けとディスク容量の回収
+store_janitor = StoreJanitor("./vector_stores")
+
 # ベクトルストアマネージャーの初期化
-vectorstore_manager = VectorStoreManager("./vector_stores")
+vectorstore_manager = VectorStoreManager("./vector_stores", on_stale_directory=store_janitor.remove_store)
+
+# モデルごとのレート制限（1分あたりのリクエスト数とトークン数。利用中のTierに合わせて変更してください）
+rate_limiters.configure("gpt-4o", requests_per_minute=500, tokens_per_minute=30_000)
+rate_limiters.configure("text-embedding-ada-002", requests_per_minute=3_000, tokens_per_minute=1_000_000)
+
+# モデルの初期化（PDF処理・問題生成・通常チャットで共有し、レート制限と再試行はラッパーが行う）
+embedding_model = RateLimitedEmbeddings(OpenAIEmbeddings(max_retries=0))
+llm = RateLimitedChatModel.wrap(
+    ChatOpenAI(model="gpt-4o", temperature=0.2, max_retries=0)  # 数学問題生成のため温度を下げる
+)
+
+# OCR結果と埋め込みベクトルのキャッシュ（全ストア共有）
+ingestion_cache = IngestionCache("./vector_stores/_cache")
+
+# 検索結果のキャッシュと、クエリ埋め込みの永続キャッシュ
+retrieval_cache = RetrievalCache(max_entries=256)
+query_embedding_model = CachedQueryEmbeddings(
+    embedding_model,
+    IngestionCache("./vector_stores/_cache", max_bytes=64 * 1024 * 1024, db_file="query_embeddings.sqlite3",
+                   name="query"),
+)
+
+def create_problem_generator(db_dir):
+    """キャッシュを組み込んだ問題ジェネレーターを作成する"""
+    return MathProblemGenerator(
+        llm,
+        query_embedding_model,
+        db_dir,
+        retrieval_cache=retrieval_cache,
+        semantic_cache=SemanticExplainCache(db_dir, query_embedding_model),
+        # 記法や定理番号での検索に転置インデックスを併用する
+        lexical_index=LexicalIndex(db_dir),
+    )
+
+def create_federated_generator(store_paths):
+    """複数のストアを並行して検索する問題ジェネレーターを作成する"""
+    return MathProblemGenerator(
+        llm,
+        query_embedding_model,
+        dir_db=None,
+        # 1つのストアの検索が遅くても全体を待たせないよう、ストアごとに時間を制限する
+        retriever=FederatedRetriever.from_store_paths(store_paths, query_embedding_model, k=4, timeout=3.0),
+    )
+
+# ストアごとのプロセッサとジェネレーター（全セッションで共有）
+store_services = StoreServicePool(
+    lambda db_dir: PDFProcessor(
+        db_dir, embedding_model, llm, cache=ingestion_cache, render_policy=AdaptiveRenderPolicy()
+    ),
+    create_problem_generator,
+    create_federated_generator,
+)
+
+# 生成済み問題のプール（(ストア, 出題範囲, 難易度)ごと）
+problem_pool = ProblemPool("./vector_stores")
+
+# PDF取り込みジョブのキュー（セッションとは独立して処理し、再起動後も続きから再開する）
+ingestion_jobs = IngestionJobQueue(
+    store_services.acquire_processor,
+    "./vector_stores/_jobs",
+    # ストアの内容が変わったため、生成済みの問題を破棄する
+    on_complete=lambda job: problem_pool.invalidate_store(job["store_path"]),
+    # ジョブが終わったらプロセッサをプールに返す（使われていないストアは閉じられる）
+    release_processor=store_services.release,
+)
+
+# 削除されたストアのパス -> 取り込みジョブの終了を待って共有インスタンスを破棄するタスク
+store_releases = {}
+
+async def release_deleted_store(store_path):
+    """削除されたストアの取り込みジョブを取り消して終了を待ち、共有インスタンスを破棄する"""
+    try:
+        # ジョブの後処理（残りのページの書き込みなど）が閉じた接続や移動したディレクトリに書き込まないよう、先に待つ
+        await ingestion_jobs.cancel_store(store_path)
+    finally:
+        store_services.discard(store_path)
+        problem_pool.invalidate_store(store_path)
+
+def on_stores_changed(previous, config):
+    """
+    削除されたストア（他のプロセスで削除された場合も含む）の取り込みジョブと共有インスタンスを破棄する
+
+    ディレクトリの削除は、ストアを削除したプロセスだけが行う（handle_store_command）。
+    破棄はstore_releasesのタスクで行い、ディレクトリを削除する前にその完了を待つ。
+    """
+    remaining = {store["path"] for store in config["stores"]}
+    for store in previous["stores"]:
+        if store["path"] not in remaining:
+            store_path = os.path.abspath(vectorstore_manager.base_dir / store["path"])
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # イベントループの外（ワーカーの起動前）では処理中のジョブはない
+                store_services.discard(store_path)
+                problem_pool.invalidate_store(store_path)
+                continue
+            task = loop.create_task(release_deleted_store(store_path))
+            store_releases[store_path] = task
+            task.add_done_callback(forget_store_release)
+
+def forget_store_release(task):
+    """完了した破棄のタスクをstore_releasesから取り除く"""
+    for path, release in list(store_releases.items()):
+        if release is task:
+            del store_releases[path]
+
+vectorstore_manager.subscribe(on_stores_changed)
+
+# 取得時に計算するメトリクス（キャッシュのサイズと状態ごとの取り込みジョブ数）
+CACHE_BYTES = metrics.gauge("mathgen_cache_bytes", "キャッシュの合計サイズ（バイト）", ("cache",))
+INGESTION_JOBS = metrics.gauge("mathgen_ingestion_jobs", "状態ごとの取り込みジョブ数", ("status",))
+
+def collect_app_metrics():
+    CACHE_BYTES.set(ingestion_cache.size(), cache="ingestion")
+    CACHE_BYTES.set(query_embedding_model.cache.size(), cache="query_embedding")
+    counts = ingestion_jobs.count_by_status()
+    for status in (IngestionJobQueue.QUEUED, IngestionJobQueue.RUNNING, IngestionJobQueue.COMPLETED,
+                   IngestionJobQueue.FAILED, IngestionJobQueue.CANCELLED):
+        INGESTION_JOBS.set(counts.get(status, 0), status=status)
+
+metrics.register_collector(collect_app_metrics)
+
+# Prometheus形式のメトリクスを /metrics で公開する（MATHGEN_METRICS_ENABLEDを設定した場合のみ、
+# MATHGEN_METRICS_TOKENをBearerトークンとして要求する）
+if os.getenv("MATHGEN_METRICS_ENABLED", "").lower() in ("1", "true", "yes"):
+    if os.getenv("MATHGEN_METRICS_TOKEN"):
+        mount_prometheus_endpoint(chainlit_app, os.getenv("MATHGEN_METRICS_TOKEN"))
+    else:
+        print("警告: MATHGEN_METRICS_TOKENが設定されていないため、/metrics を公開しません。")
+
+# メトリクスに記録するコマンド（それ以外のメッセージは通常のチャットとして記録する）
+COMMANDS = ("upload", "generate", "jobs", "stats", "answer", "explain", "store", "docs", "help")
+
+def command_name(content: str) -> str:
+    """メッセージのコマンド名を返す"""
+    for command in COMMANDS:
+        if content.startswith(f"/{command}"):
+            return command
+    return "chat"
+
+def get_session_store():
+    """
+    セッションで選択中のストア名とパスを取得する
+
+    ストアが未選択または削除済みの場合は、デフォルトのストアを選択し直す。
+
+    Returns:
+        tuple: (ストア名, ストアのパス)
+    """
+    store_name = cl.user_session.get("store_name")
+    if not store_name or not vectorstore_manager.get_store_by_name(store_name):
+        store_name = vectorstore_manager.get_current_store_name()
+        cl.user_session.set("store_name", store_name)
+    return store_name, vectorstore_manager.get_store_path(store_name)
+
+def get_session_stores():
+    """
+    セッションで複数のストアを検索する場合に、そのストア名とパスを取得する
+
+    削除済みのストアは除外し、2つ未満になった場合は複数ストアの検索を解除する。
 
-# 環境設定
-DB_DIR = vectorstore_manager.get_current_store_path()
-os.makedirs(DB_DIR, exist_ok=True)
+    Returns:
+        dict: ストア名 -> ストアのパス（複数ストアの検索を使わない場合は空の辞書）
+    """
+    store_names = cl.user_session.get("store_names") or []
+    stores = {name: vectorstore_manager.get_store_path(name) for name in store_names
+              if vectorstore_manager.get_store_by_name(name)}
+    if len(stores) < 2:
+        cl.user_session.set("store_names", None)
+        return {}
+    return stores
 
-# モデルの初期化
-embedding_model = OpenAIEmbeddings()
-llm = ChatOpenAI(model="gpt-4o", temperature=0.2)  # 数学問題生成のため温度を下げる
+def acquire_session_generator():
+    """
+    セッションで選択中のストア（複数選択時はそれらすべて）を検索するMathProblemGeneratorを借りる
 
-# プロセッサとジェネレーターの初期化
-pdf_processor = PDFProcessor(DB_DIR, embedding_model, llm)
-problem_generator = MathProblemGenerator(llm, embedding_model, DB_DIR)
+    使い終わったらstore_services.releaseで返すこと。
+    """
+    stores = get_session_stores()
+    if stores:
+        return store_services.acquire_federated_generator(stores)
+    return store_services.acquire_generator(get_session_store()[1])
 
-# 現在の問題を保存する変数
-current_problem = None
+def call_with_processor(db_dir, func):
+    """
+    ストアのPDFProcessorを借りてfunc(processor)の結果を返す
 
-# ウェルカムメッセージを保存するグローバル変数
-welcome_message = None
+    プロセッサの作成（ストアのクライアントやSQLiteを開く）と目録の読み書きはブロッキング処理のため、
+    イベントループからはrun_in_executorで呼ぶこと。
+    """
+    with store_services.processor(db_dir) as processor:
+        return func(processor)
+
+@contextmanager
+def session_generator():
+    """セッションで選択中のストアを検索するMathProblemGeneratorをwithブロックの間だけ借りる"""
+    problem_generator = acquire_session_generator()
+    try:
+        yield problem_generator
+    finally:
+        store_services.release(problem_generator)
 
 @cl.on_chat_start
 async def start():
     """チャットの開始時に実行される関数"""
-    global welcome_message
+    # セッションの状態を初期化（ストアはデフォルトのストアから開始）
+    cl.user_session.set("store_name", vectorstore_manager.get_current_store_name())
+    cl.user_session.set("store_names", None)
+    cl.user_session.set("current_problem", None)
+    cl.user_session.set("current_problem_task", None)
     
-    current_store_name = vectorstore_manager.get_current_store_name()
+    # 取り込みジョブのワーカーを起動（前回中断されたジョブがあれば再開される）
+    ingestion_jobs.start()
+    
+    current_store_name, db_dir = get_session_store()
     
     # ウェルカムメッセージの内容を作成（装飾を追加）
     welcome_content = (
@@ -51,6 +260,8 @@ async def start():
         "---\n\n"
         "## 🔍 利用可能なコマンド\n\n"
         "- `/upload`: PDFをアップロードしてベクトルストアに保存\n"
+        "- `/jobs`: PDF取り込みジョブの状況を表示\n"
+        "- `/stats`: 処理時間・キャッシュのヒット率・トークン数などの統計を表示\n"
         "- `/generate [出題範囲] [難易度]`: 指定した難易度と範囲で問題を生成\n"
         "  例: `/generate 微分積分 中級`\n"
         "- `/answer`: 最後に生成された問題の解答を表示\n"
@@ -60,8 +271,12 @@ async def start():
         "## 📂 ベクトルストア管理\n\n"
         "- `/store list`: 使用可能なベクトルストアの一覧を表示\n"
         "- `/store select [名前]`: 使用するベクトルストアを選択\n"
+        "- `/store multi [名前1] [名前2] ...`: 複数のベクトルストアを同時に検索\n"
         "- `/store add [名前] [説明]`: 新しいベクトルストアを追加\n"
         "- `/store delete [名前]`: ベクトルストアを削除\n"
+        "- `/store gc`: 不要なデータを削除してディスク容量を回収\n"
+        "- `/docs`: 現在のストアに取り込んだドキュメントの一覧を表示\n"
+        "- `/docs delete [ドキュメント名]`: ドキュメントをストアから削除\n"
         f"- 現在のベクトルストア: **{current_store_name}**\n\n"
         "## 🎓 難易度の基準\n\n"
         "- **初級**: 大学学部レベル\n"
@@ -77,6 +292,7 @@ async def start():
     # ウェルカムメッセージを作成
     welcome_message = cl.Message(content=welcome_content)
     await welcome_message.send()
+    cl.user_session.set("welcome_message", welcome_message)
     
     # チャット履歴の初期化
     cl.user_session.set("chat_history", [])
@@ -84,10 +300,13 @@ async def start():
     # ウェルカムメッセージをセッションに保存
     cl.user_session.set("welcome_message_id", welcome_message.id)
     cl.user_session.set("welcome_content", welcome_content)
+    
+    # よく要求される問題をバックグラウンドで用意しておく
+    problem_pool.warm(db_dir, lambda: store_services.generator(db_dir))
 
 # ウェルカムメッセージが表示されているか確認し、必要に応じて再表示する関数
 async def ensure_welcome_message():
-    global welcome_message
+    welcome_message = cl.user_session.get("welcome_message")
     
     # ウェルカムメッセージIDとコンテンツをセッションから取得
     welcome_message_id = cl.user_session.get("welcome_message_id")
@@ -99,6 +318,7 @@ async def ensure_welcome_message():
             # 保存された内容で新しいメッセージを作成
             welcome_message = cl.Message(content=welcome_content)
             await welcome_message.send()
+            cl.user_session.set("welcome_message", welcome_message)
             
             # 新しいIDを保存
             cl.user_session.set("welcome_message_id", welcome_message.id)
@@ -106,11 +326,15 @@ async def ensure_welcome_message():
 @cl.on_message
 async def main(message: cl.Message):
     """メッセージを受信したときに実行される関数"""
-    global current_problem, pdf_processor, problem_generator, DB_DIR
-    
     # ウェルカムメッセージを確認
     await ensure_welcome_message()
     
+    # コマンドごとのリクエスト数と応答時間を記録する
+    with track_request(command_name(message.content)):
+        await dispatch_message(message)
+
+async def dispatch_message(message: cl.Message):
+    """コマンドに応じて処理を振り分ける関数"""
     if message.content.startswith("/upload"):
         await handle_upload()
     
@@ -140,6 +364,12 @@ async def main(message: cl.Message):
                        "例: `/generate 微分積分 中級`"
             ).send()
     
+    elif message.content.startswith("/jobs"):
+        await show_jobs()
+    
+    elif message.content.startswith("/stats"):
+        await show_stats()
+    
     elif message.content.startswith("/answer"):
         await explain_problem()
     
@@ -157,6 +387,10 @@ async def main(message: cl.Message):
         # ベクトルストア管理コマンドの処理
         await handle_store_command(message.content)
     
+    elif message.content.startswith("/docs"):
+        # ストア内のドキュメント管理コマンドの処理
+        await handle_docs_command(message.content)
+    
     elif message.content.startswith("/help"):
         # ヘルプコマンドでウェルカムメッセージを再表示
         await show_help()
@@ -167,9 +401,7 @@ async def main(message: cl.Message):
 
 async def show_help():
     """ヘルプメッセージを表示する関数"""
-    global welcome_message
-    
-    current_store_name = vectorstore_manager.get_current_store_name()
+    current_store_name, _ = get_session_store()
     
     # ヘルプメッセージの内容を作成（装飾を追加）
     help_content = (
@@ -177,6 +409,8 @@ async def show_help():
         "---\n\n"
         "## 🔍 利用可能なコマンド\n\n"
         "- `/upload`: PDFをアップロードしてベクトルストアに保存\n"
+        "- `/jobs`: PDF取り込みジョブの状況を表示\n"
+        "- `/stats`: 処理時間・キャッシュのヒット率・トークン数などの統計を表示\n"
         "- `/generate [出題範囲] [難易度]`: 指定した難易度と範囲で問題を生成\n"
         "  例: `/generate 微分積分 中級`\n"
         "- `/answer`: 最後に生成された問題の解答を表示\n"
@@ -186,8 +420,12 @@ async def show_help():
         "## 📂 ベクトルストア管理\n\n"
         "- `/store list`: 使用可能なベクトルストアの一覧を表示\n"
         "- `/store select [名前]`: 使用するベクトルストアを選択\n"
+        "- `/store multi [名前1] [名前2] ...`: 複数のベクトルストアを同時に検索\n"
         "- `/store add [名前] [説明]`: 新しいベクトルストアを追加\n"
         "- `/store delete [名前]`: ベクトルストアを削除\n"
+        "- `/store gc`: 不要なデータを削除してディスク容量を回収\n"
+        "- `/docs`: 現在のストアに取り込んだドキュメントの一覧を表示\n"
+        "- `/docs delete [ドキュメント名]`: ドキュメントをストアから削除\n"
         f"- 現在のベクトルストア: **{current_store_name}**\n\n"
         "## 🎓 難易度の基準\n\n"
         "- **初級**: 大学学部レベル\n"
@@ -205,14 +443,12 @@ async def show_help():
     await help_message.send()
     
     # ウェルカムメッセージとして保存
-    welcome_message = help_message
-    cl.user_session.set("welcome_message_id", welcome_message.id)
+    cl.user_session.set("welcome_message", help_message)
+    cl.user_session.set("welcome_message_id", help_message.id)
     cl.user_session.set("welcome_content", help_content)
 
 async def handle_store_command(command: str):
     """ベクトルストア管理コマンドを処理する関数"""
-    global pdf_processor, problem_generator, DB_DIR
-    
     # ウェルカムメッセージを確認
     await ensure_welcome_message()
     
@@ -227,11 +463,17 @@ async def handle_store_command(command: str):
     # 使用可能なベクトルストアの一覧表示
     if sub_command == "list":
         stores = vectorstore_manager.get_all_stores()
-        current_store = vectorstore_manager.get_current_store_name()
+        current_store, _ = get_session_store()
+        multi_stores = get_session_stores()
         
         # ストア一覧の構築
+        def store_mark(name):
+            if multi_stores:
+                return ' 🔗 (複数ストア検索に使用中)' if name in multi_stores else ''
+            return ' 📌 (現在使用中)' if name == current_store else ''
+        
         store_list = "\n".join([
-            f"- **{store['name']}**{' 📌 (現在使用中)' if store['name'] == current_store else ''}: {store['description']}"
+            f"- **{store['name']}**{store_mark(store['name'])}: {store['description']}"
             for store in stores
         ])
         
@@ -265,20 +507,41 @@ async def handle_store_command(command: str):
             # コマンドからストア名を取得
             selected_store = " ".join(parts[2:])
         
-        try:
-            # ストアの選択
-            vectorstore_manager.set_current_store(selected_store)
-            
-            # ベクトルストアのパスを更新
-            DB_DIR = vectorstore_manager.get_current_store_path()
-            
-            # プロセッサとジェネレーターを再初期化
-            pdf_processor = PDFProcessor(DB_DIR, embedding_model, llm)
-            problem_generator = MathProblemGenerator(llm, embedding_model, DB_DIR)
-            
+        # ストアの選択（このセッションだけに適用され、複数ストアの検索は解除される）
+        if vectorstore_manager.get_store_by_name(selected_store):
+            cl.user_session.set("store_name", selected_store)
+            cl.user_session.set("store_names", None)
             await cl.Message(content=f"✅ ベクトルストア「{selected_store}」を選択しました。").send()
-        except ValueError as e:
-            await cl.Message(content=f"❌ エラー: {str(e)}").send()
+        else:
+            await cl.Message(content=f"❌ エラー: '{selected_store}'という名前のストアは存在しません").send()
+    
+    # 複数のストアを同時に検索する
+    elif sub_command == "multi":
+        store_names = list(dict.fromkeys(parts[2:]))
+        if not store_names:
+            multi_stores = get_session_stores()
+            current = "、".join(multi_stores) if multi_stores else "なし"
+            await cl.Message(
+                content="使い方: `/store multi [名前1] [名前2] ...`\n\n"
+                       f"現在、複数ストア検索に使用中のストア: {current}\n\n"
+                       "`/store select [名前]` で1つのストアの検索に戻ります。"
+            ).send()
+            return
+        
+        unknown = [name for name in store_names if not vectorstore_manager.get_store_by_name(name)]
+        if unknown:
+            await cl.Message(content=f"❌ エラー: 次のストアは存在しません: {', '.join(unknown)}").send()
+            return
+        if len(store_names) < 2:
+            await cl.Message(content="❌ 2つ以上のストアを指定してください。1つのストアを使う場合は `/store select [名前]` を使用してください。").send()
+            return
+        
+        cl.user_session.set("store_names", store_names)
+        current_store_name, _ = get_session_store()
+        await cl.Message(
+            content=f"✅ /generate と /explain で次のストアを同時に検索します: {'、'.join(store_names)}\n\n"
+                   f"PDFのアップロード先は「{current_store_name}」のままです。"
+        ).send()
     
     # 新しいベクトルストアの追加
     elif sub_command == "add":
@@ -322,15 +585,8 @@ async def handle_store_command(command: str):
             ).send()
             
             if response and response["output"].strip().lower() in ["はい", "yes", "y"]:
-                # 新しいストアを選択
-                vectorstore_manager.set_current_store(new_store["name"])
-                
-                # ベクトルストアのパスを更新
-                DB_DIR = vectorstore_manager.get_current_store_path()
-                
-                # プロセッサとジェネレーターを再初期化
-                pdf_processor = PDFProcessor(DB_DIR, embedding_model, llm)
-                problem_generator = MathProblemGenerator(llm, embedding_model, DB_DIR)
+                # 新しいストアをこのセッションで選択
+                cl.user_session.set("store_name", new_store["name"])
                 
                 await cl.Message(content=f"✅ ベクトルストア「{new_store['name']}」を選択しました。").send()
         
@@ -380,25 +636,121 @@ async def handle_store_command(command: str):
             return
         
         try:
-            # ストアの削除
+            # ストアの削除（取り込みジョブの取り消しと共有インスタンスの破棄はon_stores_changedで行う）
+            deleted_path = vectorstore_manager.get_store_path(selected_store)
             vectorstore_manager.delete_store(selected_store)
             
-            # 現在のストア名を取得
-            current_store_name = vectorstore_manager.get_current_store_name()
-            
-            # ベクトルストアのパスを更新（削除後は自動的にデフォルトか別のストアに切り替わる）
-            DB_DIR = vectorstore_manager.get_current_store_path()
+            # 取り込みジョブの終了と共有インスタンスの破棄を待ってから、
+            # クライアントを閉じ、ディレクトリをゴミ箱に移してバックグラウンドで消去する
+            if deleted_path:
+                release = store_releases.get(os.path.abspath(deleted_path))
+                if release is not None:
+                    await asyncio.gather(release, return_exceptions=True)
+                store_janitor.remove_store(deleted_path)
             
-            # プロセッサとジェネレーターを再初期化
-            pdf_processor = PDFProcessor(DB_DIR, embedding_model, llm)
-            problem_generator = MathProblemGenerator(llm, embedding_model, DB_DIR)
+            # 削除したストアを選択していた場合はデフォルトに切り替わる
+            current_store_name, _ = get_session_store()
             
             await cl.Message(content=f"✅ ベクトルストア「{selected_store}」を削除しました。現在のストア: {current_store_name}").send()
         except ValueError as e:
             await cl.Message(content=f"❌ エラー: {str(e)}").send()
     
+    # 孤立したディレクトリの削除とディスク容量の回収
+    elif sub_command == "gc":
+        msg = cl.Message(content="🧹 ベクトルストアのディスク容量を回収しています...")
+        await msg.send()
+        
+        store_paths = {store["name"]: vectorstore_manager.get_store_path(store["name"])
+                       for store in vectorstore_manager.get_all_stores()}
+        # 取り込み中のストアは圧縮しない（SQLiteのVACUUMが書き込みと競合するため）
+        busy_paths = {os.path.abspath(job["store_path"]) for job in ingestion_jobs.list_jobs(limit=100)
+                      if job["status"] in (IngestionJobQueue.QUEUED, IngestionJobQueue.RUNNING)}
+        idle_stores = {name: path for name, path in store_paths.items() if os.path.abspath(path) not in busy_paths}
+        
+        report = await asyncio.get_running_loop().run_in_executor(None, store_janitor.collect, idle_stores)
+        
+        def format_bytes(size):
+            return f"{size / 1024 / 1024:.1f} MiB" if size >= 1024 * 1024 else f"{size / 1024:.1f} KiB"
+        
+        text = f"## 🧹 ディスク容量の回収\n\n合計 **{format_bytes(report['total'])}** を回収しました。\n\n"
+        text += f"- 孤立したディレクトリ: {len(report['orphans'])}個"
+        text += f"（{format_bytes(sum(size for _, size in report['orphans']))}）\n"
+        for path, size in report["orphans"]:
+            text += f"  - `{os.path.basename(path)}`: {format_bytes(size)}\n"
+        text += f"- ゴミ箱: {format_bytes(report['trash'])}\n"
+        for name, result in report["stores"].items():
+            reclaimed = result["segments"] + result["vacuum"]
+            if reclaimed:
+                text += f"- ストア「{name}」の圧縮: {format_bytes(reclaimed)}\n"
+        skipped = sorted(set(store_paths) - set(idle_stores))
+        if skipped:
+            text += f"- 取り込み中のため圧縮しなかったストア: {', '.join(skipped)}\n"
+        msg.content = text
+        await msg.update()
+    
+    else:
+        await cl.Message(content="❌ 無効なベクトルストアコマンドです。使用可能なコマンド: list, select, multi, add, delete, gc").send()
+
+async def handle_docs_command(command: str):
+    """ストア内のドキュメント（PDF）の一覧表示と削除を行う関数"""
+    # ウェルカムメッセージを確認
+    await ensure_welcome_message()
+    
+    parts = command.split(maxsplit=2)
+    sub_command = parts[1] if len(parts) >= 2 else "list"
+    store_name, db_dir = get_session_store()
+    loop = asyncio.get_running_loop()
+    
+    # 取り込み済みのドキュメントの一覧表示
+    if sub_command == "list":
+        documents = await loop.run_in_executor(
+            None, call_with_processor, db_dir, lambda processor: processor.list_documents()
+        )
+        if not documents:
+            await cl.Message(content=f"📭 ストア「{store_name}」にはドキュメントがありません。`/upload` でPDFを登録してください。").send()
+            return
+        
+        def format_time(timestamp):
+            return time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp)) if timestamp else "不明"
+        
+        docs_text = f"## 📄 ストア「{store_name}」のドキュメント\n\n"
+        for document in documents:
+            docs_text += (
+                f"- **{document['source']}**: {document['pages']}ページ（{document['chunks']}チャンク）、"
+                f"取り込み {format_time(document['ingested_at'])}、更新 {format_time(document['updated_at'])}"
+            )
+            if document["status"] != "complete":
+                docs_text += "（一部のページが未取り込み）"
+            docs_text += "\n"
+        await cl.Message(content=docs_text).send()
+    
+    # ソースのチャンクをすべて削除
+    elif sub_command == "delete":
+        if len(parts) < 3:
+            await cl.Message(content="❌ ドキュメント名を指定してください。使い方: `/docs delete [ドキュメント名]`").send()
+            return
+        source = parts[2].strip()
+        
+        # 取り込み中のドキュメントは削除しない（削除後に残りのページが書き込まれるため）
+        db_path = os.path.abspath(db_dir)
+        if any(job["source"] == source and os.path.abspath(job["store_path"]) == db_path
+               and job["status"] in (IngestionJobQueue.QUEUED, IngestionJobQueue.RUNNING)
+               for job in ingestion_jobs.list_jobs(limit=100)):
+            await cl.Message(content=f"❌ `{source}` は取り込み中です。`/jobs` でジョブの完了を確認してから削除してください。").send()
+            return
+        
+        deleted = await loop.run_in_executor(
+            None, call_with_processor, db_dir, lambda processor: processor.delete_source(source)
+        )
+        if not deleted:
+            await cl.Message(content=f"❌ ストア「{store_name}」に `{source}` というドキュメントはありません。").send()
+            return
+        # このストアから生成済みの問題を破棄する
+        problem_pool.invalidate_store(db_dir)
+        await cl.Message(content=f"✅ ストア「{store_name}」から `{source}` の{deleted}チャンクを削除しました。").send()
+    
     else:
-        await cl.Message(content="❌ 無効なベクトルストアコマンドです。使用可能なコマンド: list, select, add, delete").send()
+        await cl.Message(content="❌ 無効なドキュメントコマンドです。使用可能なコマンド: list, delete").send()
 
 async def handle_upload():
     """PDFのアップロード処理を行う関数"""
@@ -432,34 +784,50 @@ async def handle_upload():
         total_pages = len(doc)
         doc.close()
         
-        # 新しいUpdateメソッドの使用方法
-        msg.content = f"📄 `{file.name}`（全{total_pages}ページ）の処理を開始します。"
+        # 取り込みジョブとして登録（セッションが終了しても処理は続行される）
+        store_name, db_dir = get_session_store()
+        replacing = await asyncio.get_running_loop().run_in_executor(
+            None, call_with_processor, db_dir, lambda processor: processor.catalog.get_document(file.name) is not None
+        )
+        job = ingestion_jobs.submit(file.path, store_name, db_dir, file.name, total_pages)
+        
+        msg.content = (
+            f"📄 `{file.name}`（全{total_pages}ページ）を取り込みジョブ `{job['id']}` として登録しました。\n\n"
+            "ページを閉じても処理は続行されます。`/jobs` でいつでも状況を確認できます。"
+        )
+        if replacing:
+            msg.content += "\n\n同じ名前のドキュメントが取り込み済みのため、変更されたページだけを置き換えます。"
+
         await msg.update()
         
-        # 進捗状況を表示するための関数を定義
-        async def progress_callback(current_page, total_pages, status_text=None):
-            progress = int((current_page / total_pages) * 100)
+        # ジョブの進捗をこのセッションに表示するための関数を定義
+        async def progress_callback(job, status_text=None):
+            total_pages = job["total_pages"] or 0
+            current_page = job["completed_pages"]
             
-            # ステータステキストがある場合は表示
-            if status_text:
-                message = f"🔄 `{file.name}`の処理中...\n\nページ {current_page}/{total_pages} ({progress}%)\n\n**状態**: {status_text}"
-                debug_msg.content = f"🔍 最新の状態: {status_text}"
+            if job["status"] == IngestionJobQueue.COMPLETED:
+                msg.content = f"✅ `{file.name}`の処理が完了しました。\n\n全{total_pages}ページがベクトルストアに保存されました。"
+                debug_msg.content = f"🔍 処理結果: {job['result']}"
                 await debug_msg.update()
+            elif job["status"] == IngestionJobQueue.FAILED:
+                msg.content = f"❌ エラーが発生しました: {job['error']}"
+            elif job["status"] == IngestionJobQueue.QUEUED and job["error"]:
+                # 一部のページが失敗し、再試行を待っている
+                msg.content = f"⏳ `{file.name}`: {job['error']}"
             else:
+                progress = int((current_page / total_pages) * 100) if total_pages else 0
                 message = f"🔄 `{file.name}`の処理中...\n\nページ {current_page}/{total_pages} ({progress}%)"
-            
-            msg.content = message
+                
+                # ステータステキストがある場合は表示
+                if status_text:
+                    message += f"\n\n**状態**: {status_text}"
+                    debug_msg.content = f"🔍 最新の状態: {status_text}"
+                    await debug_msg.update()
+                
+                msg.content = message
             await msg.update()
         
-        # 新しい進捗コールバック付きでPDFを処理
-        result = await pdf_processor.process_pdf_with_progress(file.path, progress_callback)
-        
-        # 処理完了メッセージ
-        msg.content = f"✅ `{file.name}`の処理が完了しました。\n\n全{total_pages}ページがベクトルストアに保存されました。"
-        await msg.update()
-        
-        debug_msg.content = f"🔍 処理結果: {result}"
-        await debug_msg.update()
+        ingestion_jobs.subscribe(job["id"], progress_callback)
     
     except Exception as e:
         error_traceback = traceback.format_exc()
@@ -469,6 +837,40 @@ async def handle_upload():
         debug_msg.content = f"🐞 エラー詳細:\n```\n{error_traceback}\n```"
         await debug_msg.update()
 
+async def show_jobs():
+    """PDF取り込みジョブの状況を表示する関数"""
+    # ウェルカムメッセージを確認
+    await ensure_welcome_message()
+    
+    jobs = ingestion_jobs.list_jobs(limit=10)
+    if not jobs:
+        await cl.Message(content="📭 取り込みジョブはありません。`/upload` でPDFを登録してください。").send()
+        return
+    
+    status_labels = {
+        IngestionJobQueue.QUEUED: "⏳ 待機中",
+        IngestionJobQueue.RUNNING: "🔄 処理中",
+        IngestionJobQueue.COMPLETED: "✅ 完了",
+        IngestionJobQueue.FAILED: "❌ 失敗",
+        IngestionJobQueue.CANCELLED: "🚫 取り消し",
+    }
+    
+    jobs_text = "## 📋 取り込みジョブ（新しい順）\n\n"
+    for job in jobs:
+        total_pages = job["total_pages"] or "?"
+        jobs_text += (
+            f"- `{job['id']}` {status_labels.get(job['status'], job['status'])}: "
+            f"**{job['source']}** → {job['store_name']}（{job['completed_pages']}/{total_pages}ページ）\n"
+        )
+        if job["error"]:
+            jobs_text += f"  - エラー: {job['error']}\n"
+    
+    await cl.Message(content=jobs_text).send()
+
+async def show_stats():
+    """処理時間・キャッシュのヒット率・トークン数などの統計を表示する関数"""
+    await cl.Message(content=format_stats()).send()
+
 async def handle_generate_with_form():
     """問題生成のフォーム入力画面を表示する関数"""
     # ウェルカムメッセージを確認
@@ -513,10 +915,41 @@ async def handle_generate_with_form():
                    "例: `微分積分 中級`"
         ).send()
 
+async def stream_field(stream, msg: cl.Message, field: str, stop_key: str = None):
+    """
+    部分的な辞書のストリームから指定したフィールドの差分をメッセージに流す
+
+    Args:
+        stream: 生成途中の辞書を順次返す非同期イテレータ
+        msg (cl.Message): トークンを流すメッセージ
+        field (str): 表示するフィールド名
+        stop_key (str): このキーが現れたら（fieldが確定したら）読み取りを中断する
+
+    Returns:
+        tuple: (最後に受け取った辞書, 表示したフィールドの値)
+    """
+    partial = {}
+    shown = ""
+    async for partial in stream:
+        value = partial.get(field) or ""
+        if len(value) > len(shown):
+            await msg.stream_token(value[len(shown):])
+            shown = value
+        if stop_key and stop_key in partial:
+            break
+    return partial, shown
+
+async def complete_problem(stream, partial: dict, problem_generator) -> MathProblem:
+    """問題文の表示後に残りのストリームを読み切り、完成した問題を返す（読み切ったらジェネレーターを返す）"""
+    try:
+        async for partial in stream:
+            pass
+    finally:
+        store_services.release(problem_generator)
+    return MathProblem(**partial)
+
 async def generate_problem(difficulty, topic):
     """問題を生成する関数"""
-    global current_problem
-    
     # ウェルカムメッセージを確認
     await ensure_welcome_message()
     
@@ -525,19 +958,41 @@ async def generate_problem(difficulty, topic):
     await msg.send()
     
     try:
-        # 問題を生成
-        current_problem = problem_generator.generate_problem(topic, difficulty)
-        
-        # current_problemが辞書型かどうか確認し、それに応じて値を取得
-        if isinstance(current_problem, dict):
-            question = current_problem.get("question", "問題の生成に失敗しました。")
+        # プールに生成済みの問題があれば即座に使い、取り出した分はバックグラウンドで補充する
+        # （複数のストアを検索する場合は、ストアの組み合わせごとのプールは作らない）
+        _, db_dir = get_session_store()
+        if get_session_stores():
+            pooled_problem = None
         else:
-            # オブジェクトの場合はアトリビュートとしてアクセス
-            question = current_problem.question if hasattr(current_problem, "question") else "問題の生成に失敗しました。"
+            pooled_problem = problem_pool.pop(db_dir, topic, difficulty)
+            problem_pool.schedule_refill(db_dir, topic, difficulty, lambda: store_services.generator(db_dir))
         
-        # LaTeX形式の問題を表示
-        msg.content = f"## 📝 問題\n\n{question}"
-        await msg.update()
+        if pooled_problem is not None:
+            cl.user_session.set("current_problem", pooled_problem)
+            cl.user_session.set("current_problem_task", None)
+            question = pooled_problem.question
+            msg.content = f"## 📝 問題\n\n{question}"
+            await msg.update()
+        else:
+            # 問題文をストリーミング表示する（解答より先に生成される）
+            problem_generator = acquire_session_generator()
+            try:
+                stream = problem_generator.astream_problem(topic, difficulty)
+                msg.content = "## 📝 問題\n\n"
+                partial, question = await stream_field(stream, msg, "question", stop_key="answer")
+            except BaseException:
+                store_services.release(problem_generator)
+                raise
+            
+            # 解答はバックグラウンドで生成を続ける（/answerで完了を待つ）
+            cl.user_session.set("current_problem", None)
+            cl.user_session.set("current_problem_task",
+                                asyncio.create_task(complete_problem(stream, partial, problem_generator)))
+            
+            if not question:
+                question = "問題の生成に失敗しました。"
+                msg.content += question
+            await msg.update()
         
         # チャット履歴に問題を追加
         chat_history = cl.user_session.get("chat_history", [])
@@ -556,11 +1011,25 @@ async def generate_problem(difficulty, topic):
 
 async def explain_problem():
     """問題の解答を表示する関数"""
-    global current_problem
-    
     # ウェルカムメッセージを確認
     await ensure_welcome_message()
     
+    current_problem = cl.user_session.get("current_problem")
+    current_problem_task = cl.user_session.get("current_problem_task")
+    
+    # 解答がバックグラウンドで生成中の場合は完了を待つ
+    if current_problem_task is not None:
+        if not current_problem_task.done():
+            await cl.Message(content="🔄 解答を生成中です。しばらくお待ちください...").send()
+        try:
+            current_problem = await current_problem_task
+            cl.user_session.set("current_problem", current_problem)
+        except Exception as e:
+            await cl.Message(content=f"❌ 解答の生成中にエラーが発生しました: {str(e)}").send()
+            return
+        finally:
+            cl.user_session.set("current_problem_task", None)
+    
     if current_problem is None:
         await cl.Message(content="❌ まだ問題が生成されていません。先に `/generate` コマンドで問題を生成してください。").send()
         return
@@ -597,17 +1066,13 @@ async def handle_explain(question: str):
     await msg.send()
     
     try:
-        # 問題に対する説明を生成
-        result = problem_generator.explain_problem(question)
-        
-        # 結果の取得
-        if isinstance(result, dict):
-            explanation = result.get("answer", "説明を生成できませんでした。")
-        else:
-            explanation = result.answer if hasattr(result, "answer") else "説明を生成できませんでした。"
-        
-        # 説明を表示
-        msg.content = f"## 📘 説明: {question}\n\n{explanation}"
+        # 説明をストリーミング表示する
+        msg.content = f"## 📘 説明: {question}\n\n"
+        with session_generator() as problem_generator:
+            _, explanation = await stream_field(problem_generator.astream_explanation(question), msg, "answer")
+        if not explanation:
+            explanation = "説明を生成できませんでした。"
+            msg.content += explanation
         await msg.update()
         
         # チャット履歴に説明を追加
@@ -632,7 +1097,7 @@ async def handle_normal_chat(message_content: str):
     
     try:
         # 処理中表示
-        thinking_msg = cl.Message(content="考え中...")
+        thinking_msg = cl.Message(content="")
         await thinking_msg.send()
         
         # チャット履歴の取得
@@ -651,21 +1116,21 @@ async def handle_normal_chat(message_content: str):
         messages = [system_message]
         messages.extend([{"role": msg["role"], "content": msg["content"]} for msg in chat_history])
         
-        # 数学専門の知識を持つLLMとして応答を生成
-        response = llm.invoke(messages)
+        # 数学専門の知識を持つLLMとして応答をストリーミング生成
+        async for chunk in llm.astream(messages):
+            if chunk.content:
+                await thinking_msg.stream_token(chunk.content)
+        await thinking_msg.update()
+        response_content = thinking_msg.content
         
         # 応答を履歴に追加
-        chat_history.append({"role": "assistant", "content": response.content})
+        chat_history.append({"role": "assistant", "content": response_content})
         
         # 履歴を保存（最大10往復まで保存）
         if len(chat_history) > 20:  # 10往復 = 20メッセージ
             chat_history = chat_history[-20:]
         cl.user_session.set("chat_history", chat_history)
         
-        # 応答を表示
-        thinking_msg.content = response.content
-        await thinking_msg.update()
-        
     except Exception as e:
         error_traceback = traceback.format_exc()
         await cl.Message(content=f"エラーが発生しました: {str(e)}").send()
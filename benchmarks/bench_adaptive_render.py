@@ -0,0 +1,117 @@
+"""
+固定解像度と適応的な解像度のラスタライズを比較するベンチマーク
+
+ページごとに画像のバイト数、推定トークン数、最も小さい文字の高さ（ピクセル）を比較する。
+--ocrを指定するとビジョンLLMで実際にOCRを行い、テキストレイヤーとの一致率で品質を比較する
+（OPENAI_API_KEYが必要。テキストレイヤーを持つPDFを使用すること）。
+
+使い方:
+    python benchmarks/bench_adaptive_render.py [PDFのパス] [--pages 10] [--dpi 300] [--max-bytes 400000] [--ocr]
+"""
+import argparse
+import base64
+import os
+import re
+import sys
+import tempfile
+from difflib import SequenceMatcher
+from pathlib import Path
+
+import fitz  # PyMuPDF
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from page_renderer import AdaptiveRenderPolicy  # noqa: E402
+from pdf_processor import PDFProcessor  # noqa: E402
+from benchmarks.sample_pdf import make_sample_pdf  # noqa: E402
+
+
+def normalize(text):
+    """比較のために空白とLaTeXの区切り記号を取り除く"""
+    return re.sub(r"[\s$]", "", text)
+
+
+def ocr_score(processor, image, reference):
+    """画像をOCRし、テキストレイヤーとの一致率（0〜1）を返す"""
+    response = processor.process_img(base64.b64encode(image).decode("utf-8"))
+    return SequenceMatcher(None, normalize(response.content), normalize(reference)).ratio()
+
+
+def run(pdf_path, args):
+    policy = AdaptiveRenderPolicy(max_bytes=args.max_bytes, max_tokens=args.max_tokens)
+    processor = None
+    if args.ocr:
+        from langchain_openai import ChatOpenAI
+
+        # OCRだけを使うため、ベクトルストアは初期化しない
+        processor = PDFProcessor.__new__(PDFProcessor)
+        processor.llm = ChatOpenAI(model=args.model, temperature=0)
+
+    doc = fitz.open(pdf_path)
+    totals = {"固定": [0, 0, 0.0], "適応": [0, 0, 0.0]}
+    print(f"PDF: {pdf_path}（{len(doc)}ページ, 上限 {args.dpi}DPI, JPEG品質{args.quality}）")
+    print("ページ | 固定 KiB / トークン / 最小文字px | 適応 KiB / トークン / 最小文字px / DPI / 切り抜き")
+    for page in doc:
+        reference = page.get_text()
+        min_font_size = policy.analyze(page)["min_font_size"]
+
+        zoom = args.dpi / 72
+        fixed = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom)).tobytes(output="jpeg", jpg_quality=args.quality)
+        fixed_tokens = policy.estimate_tokens(page.rect.width * zoom, page.rect.height * zoom)
+        adaptive = policy.render(page, args.dpi, args.quality)
+        clip_ratio = adaptive["clip"].get_area() / page.rect.get_area()
+
+        def glyph_px(dpi, rect):
+            # ビジョンLLM側で縮小された後の、最も小さい文字の高さ
+            if not min_font_size:
+                return 0.0
+            short_side, long_side = sorted((rect.width * dpi / 72, rect.height * dpi / 72))
+            scale = min(1.0, 2048 / long_side)
+            scale *= min(1.0, 768 / (short_side * scale))
+            return min_font_size * dpi / 72 * scale
+
+        fixed_px = glyph_px(args.dpi, page.rect)
+        adaptive_px = glyph_px(adaptive["dpi"], adaptive["clip"])
+        print(
+            f"{page.number + 1:>4} | {len(fixed) / 1024:7.1f} / {fixed_tokens:5} / {fixed_px:5.1f}"
+            f" | {len(adaptive['image']) / 1024:7.1f} / {adaptive['tokens']:5} / {adaptive_px:5.1f}"
+            f" / {adaptive['dpi']:5.0f} / {clip_ratio:.0%}"
+        )
+        totals["固定"][0] += len(fixed)
+        totals["固定"][1] += fixed_tokens
+        totals["適応"][0] += len(adaptive["image"])
+        totals["適応"][1] += adaptive["tokens"]
+        if processor and reference.strip():
+            totals["固定"][2] += ocr_score(processor, fixed, reference)
+            totals["適応"][2] += ocr_score(processor, adaptive["image"], reference)
+
+    print()
+    for label, (total_bytes, total_tokens, total_score) in totals.items():
+        line = f"- {label}: {total_bytes / len(doc) / 1024:.1f} KiB/ページ, {total_tokens / len(doc):.0f} トークン/ページ"
+        if processor:
+            line += f", OCR一致率 {total_score / len(doc):.3f}"
+        print(line)
+    doc.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="適応的な解像度のラスタライズのベンチマーク")
+    parser.add_argument("pdf", nargs="?", help="対象のPDF（省略時はサンプルPDFを生成）")
+    parser.add_argument("--pages", type=int, default=10, help="サンプルPDFのページ数")
+    parser.add_argument("--dpi", type=int, default=300, help="解像度（適応時は上限）")
+    parser.add_argument("--quality", type=int, default=95, help="JPEG品質（適応時は上限）")
+    parser.add_argument("--max-bytes", type=int, default=400_000, help="1ページのバイト数の上限")
+    parser.add_argument("--max-tokens", type=int, default=1105, help="1ページのトークン数の上限")
+    parser.add_argument("--ocr", action="store_true", help="ビジョンLLMでOCRを行い品質を比較する")
+    parser.add_argument("--model", default="gpt-4o", help="OCRに使用するモデル")
+    args = parser.parse_args()
+
+    if args.pdf:
+        run(args.pdf, args)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            run(make_sample_pdf(os.path.join(tmp, "sample.pdf"), args.pages), args)
+
+
+if __name__ == "__main__":
+    main()
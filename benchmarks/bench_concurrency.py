@@ -0,0 +1,70 @@
+"""
+複数ユーザーの同時リクエストが並列に処理されることを確認するベンチマーク
+
+偽のチャットモデル（固定の待ち時間）でN人分の問題生成を同時に実行し、
+同期API（イベントループをブロックする）と非同期API（ainvoke）の所要時間と、
+処理中のイベントループの応答性（ハートビートの最大遅延）を比較する。
+
+使い方:
+    python benchmarks/bench_concurrency.py [--users 8] [--latency 0.5]
+"""
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from problem_generator import MathProblemGenerator  # noqa: E402
+from benchmarks.fakes import FakeChatModel, FakeEmbeddings  # noqa: E402
+
+
+async def heartbeat(stop: asyncio.Event, interval: float = 0.05):
+    """イベントループが止まっていないかを計測し、最大の遅延（秒）を返す"""
+    worst = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - start - interval)
+    return worst
+
+
+async def run_users(generator, users, use_async):
+    async def user_request(i):
+        if use_async:
+            return await generator.agenerate_problem(f"トピック{i}", "初級")
+        # 変更前のハンドラと同じく、非同期ハンドラの中から同期APIを呼ぶ
+        return generator.generate_problem(f"トピック{i}", "初級")
+
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(heartbeat(stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(user_request(i) for i in range(users)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    return elapsed, await monitor
+
+
+def main():
+    parser = argparse.ArgumentParser(description="同時リクエストのベンチマーク")
+    parser.add_argument("--users", type=int, default=8, help="同時に問題生成を行うユーザー数")
+    parser.add_argument("--latency", type=float, default=0.5, help="偽LLMの応答時間（秒）")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        generator = MathProblemGenerator(FakeChatModel(args.latency), FakeEmbeddings(), db_dir)
+
+        print(f"{args.users}ユーザーが同時に /generate を実行（LLM応答 {args.latency}秒）")
+        for label, use_async in [("同期API（変更前）", False), ("非同期API", True)]:
+            elapsed, worst_stall = asyncio.run(run_users(generator, args.users, use_async))
+            print(f"- {label}: 全体 {elapsed:.2f}秒, イベントループの最大停止 {worst_stall:.2f}秒")
+
+        ok = elapsed < args.latency * 2
+        print("並列に処理されています" if ok else "並列に処理されていません")
+        sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
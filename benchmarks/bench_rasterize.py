@@ -0,0 +1,88 @@
+"""
+ページのラスタライズ方式を比較するベンチマーク
+
+一時JPEGファイルを経由する従来方式と、Pixmapのバッファから直接エンコードする
+メモリ上の方式について、1ページあたりのバイト数と処理時間を表示する。
+
+使い方:
+    python benchmarks/bench_rasterize.py [PDFのパス] [--pages N] [--dpi 300] [--quality 95]
+"""
+import argparse
+import base64
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import fitz  # PyMuPDF
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pdf_processor import PDFProcessor  # noqa: E402
+from benchmarks.sample_pdf import make_sample_pdf  # noqa: E402
+
+
+def encode_via_temp_file(page, page_num, dpi):
+    """従来方式: 一時JPEGファイルに保存してから読み込んでbase64エンコードする"""
+    pix = page.get_pixmap(matrix=fitz.Matrix(dpi/72, dpi/72))
+    temp_path = f"temp_page_{page_num}.jpg"
+    pix.save(temp_path)
+    with open(temp_path, "rb") as image_file:
+        encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
+    os.remove(temp_path)
+    return encoded_string
+
+
+def run(pdf_path, dpi, quality):
+    # ラスタライズ処理だけを使うため、ベクトルストアやモデルは初期化しない
+    processor = PDFProcessor.__new__(PDFProcessor)
+    processor.render_dpi = dpi
+    processor.jpeg_quality = quality
+    processor.render_policy = None
+
+    doc = fitz.open(pdf_path)
+    total_pages = len(doc)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            for label, encode in [
+                ("一時ファイル経由", lambda page, n: encode_via_temp_file(page, n, dpi)),
+                ("メモリ上", lambda page, n: processor.encode_page(page)),
+            ]:
+                total_bytes = 0
+                start = time.perf_counter()
+                for page_num in range(total_pages):
+                    total_bytes += len(encode(doc[page_num], page_num))
+                elapsed = time.perf_counter() - start
+                results[label] = (total_bytes / total_pages, elapsed / total_pages * 1000)
+        finally:
+            os.chdir(cwd)
+
+    doc.close()
+
+    print(f"PDF: {pdf_path}（{total_pages}ページ, {dpi}DPI, JPEG品質{quality}）")
+    for label, (bytes_per_page, ms_per_page) in results.items():
+        print(f"- {label}: {bytes_per_page / 1024:.1f} KiB/ページ (base64), {ms_per_page:.1f} ms/ページ")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ページラスタライズ方式のベンチマーク")
+    parser.add_argument("pdf", nargs="?", help="対象のPDF（省略時はサンプルPDFを生成）")
+    parser.add_argument("--pages", type=int, default=10, help="サンプルPDFのページ数")
+    parser.add_argument("--dpi", type=int, default=300)
+    parser.add_argument("--quality", type=int, default=95)
+    args = parser.parse_args()
+
+    if args.pdf:
+        run(args.pdf, args.dpi, args.quality)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            run(make_sample_pdf(os.path.join(tmp, "sample.pdf"), args.pages), args.dpi, args.quality)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+ページのラスタライズをプロセスプールで行った場合の効果を計測するベンチマーク
+
+すべてのページをビジョンOCRの対象にして、イベントループのスレッドでラスタライズする方式と
+PageRendererのワーカープロセスでラスタライズする方式の所要時間と、
+処理中のイベントループの応答性（ハートビートの最大遅延）を比較する。
+
+使い方:
+    python benchmarks/bench_render_pool.py [PDFのパス] [--pages 40] [--workers 4] [--dpi 300]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pdf_processor import PDFProcessor  # noqa: E402
+from page_renderer import PageRenderer  # noqa: E402
+from benchmarks.bench_concurrency import heartbeat  # noqa: E402
+from benchmarks.fakes import FakeChatModel, FakeEmbeddings  # noqa: E402
+from benchmarks.sample_pdf import make_sample_pdf  # noqa: E402
+
+
+async def run(pdf_path, db_dir, renderer, args):
+    processor = PDFProcessor(
+        db_dir,
+        FakeEmbeddings(),
+        FakeChatModel(args.latency),
+        max_concurrency=args.concurrency,
+        render_dpi=args.dpi,
+        text_fast_path=False,
+        renderer=renderer,
+    )
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(heartbeat(stop))
+    start = time.perf_counter()
+    try:
+        await processor.process_pdf_with_progress(pdf_path)
+    finally:
+        processor.close()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    return elapsed, await monitor
+
+
+def main():
+    parser = argparse.ArgumentParser(description="プロセスプールによるラスタライズのベンチマーク")
+    parser.add_argument("pdf", nargs="?", help="計測に使用するPDF（省略時はサンプルPDFを生成）")
+    parser.add_argument("--pages", type=int, default=40, help="サンプルPDFのページ数")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="ワーカープロセス数")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時に行うOCRの数")
+    parser.add_argument("--latency", type=float, default=0.05, help="偽LLMの応答時間（秒）")
+    parser.add_argument("--dpi", type=int, default=300, help="解像度")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        pdf_path = args.pdf or os.path.join(work_dir, "sample.pdf")
+        if not args.pdf:
+            make_sample_pdf(pdf_path, args.pages)
+
+        renderer = PageRenderer(max_workers=args.workers)
+        print(f"{pdf_path}（DPI {args.dpi}, ワーカー {args.workers}）")
+        try:
+            for label, page_renderer in [("イベントループ上", None), ("プロセスプール", renderer)]:
+                db_dir = os.path.join(work_dir, f"db_{page_renderer is not None}")
+                elapsed, worst_stall = asyncio.run(run(pdf_path, db_dir, page_renderer, args))
+                print(f"- {label}: 全体 {elapsed:.2f}秒, イベントループの最大停止 {worst_stall:.2f}秒")
+        finally:
+            renderer.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+取り込みと問題生成のオフラインベンチマーク
+
+偽チャットモデルと偽埋め込みモデル（固定の待ち時間、1文字1トークン）を使い、
+生成したサンプルPDF（既定では10・100・1000ページ）を取り込んでから
+問題生成（/generate）と解説（/explain）を繰り返す。ネットワークには接続しない。
+
+ページ数ごとに別プロセスで実行し、次の値を計測してJSONに保存する。
+- 取り込みのページ/秒と処理段階ごとの所要時間
+- 問題生成・解説の応答時間（p50/p95）
+- 最大RSS（メモリ使用量）とChromaのディスク使用量
+- 偽モデルが消費したトークン数
+
+--compareに以前の結果のJSONを指定すると、主な値の変化を表示する。
+
+使い方:
+    python benchmarks/bench_suite.py [--pages 10 100 1000] [--requests 20] [--output bench_results.json]
+        [--compare 以前の結果.json] [--vision]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import traceback
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from metrics import Histogram, STAGE_SECONDS  # noqa: E402
+from page_renderer import page_renderer  # noqa: E402
+from pdf_processor import PDFProcessor  # noqa: E402
+from problem_generator import MathProblemGenerator  # noqa: E402
+from benchmarks.fakes import FakeChatModel, FakeEmbeddings  # noqa: E402
+from benchmarks.sample_pdf import make_sample_pdf  # noqa: E402
+
+TOPICS = ["平均値の定理", "ベクトル場の回転", "固有値", "ε-δ論法", "微分方程式"]
+
+
+def peak_rss_bytes(who=resource.RUSAGE_SELF) -> int:
+    """最大RSSをバイト単位で返す（Linuxではキロバイト、macOSではバイトで返されるため換算する）"""
+    peak = resource.getrusage(who).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def directory_size(path: str) -> int:
+    """ディレクトリ以下のファイルの合計サイズ（バイト）"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+async def measure_requests(label, requests, concurrency, call):
+    """callを同時実行数concurrencyでrequests回呼び出し、応答時間の集計を返す"""
+    latencies = Histogram(label, "")
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            with latencies.time():
+                await call(i)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - start
+    stats = latencies.summary()[()]
+    return {
+        "requests": requests,
+        "requests_per_sec": requests / elapsed,
+        "p50_ms": stats["p50"] * 1000,
+        "p95_ms": stats["p95"] * 1000,
+        "avg_ms": stats["avg"] * 1000,
+    }
+
+
+async def run_scenario_async(num_pages, args, work_dir):
+    pdf_path = make_sample_pdf(os.path.join(work_dir, "sample.pdf"), num_pages)
+    db_dir = os.path.join(work_dir, "db")
+    llm = FakeChatModel(args.llm_latency)
+    embeddings = FakeEmbeddings(latency=args.embedding_latency)
+
+    processor = PDFProcessor(
+        db_dir,
+        embeddings,
+        llm,
+        max_concurrency=args.concurrency,
+        text_fast_path=not args.vision,
+    )
+    start = time.perf_counter()
+    try:
+        result = await processor.process_pdf_with_progress(pdf_path)
+    finally:
+        processor.close()
+    ingest_seconds = time.perf_counter() - start
+    # 処理段階ごとの合計時間（ページは並行して処理されるため、全体の時間を超えることがある）
+    ingest_stages = {stage: round(stats["sum"], 3) for (stage,), stats in STAGE_SECONDS.summary().items()}
+
+    generator = MathProblemGenerator(llm, embeddings, db_dir)
+    try:
+        generate = await measure_requests(
+            "generate", args.requests, args.users,
+            lambda i: generator.agenerate_problem(TOPICS[i % len(TOPICS)], "中級"),
+        )
+        explain = await measure_requests(
+            "explain", args.requests, args.users,
+            lambda i: generator.aexplain_problem(f"{TOPICS[i % len(TOPICS)]}について説明してください（{i}）"),
+        )
+    finally:
+        generator.close()
+
+    return {
+        "pages": num_pages,
+        "ingest": {
+            "status": result["status"],
+            "seconds": ingest_seconds,
+            "pages_per_sec": num_pages / ingest_seconds,
+            "vision_pages": result["vision_pages"],
+            "documents": result["throughput"]["embeddings_computed"],
+            "stage_seconds": ingest_stages,
+        },
+        "generate": generate,
+        "explain": explain,
+        "tokens": {
+            "prompt": llm.prompt_tokens,
+            "completion": llm.completion_tokens,
+            "embedding": embeddings.tokens,
+        },
+        "peak_rss_bytes": peak_rss_bytes(),
+        "peak_rss_children_bytes": peak_rss_bytes(resource.RUSAGE_CHILDREN),
+        "chroma_disk_bytes": directory_size(db_dir),
+    }
+
+
+def run_scenario(num_pages, args):
+    """1つのページ数のシナリオを実行する"""
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            return asyncio.run(run_scenario_async(num_pages, args, work_dir))
+    finally:
+        # ラスタライズのワーカープロセスを止めないと、このプロセスが終了できない
+        page_renderer.close()
+
+
+def _scenario_process(num_pages, args, queue):
+    try:
+        queue.put(("ok", run_scenario(num_pages, args)))
+    except Exception:
+        queue.put(("error", traceback.format_exc()))
+
+
+def run_in_subprocess(num_pages, args):
+    """
+    シナリオを新しいプロセスで実行して結果を返す
+
+    最大RSSをシナリオごとに独立して計測するため、spawnで起動する。
+    ページのラスタライズ用にワーカープロセスを起動できるよう、デーモンにはしない。
+    """
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_scenario_process, args=(num_pages, args, queue))
+    process.start()
+    status, result = queue.get()
+    process.join()
+    if status != "ok":
+        raise RuntimeError(f"{num_pages}ページのシナリオでエラーが発生しました:\n{result}")
+    return result
+
+
+def print_result(result):
+    ingest = result["ingest"]
+    print(
+        f"- {result['pages']}ページ: 取り込み {ingest['seconds']:.1f}秒（{ingest['pages_per_sec']:.1f}ページ/秒）, "
+        f"generate p50 {result['generate']['p50_ms']:.0f} ms / p95 {result['generate']['p95_ms']:.0f} ms, "
+        f"explain p50 {result['explain']['p50_ms']:.0f} ms / p95 {result['explain']['p95_ms']:.0f} ms, "
+        f"最大RSS {result['peak_rss_bytes'] / 1024 / 1024:.0f} MiB, "
+        f"Chroma {result['chroma_disk_bytes'] / 1024 / 1024:.1f} MiB"
+    )
+
+
+def compare(previous, current):
+    """以前の結果と比較して、主な値の変化を表示する"""
+    before = {result["pages"]: result for result in previous["results"]}
+    metrics = [
+        ("取り込みページ/秒", lambda r: r["ingest"]["pages_per_sec"]),
+        ("generate p95 ms", lambda r: r["generate"]["p95_ms"]),
+        ("explain p95 ms", lambda r: r["explain"]["p95_ms"]),
+        ("最大RSS MiB", lambda r: r["peak_rss_bytes"] / 1024 / 1024),
+        ("Chroma MiB", lambda r: r["chroma_disk_bytes"] / 1024 / 1024),
+    ]
+    print("\n以前の結果との比較:")
+    for result in current["results"]:
+        old = before.get(result["pages"])
+        if old is None:
+            continue
+        changes = []
+        for label, value in metrics:
+            old_value, new_value = value(old), value(result)
+            ratio = f"{(new_value - old_value) / old_value:+.0%}" if old_value else "—"
+            changes.append(f"{label} {old_value:.1f} → {new_value:.1f} ({ratio})")
+        print(f"- {result['pages']}ページ: " + ", ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="取り込みと問題生成のオフラインベンチマーク")
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 100, 1000], help="サンプルPDFのページ数")
+    parser.add_argument("--requests", type=int, default=20, help="generate・explainそれぞれの呼び出し回数")
+    parser.add_argument("--users", type=int, default=4, help="generate・explainの同時実行数")
+    parser.add_argument("--concurrency", type=int, default=4, help="取り込み時に同時に行うOCRの数")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="偽LLMの応答時間（秒）")
+    parser.add_argument("--embedding-latency", type=float, default=0.01, help="偽埋め込みモデルの応答時間（秒）")
+    parser.add_argument("--vision", action="store_true", help="テキストレイヤーを使わず全ページをOCRする")
+    parser.add_argument("--output", default="bench_results.json", help="結果を保存するJSONのパス")
+    parser.add_argument("--compare", help="比較する以前の結果のJSON")
+    args = parser.parse_args()
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": vars(args),
+        "results": [],
+    }
+
+    print(f"偽LLM {args.llm_latency}秒, 偽埋め込み {args.embedding_latency}秒, "
+          f"{'全ページOCR' if args.vision else 'テキストレイヤー優先'}")
+    for num_pages in args.pages:
+        result = run_in_subprocess(num_pages, args)
+        print_result(result)
+        report["results"].append(result)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n結果を {args.output} に保存しました")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
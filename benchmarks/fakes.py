@@ -0,0 +1,116 @@
+"""
+ベンチマーク用の決定的な偽チャットモデルと偽埋め込みモデル
+
+ネットワークに接続せず、固定の待ち時間でOpenAIのモデルの代わりに応答する。
+トークン数は本体の概算と同じく1文字1トークンとして数える。
+"""
+import asyncio
+import hashlib
+import time
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+
+from llm_client import estimate_message_tokens
+
+
+class FakeChatModel:
+    """固定の待ち時間で応答する偽チャットモデル"""
+
+    def __init__(self, latency: float = 0.5):
+        """
+        Args:
+            latency (float): 1回の呼び出しにかかる秒数
+        """
+        self.latency = latency
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def _count(self, prompt, output: str):
+        """入力と出力の文字数をトークン数として加算する"""
+        if hasattr(prompt, "to_messages"):
+            prompt = prompt.to_messages()
+        # 画像は本体の概算と同じく1枚あたりIMAGE_TOKENSとして数える
+        self.prompt_tokens += estimate_message_tokens(prompt if isinstance(prompt, list) else [str(prompt)])
+        self.completion_tokens += len(output)
+
+    def _reply(self, messages) -> str:
+        self.calls += 1
+        reply = f"$x^{self.calls}$ に関する応答です。"
+        self._count(messages, reply)
+        return reply
+
+    def invoke(self, messages, config=None, **kwargs):
+        time.sleep(self.latency)
+        return AIMessage(content=self._reply(messages))
+
+    async def ainvoke(self, messages, config=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        return AIMessage(content=self._reply(messages))
+
+    def with_structured_output(self, schema, **kwargs):
+        """スキーマのインスタンス（辞書スキーマの場合は辞書）を返すRunnableを作成する"""
+
+        def build(prompt):
+            self.calls += 1
+            fields = {
+                "question": f"問題 {self.calls}: $\\int_0^1 x^{self.calls} dx$ を求めよ。",
+                "answer": f"$\\frac{{1}}{{{self.calls + 1}}}$",
+            }
+            self._count(prompt, fields["question"] + fields["answer"])
+            return fields if isinstance(schema, dict) else schema(**fields)
+
+        def invoke(prompt):
+            time.sleep(self.latency)
+            return build(prompt)
+
+        async def ainvoke(prompt):
+            await asyncio.sleep(self.latency)
+            return build(prompt)
+
+        return RunnableLambda(invoke, afunc=ainvoke)
+
+
+class FakeEmbeddings(Embeddings):
+    """テキストのハッシュから決定的なベクトルを返す偽埋め込みモデル"""
+
+    model = "fake-embedding"
+
+    def __init__(self, dim: int = 32, latency: float = 0.0, fail_calls=()):
+        """
+        Args:
+            dim (int): ベクトルの次元数
+            latency (float): 1回の呼び出しにかかる秒数
+            fail_calls (set): 例外を送出するaembed_documentsの呼び出し回数（1始まり。障害時の動作の確認用）
+        """
+        self.dim = dim
+        self.latency = latency
+        self.fail_calls = set(fail_calls)
+        self.document_calls = 0
+        self.tokens = 0
+
+    def _vector(self, text: str):
+        self.tokens += len(text)
+        digest = hashlib.sha256(text.encode("utf-8")).digest()
+        return [digest[i % len(digest)] / 255.0 for i in range(self.dim)]
+
+    def embed_documents(self, texts):
+        time.sleep(self.latency)
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text):
+        time.sleep(self.latency)
+        return self._vector(text)
+
+    async def aembed_documents(self, texts):
+        await asyncio.sleep(self.latency)
+        self.document_calls += 1
+        if self.document_calls in self.fail_calls:
+            raise RuntimeError(f"埋め込みリクエスト {self.document_calls} 回目が失敗しました（rate limited）")
+        return [self._vector(text) for text in texts]
+
+    async def aembed_query(self, text):
+        await asyncio.sleep(self.latency)
+        return self._vector(text)
@@ -0,0 +1,38 @@
+"""ベンチマーク用のサンプルPDFを生成するモジュール"""
+import fitz  # PyMuPDF
+
+SAMPLE_PARAGRAPHS = [
+    "定理 {n}.1 (平均値の定理) 関数 f が閉区間 [a, b] で連続、開区間 (a, b) で微分可能ならば、"
+    "f(b) - f(a) = f'(c)(b - a) を満たす c が存在する。",
+    "定義 {n}.2 ベクトル場 F の回転を rot F = ∇ × F で定める。",
+    "例題 {n}.3 行列 A の固有値 λ は det(A - λI) = 0 の解として求められる。",
+    "証明. ε > 0 を任意に取る。δ = ε / 2 とおけば |x - a| < δ のとき |f(x) - f(a)| < ε が成り立つ。",
+]
+
+
+def make_sample_pdf(path: str, num_pages: int) -> str:
+    """
+    数学資料を模したテキストを含むサンプルPDFを作成する
+
+    Args:
+        path (str): 保存先のパス
+        num_pages (int): ページ数
+
+    Returns:
+        str: 保存したPDFのパス
+    """
+    doc = fitz.open()
+    for page_num in range(num_pages):
+        page = doc.new_page()
+        body = "\n\n".join(p.format(n=page_num + 1) for p in SAMPLE_PARAGRAPHS)
+        page.insert_textbox(
+            fitz.Rect(72, 72, page.rect.width - 72, page.rect.height - 72),
+            f"第{page_num + 1}節\n\n{body}",
+            fontname="japan",
+            fontsize=11,
+        )
+        # 図を模した矩形
+        page.draw_rect(fitz.Rect(100, 500, 300, 650), color=(0, 0, 0), fill=(0.85, 0.85, 0.85))
+    doc.save(path)
+    doc.close()
+    return path
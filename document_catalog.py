@@ -0,0 +1,190 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class DocumentCatalog:
+    """
+    ストアに取り込んだドキュメント（PDF）の目録
+
+    ソースごとの取り込み日時と、ページごとのページハッシュ・チャンク数・次のページに引き継ぐ見出しを
+    ストアのディレクトリ内のSQLiteに保存する。同じソースを取り込み直すときは、ページハッシュが
+    変わっていないページのOCRと埋め込みを省略し、変わったページのチャンクだけを置き換えるのに使う。
+    """
+
+    DB_FILE = "document_catalog.sqlite3"
+    # チャンクIDの形式（PDFProcessor.make_document_idの引数が変わったら上げる）
+    ID_SCHEME = "2"
+
+    def __init__(self, store_path: str):
+        """
+        Args:
+            store_path (str): ストアのディレクトリ
+        """
+        self._lock = threading.Lock()
+        os.makedirs(store_path, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(store_path, self.DB_FILE), timeout=30, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS documents (
+                    source TEXT PRIMARY KEY,
+                    total_pages INTEGER,
+                    status TEXT NOT NULL,
+                    ingested_at REAL,
+                    updated_at REAL
+                )
+                """
+            )
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS pages (
+                    source TEXT NOT NULL,
+                    page INTEGER NOT NULL,
+                    page_hash TEXT,
+                    chunks INTEGER NOT NULL,
+                    section TEXT,
+                    PRIMARY KEY (source, page)
+                )
+                """
+            )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            # ページ番号を含まないIDで書き込まれたページは、ページハッシュを消して次の取り込みで処理し直す
+            # （古いIDのチャンクは、ページハッシュのないページと同じくページ番号で扱われる）
+            if not self._conn.execute("SELECT 1 FROM meta WHERE key = 'id_scheme'").fetchone():
+                self._conn.execute("UPDATE pages SET page_hash = NULL")
+                self._conn.execute("INSERT INTO meta (key, value) VALUES ('id_scheme', ?)", (self.ID_SCHEME,))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def get_pages(self, source: str) -> dict:
+        """
+        ソースの取り込み済みのページを返す
+
+        Returns:
+            dict: ページ番号（1始まり） -> {"page_hash", "chunks", "section"}
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT page, page_hash, chunks, section FROM pages WHERE source = ?", (source,)
+            ).fetchall()
+        return {row["page"]: {"page_hash": row["page_hash"], "chunks": row["chunks"], "section": row["section"]}
+                for row in rows}
+
+    def record_page(self, source: str, page: int, page_hash: str, chunks: int, section: str):
+        """ベクトルストアへの書き込みが完了したページを記録する"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO documents (source, status, ingested_at, updated_at) VALUES (?, 'ingesting', ?, ?)",
+                (source, now, now),
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pages (source, page, page_hash, chunks, section) VALUES (?, ?, ?, ?, ?)",
+                (source, page, page_hash, chunks, section),
+            )
+            self._conn.commit()
+
+    def finish_source(self, source: str, total_pages: int, status: str):
+        """
+        ソースの取り込みの完了を記録し、PDFから無くなったページを目録から削除する
+
+        Args:
+            status (str): "complete"（全ページ取り込み済み）または "partial"（失敗したページがある）
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT INTO documents (source, total_pages, status, ingested_at, updated_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(source) DO UPDATE SET total_pages = excluded.total_pages, status = excluded.status,
+                                                  updated_at = excluded.updated_at
+                """,
+                (source, total_pages, status, now, now),
+            )
+            self._conn.execute("DELETE FROM pages WHERE source = ? AND page > ?", (source, total_pages))
+            self._conn.commit()
+
+    def get_document(self, source: str):
+        """ソースの情報を返す。取り込まれていない場合はNone"""
+        return next((doc for doc in self.list_documents() if doc["source"] == source), None)
+
+    def list_documents(self) -> list:
+        """
+        取り込み済みのソースの一覧を返す（ソース名順）
+
+        Returns:
+            list: {"source", "pages", "chunks", "total_pages", "status", "ingested_at", "updated_at"} のリスト
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT d.source, d.total_pages, d.status, d.ingested_at, d.updated_at,
+                       COUNT(p.page) AS pages, COALESCE(SUM(p.chunks), 0) AS chunks
+                FROM documents d LEFT JOIN pages p ON p.source = d.source
+                GROUP BY d.source ORDER BY d.source
+                """
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def delete_source(self, source: str):
+        """ソースを目録から削除する"""
+        with self._lock:
+            self._conn.execute("DELETE FROM pages WHERE source = ?", (source,))
+            self._conn.execute("DELETE FROM documents WHERE source = ?", (source,))
+            self._conn.commit()
+
+    def backfill(self, collection, batch_size: int = 5000) -> int:
+        """
+        目録を作る前に取り込まれたドキュメントを、Chromaのメタデータから目録に登録する（1回だけ行う）
+
+        ページハッシュと取り込み日時は復元できないため空にする。
+        これらのソースを取り込み直した場合は、全ページが処理し直される。
+
+        Args:
+            collection: ストアのChromaコレクション
+            batch_size (int): 1回に読み込むドキュメント数
+
+        Returns:
+            int: 登録したソースの数
+        """
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM meta WHERE key = 'backfilled'").fetchone():
+                return 0
+            known = {row[0] for row in self._conn.execute("SELECT source FROM documents")}
+
+        # ソース -> ページ番号 -> チャンク数
+        sources = {}
+        offset = 0
+        while True:
+            batch = collection.get(include=["metadatas"], limit=batch_size, offset=offset)
+            for metadata in batch["metadatas"]:
+                source = (metadata or {}).get("source")
+                if source is None or source in known:
+                    continue
+                pages = sources.setdefault(source, {})
+                page = metadata.get("page", 0)
+                pages[page] = pages.get(page, 0) + 1
+            if len(batch["ids"]) < batch_size:
+                break
+            offset += batch_size
+
+        with self._lock:
+            for source, pages in sources.items():
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO documents (source, total_pages, status) VALUES (?, ?, 'complete')",
+                    (source, max(pages)),
+                )
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO pages (source, page, chunks) VALUES (?, ?, ?)",
+                    [(source, page, chunks) for page, chunks in pages.items()],
+                )
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('backfilled', ?)", (str(time.time()),))
+            self._conn.commit()
+        return len(sources)
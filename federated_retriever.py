@@ -0,0 +1,201 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Dict, List
+
+from langchain_core.documents import Document
+from langchain_core.pydantic_v1 import PrivateAttr
+from langchain_core.retrievers import BaseRetriever
+
+from metrics import metrics
+from store_registry import store_registry
+
+# ストアごとの検索時間と、時間内に応答しなかったストアの数
+FEDERATED_STORE_SECONDS = metrics.histogram(
+    "mathgen_federated_store_seconds", "複数ストア検索でのストアごとの検索時間（秒）", ("store",)
+)
+FEDERATED_TIMEOUTS = metrics.counter(
+    "mathgen_federated_timeouts_total", "複数ストア検索で時間内に応答しなかったストアの数", ("store",)
+)
+
+
+def doc_key(doc: Document):
+    """1つのストア内で同じチャンクを識別するキー（ストアをまたぐ場合はストアと組み合わせて使う）"""
+    metadata = doc.metadata
+    if metadata.get("source") is not None and metadata.get("page") is not None:
+        return (metadata["source"], metadata["page"], metadata.get("chunk", 0))
+    return doc.page_content
+
+
+def reciprocal_rank_fusion(results: Dict[str, List[Document]], k: int, rrf_k: int = 60,
+                           label_key: str = None, key_func=None) -> List[Document]:
+    """
+    複数の検索結果をReciprocal Rank Fusion（RRF）で統合する
+
+    各検索結果での順位rに対して1 / (rrf_k + r)を加算し、合計の大きい順に上位k件を返す。
+    ドキュメントのメタデータにはRRFのスコア（rrf_score）を追加する。
+
+    Args:
+        results (dict): 検索結果の名前 -> ドキュメントのリスト（順位の高い順）
+        k (int): 返す件数
+        rrf_k (int): RRFの定数（大きいほど下位の結果の重みが上位に近づく）
+        label_key (str): 指定した場合、最初に見つかった検索結果の名前をこのキーでメタデータに追加する
+        key_func (function): (検索結果の名前, ドキュメント)から同じチャンクを識別するキーを返す関数
+                             （省略した場合はdoc_key。同じキーのドキュメントはスコアを合算して1つにまとめる）
+    """
+    scores = {}
+    docs = {}
+    for name, ranked_docs in results.items():
+        for rank, doc in enumerate(ranked_docs, start=1):
+            key = key_func(name, doc) if key_func else doc_key(doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank)
+            if key not in docs:
+                metadata = {**doc.metadata, label_key: name} if label_key else dict(doc.metadata)
+                docs[key] = Document(page_content=doc.page_content, metadata=metadata)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:k]
+    for key in ranked:
+        docs[key].metadata["rrf_score"] = scores[key]
+    return [docs[key] for key in ranked]
+
+
+class FederatedRetriever(BaseRetriever):
+    """
+    複数のストアを並行して検索し、Reciprocal Rank Fusion（RRF）で結果を統合するリトリーバー
+
+    クエリの埋め込みは1回だけ計算して全ストアで共有する。ストアごとに時間制限を設け、
+    時間内に応答しなかったストアやエラーになったストアは除外して残りの結果だけを返す。
+    時間切れになった検索はスレッドを使い続けるため、その検索が終わるまでそのストアは検索せずに
+    時間切れとして扱う（応答しないストアの検索でスレッドが埋まり、他のストアが順番待ちにならないようにする）。
+    """
+
+    # ストア名 -> ベクトルストア（Chroma）
+    stores: Dict[str, Any]
+    # ストア名 -> ストアのパス（closeで参照を解放するため）
+    store_paths: Dict[str, str] = {}
+    embedding_model: Any
+    registry: Any = None
+    # 統合後に返す件数
+    k: int = 3
+    # 1つのストアから取得する件数（Noneの場合はk）
+    fetch_k: int = None
+    # 1つのストアの検索を待つ秒数
+    timeout: float = 5.0
+    # RRFの定数（大きいほど下位の結果の重みが上位に近づく）
+    rrf_k: int = 60
+    # ストアの検索を実行するスレッド（ストアごとに1つ。共有のスレッドプールで順番待ちにならないようにする）
+    _executor: Any = PrivateAttr(default=None)
+    # ストア名 -> 時間切れになった後も実行中の検索（Future）
+    _stalled: Dict[str, Any] = PrivateAttr(default_factory=dict)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+    @classmethod
+    def from_store_paths(cls, store_paths: Dict[str, str], embedding_model, registry=store_registry, **kwargs):
+        """
+        レジストリから各ストアを取得してリトリーバーを作成する（使い終わったらcloseを呼ぶこと）
+
+        Args:
+            store_paths (dict): ストア名 -> ストアのパス
+            embedding_model: クエリの埋め込みに使用するモデル（ストアの取り込みと同じモデル）
+            registry (StoreHandleRegistry): ストアのクライアントを共有するレジストリ
+        """
+        stores = {name: registry.acquire(path, embedding_model) for name, path in store_paths.items()}
+        return cls(stores=stores, store_paths=dict(store_paths), embedding_model=embedding_model,
+                   registry=registry, **kwargs)
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=max(1, len(self.stores)))
+        return self._executor
+
+    def close(self):
+        """ストアの参照とスレッドを解放する"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self.registry is not None:
+            for path in self.store_paths.values():
+                self.registry.release(path)
+            self.store_paths = {}
+
+    def fuse(self, results: Dict[str, List[Document]]) -> List[Document]:
+        """
+        ストアごとの検索結果をRRFで統合する
+
+        ドキュメントのメタデータには取得元のストア名（store）とRRFのスコア（rrf_score）を追加する。
+        同じソース・ページ・チャンク番号でも、ストアが異なる場合は別のチャンクとして扱う。
+        """
+        return reciprocal_rank_fusion(
+            results, self.k, self.rrf_k, label_key="store",
+            key_func=lambda name, doc: (self.store_paths.get(name, name), doc_key(doc)),
+        )
+
+    def _search(self, store_name, embedding):
+        with FEDERATED_STORE_SECONDS.time(store=store_name):
+            return self.stores[store_name].similarity_search_by_vector(embedding, k=self.fetch_k or self.k)
+
+    def _log_failure(self, store_name, error=None, busy=False):
+        if busy:
+            FEDERATED_TIMEOUTS.inc(store=store_name)
+            print(f"ストア「{store_name}」は時間切れになった前回の検索がまだ完了していないため、結果から除外しました")
+        elif error is None:
+            FEDERATED_TIMEOUTS.inc(store=store_name)
+            print(f"ストア「{store_name}」の検索が{self.timeout}秒以内に完了しなかったため、結果から除外しました")
+        else:
+            print(f"ストア「{store_name}」の検索中にエラーが発生したため、結果から除外しました: {str(error)}")
+
+    def _submit(self, embedding) -> dict:
+        """
+        各ストアの検索をスレッドで開始する
+
+        時間切れになった前回の検索がまだ実行中のストアは検索せず、時間切れとして記録する。
+
+        Returns:
+            dict: Future -> ストア名
+        """
+        futures = {}
+        for name in self.stores:
+            with self._lock:
+                stalled = self._stalled.get(name)
+                if stalled is not None and stalled.done():
+                    del self._stalled[name]
+                    stalled = None
+            if stalled is not None:
+                self._log_failure(name, busy=True)
+                continue
+            futures[self.executor.submit(self._search, name, embedding)] = name
+        return futures
+
+    def _collect(self, futures: dict, done) -> dict:
+        """完了した検索の結果をストアごとにまとめ、時間切れになった検索を記録する"""
+        results = {}
+        for future, name in futures.items():
+            if future not in done:
+                with self._lock:
+                    self._stalled[name] = future
+                self._log_failure(name)
+            elif future.exception() is not None:
+                self._log_failure(name, future.exception())
+            else:
+                results[name] = future.result()
+        return results
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        embedding = self.embedding_model.embed_query(query)
+        futures = self._submit(embedding)
+        # 時間切れのストアの検索は待たずに、完了した分だけで統合する
+        done, _ = wait(futures, timeout=self.timeout)
+        return self.fuse(self._collect(futures, done))
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        embedding = await self.embedding_model.aembed_query(query)
+        futures = self._submit(embedding)
+        waiting = {asyncio.wrap_future(future): future for future in futures}
+        done = set()
+        if waiting:
+            finished, pending = await asyncio.wait(waiting, timeout=self.timeout)
+            done = {waiting[future] for future in finished}
+            # 時間切れの検索はスレッドで実行されたまま残るため、イベントループ側の待機だけをやめる
+            for future in pending:
+                future.cancel()
+        return self.fuse(self._collect(futures, done))
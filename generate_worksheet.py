@@ -0,0 +1,117 @@
+"""
+Chainlitを起動せずに問題セットを一括生成するコマンドラインツール
+
+使い方:
+    python generate_worksheet.py --spec 微分積分:中級:10 --spec 線形代数:初級:5 -o worksheet.md
+    python generate_worksheet.py --spec-file specs.jsonl --store 線形代数資料 -o worksheet.jsonl
+
+specs.jsonlの各行は {"topic": "微分積分", "difficulty": "中級", "count": 10} の形式です。
+"""
+import argparse
+import json
+import os
+import sys
+
+VALID_DIFFICULTIES = ["初級", "中級", "上級"]
+
+
+def parse_spec(text: str) -> dict:
+    """「出題範囲:難易度:問題数」形式の指定を辞書に変換する"""
+    parts = text.rsplit(":", 2)
+    if len(parts) != 3:
+        raise argparse.ArgumentTypeError(f"'{text}' は「出題範囲:難易度:問題数」の形式ではありません")
+    topic, difficulty, count = parts
+    if difficulty not in VALID_DIFFICULTIES:
+        raise argparse.ArgumentTypeError(f"無効な難易度です: {difficulty}（有効な難易度: {', '.join(VALID_DIFFICULTIES)}）")
+    return {"topic": topic, "difficulty": difficulty, "count": int(count)}
+
+
+def load_spec_file(path: str) -> list:
+    """JSONL形式の指定ファイルを読み込む"""
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_jsonl(results, path):
+    with open(path, "w", encoding="utf-8") as f:
+        for item in results:
+            f.write(json.dumps({
+                "topic": item["topic"],
+                "difficulty": item["difficulty"],
+                "question": item["problem"].question,
+                "answer": item["problem"].answer,
+            }, ensure_ascii=False) + "\n")
+
+
+def write_markdown(results, path):
+    lines = ["# 問題セット", ""]
+    for number, item in enumerate(results, 1):
+        lines += [f"## 問題 {number}（{item['topic']} / {item['difficulty']}）", "", item["problem"].question, ""]
+    lines += ["---", "", "# 解答", ""]
+    for number, item in enumerate(results, 1):
+        lines += [f"## 問題 {number} の解答", "", item["problem"].answer, ""]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="問題セットを一括生成してJSONL/Markdownに保存します")
+    parser.add_argument("--spec", action="append", type=parse_spec, default=[],
+                        help="「出題範囲:難易度:問題数」（複数指定可）")
+    parser.add_argument("--spec-file", help="JSONL形式の指定ファイル")
+    parser.add_argument("--store", help="使用するベクトルストア名（省略時は現在のストア）")
+    parser.add_argument("-o", "--output", required=True, help="出力先（拡張子が.mdならMarkdown、それ以外はJSONL）")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時に実行するLLM呼び出しの上限")
+    parser.add_argument("--similarity", type=float, default=0.85, help="重複とみなす問題文の類似度")
+    parser.add_argument("--model", default="gpt-4o", help="使用するチャットモデル")
+    args = parser.parse_args()
+
+    specs = list(args.spec)
+    if args.spec_file:
+        specs += load_spec_file(args.spec_file)
+    if not specs:
+        parser.error("--spec または --spec-file で生成する問題を指定してください")
+
+    if not os.getenv("OPENAI_API_KEY"):
+        print("エラー: OPENAI_API_KEYが設定されていません。")
+        sys.exit(1)
+
+    # 重いライブラリは引数の検証後に読み込む
+    from langchain_openai import OpenAIEmbeddings, ChatOpenAI
+    from lexical_index import LexicalIndex
+    from llm_client import RateLimitedChatModel, RateLimitedEmbeddings
+    from problem_generator import MathProblemGenerator
+    from vectorstore_manager import VectorStoreManager
+
+    vectorstore_manager = VectorStoreManager("./vector_stores")
+    if args.store:
+        store = vectorstore_manager.get_store_by_name(args.store)
+        if not store:
+            print(f"エラー: '{args.store}'という名前のストアは存在しません")
+            sys.exit(1)
+        db_dir = str(vectorstore_manager.base_dir / store["path"])
+    else:
+        db_dir = vectorstore_manager.get_current_store_path()
+
+    # 429などの一時的なエラーはラッパーが待ってから再試行する
+    llm = RateLimitedChatModel.wrap(ChatOpenAI(model=args.model, temperature=0.2, max_retries=0))
+    generator = MathProblemGenerator(llm, RateLimitedEmbeddings(OpenAIEmbeddings(max_retries=0)), db_dir,
+                                     lexical_index=LexicalIndex(db_dir))
+
+    requested = sum(int(spec.get("count", 1)) for spec in specs)
+    print(f"{requested}問を生成します（同時実行数: {args.concurrency}）...")
+    results = generator.generate_batch(specs, max_concurrency=args.concurrency,
+                                       similarity_threshold=args.similarity)
+
+    if args.output.endswith(".md"):
+        write_markdown(results, args.output)
+    else:
+        write_jsonl(results, args.output)
+
+    print(f"✅ {len(results)}/{requested}問を {args.output} に保存しました。")
+    if len(results) < requested:
+        print("⚠️ 重複または生成エラーのため、一部の問題を生成できませんでした。")
+
+
+if __name__ == "__main__":
+    main()
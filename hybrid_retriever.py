@@ -0,0 +1,85 @@
+import asyncio
+from typing import Any, List
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from federated_retriever import reciprocal_rank_fusion
+from lexical_index import is_lexical_query
+from metrics import metrics
+
+# 検索方法ごとのクエリ数（lexical: 転置インデックスのみ, hybrid: 両方を統合, vector: 埋め込み検索のみ）
+HYBRID_QUERIES = metrics.counter("mathgen_hybrid_queries_total", "ハイブリッド検索の方法ごとのクエリ数", ("mode",))
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    転置インデックス（BM25）と埋め込み検索を組み合わせるリトリーバー
+
+    両方の検索結果をReciprocal Rank Fusion（RRF）で統合する。記法や番号だけからなるクエリ
+    （"$\\nabla \\times$"、"定理 3.2"など）は転置インデックスだけで検索し、埋め込みAPIを呼び出さない。
+    転置インデックスが未作成のストアでは、バックグラウンドで作成している間は埋め込み検索だけを行う。
+    """
+
+    # ベクトルストア（Chroma）
+    vectorstore: Any
+    # ストアの転置インデックス（LexicalIndex）
+    index: Any
+    # 統合後に返す件数
+    k: int = 3
+    # それぞれの検索で取得する件数（Noneの場合はkの3倍）
+    fetch_k: int = None
+    # RRFの定数
+    rrf_k: int = 60
+
+    @property
+    def _fetch_k(self) -> int:
+        return self.fetch_k or self.k * 3
+
+    def _index_ready(self) -> bool:
+        if self.index.ready:
+            return True
+        self.index.build_in_background(self.vectorstore._collection)
+        return False
+
+    def _lexical_search(self, query: str) -> List[Document]:
+        """転置インデックスで検索し、チャンクの本文をChromaから取得する（埋め込みは計算しない）"""
+        if not self._index_ready():
+            return []
+        hits = self.index.search(query, self._fetch_k)
+        if not hits:
+            return []
+        found = self.vectorstore._collection.get(ids=[doc_id for doc_id, _ in hits], include=["documents", "metadatas"])
+        chunks = {doc_id: (text, metadata) for doc_id, text, metadata
+                  in zip(found["ids"], found["documents"], found["metadatas"])}
+        docs = []
+        for doc_id, score in hits:
+            # 削除の反映前などでChromaにないチャンクは除外する
+            if doc_id in chunks:
+                text, metadata = chunks[doc_id]
+                docs.append(Document(page_content=text, metadata={**(metadata or {}), "bm25_score": score}))
+        return docs
+
+    def _combine(self, lexical: List[Document], vector: List[Document]) -> List[Document]:
+        if not lexical:
+            HYBRID_QUERIES.inc(mode="vector")
+            return vector[:self.k]
+        HYBRID_QUERIES.inc(mode="hybrid")
+        return reciprocal_rank_fusion({"lexical": lexical, "vector": vector}, self.k, self.rrf_k)
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        lexical = self._lexical_search(query)
+        if lexical and is_lexical_query(query):
+            HYBRID_QUERIES.inc(mode="lexical")
+            return lexical[:self.k]
+        vector = self.vectorstore.similarity_search(query, k=self._fetch_k)
+        return self._combine(lexical, vector)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        loop = asyncio.get_running_loop()
+        lexical = await loop.run_in_executor(None, self._lexical_search, query)
+        if lexical and is_lexical_query(query):
+            HYBRID_QUERIES.inc(mode="lexical")
+            return lexical[:self.k]
+        vector = await self.vectorstore.asimilarity_search(query, k=self._fetch_k)
+        return self._combine(lexical, vector)
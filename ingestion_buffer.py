@@ -0,0 +1,142 @@
+import time
+
+from metrics import STAGE_SECONDS
+
+
+class IngestionWriteBuffer:
+    """
+    ベクトルストアへの書き込みをまとめて行うバッファ
+
+    追加されたドキュメントを溜めておき、件数またはトークン数の上限に達したら
+    埋め込みAPIをまとめて1回呼び出し、コレクションへ一括でupsertする。
+    転置インデックスを指定した場合は、書き込んだチャンクを同時に登録する。
+    """
+
+    def __init__(self, collection, embedding_model, cache=None, model_name=None,
+                 batch_size: int = 64, max_batch_tokens: int = 100_000, on_flush=None, index=None):
+        """
+        バッファを初期化
+
+        Args:
+            collection: 書き込み先のChromaコレクション
+            embedding_model: 埋め込みモデル
+            cache (IngestionCache): 埋め込みベクトルのキャッシュ
+            model_name (str): キャッシュのキーに使用する埋め込みモデル名
+            batch_size (int): 1回の埋め込みリクエストに含める最大件数
+            max_batch_tokens (int): 1回の埋め込みリクエストに含める最大トークン数（概算）
+            on_flush (function): 書き込み後に呼ばれるコールバック（引数なし）
+            index (LexicalIndex): 書き込んだチャンクを登録する転置インデックス
+        """
+        self.collection = collection
+        self.embedding_model = embedding_model
+        self.cache = cache
+        self.model_name = model_name or getattr(embedding_model, "model", type(embedding_model).__name__)
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.on_flush = on_flush
+        self.index = index
+
+        self._ids = []
+        self._texts = []
+        self._metadatas = []
+        self._pending_tokens = 0
+
+        # スループット計測用
+        self.started_at = time.perf_counter()
+        self.documents_written = 0
+        self.embeddings_computed = 0
+        self._pages_written = set()
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """トークン数を概算する（日本語は1文字1トークン前後のため文字数を上限とみなす）"""
+        return max(1, len(text))
+
+    def __len__(self):
+        return len(self._ids)
+
+    async def add(self, doc_id: str, text: str, metadata: dict) -> bool:
+        """
+        ドキュメントをバッファに追加し、上限に達した場合は書き込む
+
+        Returns:
+            bool: 書き込みが行われた場合True
+        """
+        tokens = self.estimate_tokens(text)
+        # トークン数の上限を超える場合は先に溜まっている分を書き込む
+        flushed = False
+        if self._ids and self._pending_tokens + tokens > self.max_batch_tokens:
+            await self.flush()
+            flushed = True
+
+        self._ids.append(doc_id)
+        self._texts.append(text)
+        self._metadatas.append(metadata)
+        self._pending_tokens += tokens
+
+        if len(self._ids) >= self.batch_size:
+            await self.flush()
+            flushed = True
+        return flushed
+
+    async def flush(self):
+        """
+        溜まっているドキュメントを埋め込み、コレクションへ一括で書き込む
+
+        埋め込みや書き込みに失敗した場合は、ドキュメントをバッファに残したまま例外を送出する
+        （次のflushで再び書き込まれ、それまでdocuments_writtenには数えない）。
+        """
+        if not self._ids:
+            return
+
+        count = len(self._ids)
+        ids, texts, metadatas = self._ids[:count], self._texts[:count], self._metadatas[:count]
+
+        # キャッシュにない埋め込みだけをまとめて計算する
+        embeddings = [self.cache.get_embedding(self.model_name, text) if self.cache else None for text in texts]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            with STAGE_SECONDS.time(stage="embed"):
+                computed = await self.embedding_model.aembed_documents([texts[i] for i in missing])
+            for i, embedding in zip(missing, computed):
+                embeddings[i] = embedding
+                if self.cache:
+                    self.cache.put_embedding(self.model_name, texts[i], embedding)
+            self.embeddings_computed += len(missing)
+
+        with STAGE_SECONDS.time(stage="chroma_write"):
+            self.collection.upsert(ids=ids, embeddings=embeddings, documents=texts, metadatas=metadatas)
+        if self.index is not None:
+            with STAGE_SECONDS.time(stage="lexical_index"):
+                self.index.add(ids, texts, metadatas)
+
+        # 書き込みが完了してからバッファから取り除く
+        del self._ids[:count], self._texts[:count], self._metadatas[:count]
+        self._pending_tokens = sum(self.estimate_tokens(text) for text in self._texts)
+        self.documents_written += len(ids)
+        self._pages_written.update((m.get("source"), m.get("page")) for m in metadatas)
+        if self.on_flush:
+            self.on_flush()
+
+    def throughput(self) -> dict:
+        """
+        書き込みのスループットを返す
+
+        Returns:
+            dict: {"pages_per_sec", "embeddings_per_sec", "pages_written", "embeddings_computed"}
+        """
+        elapsed = max(time.perf_counter() - self.started_at, 1e-9)
+        return {
+            "pages_per_sec": len(self._pages_written) / elapsed,
+            "embeddings_per_sec": self.embeddings_computed / elapsed,
+            "pages_written": len(self._pages_written),
+            "embeddings_computed": self.embeddings_computed,
+        }
+
+    def format_throughput(self) -> str:
+        """進捗表示用のスループット文字列を返す"""
+        stats = self.throughput()
+        return (
+            f"{stats['pages_written']}ページ保存済み"
+            f"（{stats['pages_per_sec']:.2f} ページ/秒, {stats['embeddings_per_sec']:.2f} 埋め込み/秒）"
+        )
@@ -0,0 +1,161 @@
+import os
+import sqlite3
+import threading
+import time
+import hashlib
+from array import array
+
+from metrics import record_cache
+
+
+class IngestionCache:
+    """
+    PDF取り込み結果のコンテンツアドレス型キャッシュ
+
+    ページ内容のハッシュをキーにOCR結果のテキストを、テキストのハッシュをキーに
+    埋め込みベクトルを保存する。全ストアで共有され、合計サイズが上限を超えると
+    最も長く参照されていないエントリから削除する（LRU）。
+    """
+
+    DB_FILE = "ingestion_cache.sqlite3"
+    # 上限を超えたときに、合計サイズがこの割合になるまで削除する（削除の頻度を抑える）
+    EVICT_TO_RATIO = 0.9
+    # 削除するエントリを一度に読み込む件数
+    EVICT_BATCH = 256
+
+    def __init__(self, cache_dir="./vector_stores/_cache", max_bytes=512 * 1024 * 1024, db_file=None,
+                 name="ingestion"):
+        """
+        キャッシュを初期化
+
+        Args:
+            cache_dir (str): キャッシュを保存するディレクトリ
+            max_bytes (int): キャッシュの最大サイズ（バイト）
+            db_file (str): キャッシュのファイル名（省略時はDB_FILE）
+            name (str): メトリクスに記録するキャッシュの名前
+        """
+        self.max_bytes = max_bytes
+        self.name = name
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._conn = sqlite3.connect(
+            os.path.join(cache_dir, db_file or self.DB_FILE), timeout=30, check_same_thread=False
+        )
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_last_access ON entries(last_access)")
+            self._conn.commit()
+            # 合計サイズ（putのたびに集計しないよう、書き込みに合わせて更新する）
+            self._total = self._sum_size()
+
+    @staticmethod
+    def hash_page(page) -> str:
+        """
+        ページのコンテンツストリームと参照する画像・フォントからページのハッシュを計算する
+
+        Args:
+            page (fitz.Page): 対象のページ
+
+        Returns:
+            str: SHA-256の16進文字列
+        """
+        digest = hashlib.sha256()
+        digest.update(f"{tuple(page.rect)}:{page.rotation}".encode())
+        digest.update(page.read_contents())
+        for image in page.get_images(full=True):
+            digest.update(page.parent.xref_stream_raw(image[0]) or b"")
+        for font in page.get_fonts(full=True):
+            digest.update(font[3].encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def hash_text(text: str) -> str:
+        """テキストのSHA-256ハッシュを返す"""
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def _sum_size(self) -> int:
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def _put(self, key, value: bytes):
+        size = len(key) + len(value)
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self._total += size - (old[0] if old else 0)
+            if self._total > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """
+        合計サイズが上限のEVICT_TO_RATIOになるまで、最も古いエントリから削除する（ロック取得済みで呼ぶこと）
+
+        他のプロセスも同じファイルに書き込んでいる場合に備え、削除の前に合計サイズを集計し直す。
+        """
+        self._total = self._sum_size()
+        target = int(self.max_bytes * self.EVICT_TO_RATIO)
+        while self._total > target:
+            rows = self._conn.execute(
+                "SELECT key, size FROM entries ORDER BY last_access LIMIT ?", (self.EVICT_BATCH,)
+            ).fetchall()
+            if not rows:
+                break
+            victims = []
+            for key, size in rows:
+                if self._total <= target:
+                    break
+                victims.append((key,))
+                self._total -= size
+            self._conn.executemany("DELETE FROM entries WHERE key = ?", victims)
+
+    def get_text(self, page_hash: str):
+        """ページハッシュに対応するOCR結果を返す。キャッシュにない場合はNone"""
+        value = self._get(f"text:{page_hash}")
+        record_cache(f"{self.name}_text", value is not None)
+        return value.decode("utf-8") if value is not None else None
+
+    def put_text(self, page_hash: str, text: str):
+        """ページハッシュに対応するOCR結果を保存する"""
+        self._put(f"text:{page_hash}", text.encode("utf-8"))
+
+    def get_embedding(self, model_name: str, text: str):
+        """テキストの埋め込みベクトルを返す。キャッシュにない場合はNone"""
+        value = self._get(f"emb:{model_name}:{self.hash_text(text)}")
+        record_cache(f"{self.name}_embedding", value is not None)
+        if value is None:
+            return None
+        vector = array("f")
+        vector.frombytes(value)
+        return vector.tolist()
+
+    def put_embedding(self, model_name: str, text: str, embedding):
+        """テキストの埋め込みベクトルを保存する"""
+        self._put(f"emb:{model_name}:{self.hash_text(text)}", array("f", embedding).tobytes())
+
+    def size(self) -> int:
+        """キャッシュの合計サイズ（バイト）を返す"""
+        with self._lock:
+            return self._total
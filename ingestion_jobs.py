@@ -0,0 +1,371 @@
+import asyncio
+import contextvars
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+
+class IngestionJobQueue:
+    """
+    PDF取り込みジョブの永続キュー
+
+    ジョブとページごとの完了状況をSQLiteに保存し、ワーカーがチャットのセッションとは
+    独立してPDFProcessorでジョブを処理する。アプリが再起動しても、処理中だったジョブは
+    最後に書き込みが完了したページの次から再開される。
+    """
+
+    DB_FILE = "ingestion_jobs.sqlite3"
+
+    # ジョブの状態
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, processor_factory, jobs_dir="./vector_stores/_jobs", max_workers: int = 2,
+                 on_complete=None, max_attempts: int = 3, retry_delay: float = 60.0, release_processor=None):
+        """
+        キューを初期化
+
+        Args:
+            processor_factory (function): ストアのパスからPDFProcessorを取得する関数
+            jobs_dir (str): ジョブのデータベースと取り込み待ちのPDFを保存するディレクトリ
+            max_workers (int): 同時に処理するジョブ数の上限
+            on_complete (function): ジョブの処理が終わるたびに(ジョブの辞書)を引数に呼ばれる関数
+                                    （一部のページが失敗して再試行待ちになった場合も呼ばれる）
+            max_attempts (int): 失敗したページが残ったジョブを処理する最大回数
+            retry_delay (float): 失敗したページが残ったジョブを再び処理するまでの基準の待ち時間（秒、回数ごとに倍になる）
+            release_processor (function): ジョブの処理が終わったときに、processor_factoryで取得した
+                                          PDFProcessorを引数に呼ばれる関数（共有のプールに返すなど）
+        """
+        self.processor_factory = processor_factory
+        self.jobs_dir = jobs_dir
+        self.files_dir = os.path.join(jobs_dir, "files")
+        self.max_workers = max_workers
+        self.on_complete = on_complete
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.release_processor = release_processor
+
+        self._lock = threading.Lock()
+        # ジョブID -> 進捗を受け取るコールバックのリスト
+        self._listeners = {}
+        # ジョブID -> 処理中のタスク
+        self._running = {}
+        self._workers = []
+        self._wakeup = None
+
+        os.makedirs(self.files_dir, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(jobs_dir, self.DB_FILE), timeout=30, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    store_name TEXT NOT NULL,
+                    store_path TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    pdf_path TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    total_pages INTEGER,
+                    error TEXT,
+                    result TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    not_before REAL NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS job_pages (
+                    job_id TEXT NOT NULL,
+                    page INTEGER NOT NULL,
+                    PRIMARY KEY (job_id, page)
+                )
+                """
+            )
+            # 再試行の列がない古いデータベースに列を追加する
+            columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            if "attempts" not in columns:
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN not_before REAL NOT NULL DEFAULT 0")
+            # 前回の実行中に中断されたジョブは最初からではなく続きから再開する
+            self._conn.execute("UPDATE jobs SET status = ? WHERE status = ?", (self.QUEUED, self.RUNNING))
+            self._conn.commit()
+
+    def _to_dict(self, row) -> dict:
+        job = dict(row)
+        job["completed_pages"] = self._conn.execute(
+            "SELECT COUNT(*) FROM job_pages WHERE job_id = ?", (job["id"],)
+        ).fetchone()[0]
+        return job
+
+    def _set_status(self, job_id, status, **fields):
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE jobs SET status = ?, updated_at = ?{', ' + columns if columns else ''} WHERE id = ?",
+                (status, time.time(), *fields.values(), job_id),
+            )
+            self._conn.commit()
+
+    def start(self):
+        """ワーカーを起動する（実行中のイベントループから呼ぶこと。起動済みの場合は何もしない）"""
+        if any(not worker.done() for worker in self._workers):
+            return
+        self._wakeup = asyncio.Event()
+        # 起動したセッションのコンテキストを引き継がないよう、空のコンテキストでワーカーを動かす
+        self._workers = [
+            contextvars.Context().run(asyncio.ensure_future, self._worker()) for _ in range(self.max_workers)
+        ]
+        self._wakeup.set()
+
+    def submit(self, pdf_path: str, store_name: str, store_path: str, source: str, total_pages: int = None) -> dict:
+        """
+        取り込みジョブを登録する
+
+        アップロードされたファイルはセッション終了時に削除されるため、ジョブ用のディレクトリにコピーする。
+
+        Args:
+            pdf_path (str): 取り込むPDFファイルのパス
+            store_name (str): 取り込み先のストア名
+            store_path (str): 取り込み先のストアのディレクトリ
+            source (str): メタデータに記録するソース名
+            total_pages (int): PDFのページ数
+
+        Returns:
+            dict: 登録したジョブ
+        """
+        job_id = uuid.uuid4().hex[:12]
+        job_pdf_path = os.path.join(self.files_dir, f"{job_id}.pdf")
+        shutil.copyfile(pdf_path, job_pdf_path)
+
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT INTO jobs (id, store_name, store_path, source, pdf_path, status, total_pages, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (job_id, store_name, os.path.abspath(store_path), source, job_pdf_path, self.QUEUED,
+                 total_pages, now, now),
+            )
+            self._conn.commit()
+        if self._wakeup:
+            self._wakeup.set()
+        return self.get(job_id)
+
+    def get(self, job_id: str):
+        """ジョブを取得する。存在しない場合はNone"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            return self._to_dict(row) if row else None
+
+    def list_jobs(self, limit: int = 10) -> list:
+        """新しい順にジョブの一覧を返す"""
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+            return [self._to_dict(row) for row in rows]
+
+    def count_by_status(self) -> dict:
+        """状態ごとのジョブ数を返す"""
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+            return dict(rows)
+
+    async def cancel(self, job_id: str) -> bool:
+        """
+        未完了のジョブを取り消す
+
+        処理中の場合は、ジョブの後処理（バッファに残ったページの書き込みなど）が終わるまで待つ。
+
+        Returns:
+            bool: 取り消した場合True
+        """
+        job = self.get(job_id)
+        if not job or job["status"] not in (self.QUEUED, self.RUNNING):
+            return False
+        self._set_status(job_id, self.CANCELLED)
+        task = self._running.get(job_id)
+        if task:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        else:
+            self._cleanup(job)
+        return True
+
+    async def cancel_store(self, store_path: str) -> int:
+        """
+        ストアの未完了のジョブをすべて取り消し、処理中のジョブが終わるまで待つ（ストア削除時など）
+
+        Returns:
+            int: 取り消した件数
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id FROM jobs WHERE store_path = ? AND status IN (?, ?)",
+                (os.path.abspath(store_path), self.QUEUED, self.RUNNING),
+            ).fetchall()
+        cancelled = await asyncio.gather(*(self.cancel(row["id"]) for row in rows))
+        return sum(cancelled)
+
+    def subscribe(self, job_id: str, callback):
+        """
+        ジョブの進捗を受け取るコールバックを登録する
+
+        Args:
+            callback (function): (ジョブの辞書, 状態のテキスト)を引数に呼ばれる非同期関数。
+                                 登録時のコンテキスト（チャットのセッションなど）で実行され、
+                                 例外が発生した場合（セッションの終了など）は登録を解除する
+        """
+        with self._lock:
+            self._listeners.setdefault(job_id, []).append((callback, contextvars.copy_context()))
+
+    async def _notify(self, job_id: str, status_text=None):
+        listeners = self._listeners.get(job_id)
+        if not listeners:
+            return
+        job = self.get(job_id)
+        for listener in list(listeners):
+            callback, context = listener
+            try:
+                await context.run(asyncio.ensure_future, callback(job, status_text))
+            except Exception:
+                # 通知先のセッションが終了していてもジョブは続行する
+                listeners.remove(listener)
+
+    def _claim(self):
+        """処理できる待機中のジョブを1件取り出して処理中にする。ない場合はNone"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM jobs WHERE status = ? AND not_before <= ? ORDER BY created_at LIMIT 1",
+                (self.QUEUED, time.time()),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?", (self.RUNNING, time.time(), row["id"])
+            )
+            self._conn.commit()
+            return self._to_dict(row)
+
+    def _next_retry_delay(self):
+        """再試行待ちのジョブが処理できるようになるまでの秒数を返す。ない場合はNone"""
+        with self._lock:
+            not_before = self._conn.execute(
+                "SELECT MIN(not_before) FROM jobs WHERE status = ?", (self.QUEUED,)
+            ).fetchone()[0]
+        return None if not_before is None else max(0.0, not_before - time.time())
+
+    async def _worker(self):
+        while True:
+            job = self._claim()
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    # 新しいジョブの登録か、再試行待ちのジョブの待ち時間の経過まで待つ
+                    await asyncio.wait_for(self._wakeup.wait(), self._next_retry_delay())
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = asyncio.create_task(self._run(job))
+            self._running[job["id"]] = task
+            try:
+                await task
+            except asyncio.CancelledError:
+                if not task.cancelled():
+                    raise
+            finally:
+                self._running.pop(job["id"], None)
+
+    def _checkpoint(self, job_id: str, page: int):
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO job_pages (job_id, page) VALUES (?, ?)", (job_id, page))
+            self._conn.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (time.time(), job_id))
+            self._conn.commit()
+
+    def _cleanup(self, job: dict):
+        """取り込み待ちのPDFのコピーを削除する"""
+        try:
+            os.remove(job["pdf_path"])
+        except FileNotFoundError:
+            pass
+
+    async def _run(self, job: dict):
+        job_id = job["id"]
+        with self._lock:
+            done_pages = {
+                row[0] for row in self._conn.execute("SELECT page FROM job_pages WHERE job_id = ?", (job_id,))
+            }
+
+        async def progress_callback(completed_pages, total_pages, status_text=None):
+            if job["total_pages"] != total_pages:
+                job["total_pages"] = total_pages
+                self._set_status(job_id, self.RUNNING, total_pages=total_pages)
+            await self._notify(job_id, status_text)
+
+        processor = None
+        try:
+            processor = self.processor_factory(job["store_path"])
+            result = await processor.process_pdf_with_progress(
+                job["pdf_path"],
+                progress_callback,
+                source_name=job["source"],
+                skip_pages=done_pages,
+                checkpoint_callback=lambda page: self._checkpoint(job_id, page),
+            )
+        except asyncio.CancelledError:
+            # 取り消し以外（アプリの終了など）で中断された場合は、再開できるようにPDFのコピーを残す
+            if self.get(job_id)["status"] == self.CANCELLED:
+                self._cleanup(job)
+                await self._notify(job_id, "ジョブが取り消されました")
+            raise
+        except Exception as e:
+            print(f"取り込みジョブ {job_id} の処理中にエラーが発生しました: {str(e)}")
+            print(traceback.format_exc())
+            # PDFのコピーは残しておき、再登録せずに原因を確認できるようにする
+            self._set_status(job_id, self.FAILED, error=str(e))
+            await self._notify(job_id)
+            return
+        finally:
+            if processor is not None and self.release_processor:
+                self.release_processor(processor)
+
+        failed_pages = result.get("failed_pages") or []
+        attempts = job["attempts"] + 1
+        if not failed_pages:
+            self._set_status(job_id, self.COMPLETED, result=str(result), attempts=attempts, error=None)
+            self._cleanup(job)
+        elif attempts < self.max_attempts:
+            # 失敗したページだけを時間を空けて再び処理する（処理済みのページはチェックポイントで飛ばされる）
+            delay = self.retry_delay * 2 ** (attempts - 1)
+            self._set_status(
+                job_id, self.QUEUED, result=str(result), attempts=attempts, not_before=time.time() + delay,
+                error=f"ページ {', '.join(map(str, failed_pages))} の処理に失敗したため、{delay:.0f}秒後に再試行します",
+            )
+        else:
+            # PDFのコピーは残しておき、原因を確認できるようにする
+            self._set_status(
+                job_id, self.FAILED, result=str(result), attempts=attempts,
+                error=f"ページ {', '.join(map(str, failed_pages))} の処理に{attempts}回失敗しました",
+            )
+
+        finished_job = self.get(job_id)
+        if self.on_complete:
+            try:
+                self.on_complete(finished_job)
+            except Exception as e:
+                print(f"取り込みジョブ {job_id} の完了処理中にエラーが発生しました: {str(e)}")
+        await self._notify(job_id)
+        if finished_job["status"] != self.QUEUED:
+            with self._lock:
+                self._listeners.pop(job_id, None)
@@ -0,0 +1,119 @@
+import re
+
+# 分割してはいけない数式（$$...$$, \[...\], \begin{...}...\end{...}, $...$, \(...\)）
+MATH_PATTERN = re.compile(
+    r"\$\$.+?\$\$"
+    r"|\\\[.+?\\\]"
+    r"|\\begin\{([A-Za-z]+\*?)\}.+?\\end\{\1\}"
+    r"|(?<!\\)\$(?:\\.|[^$\\])+?\$"
+    r"|\\\(.+?\\\)",
+    re.DOTALL,
+)
+# 分割候補の位置（文末記号や改行の直後）
+BREAK_PATTERN = re.compile(r"\n+|[。．！？]|[.!?](?=\s)")
+# 見出しとみなす行（Markdown見出し、第N章/節、\section、番号付き見出し）
+HEADING_PATTERN = re.compile(
+    r"^(?:#{1,6}\s+\S.*"
+    r"|第[0-9０-９一二三四五六七八九十百]+[章節部].*"
+    r"|\\(?:sub)*section\*?\{.+\}.*"
+    r"|(?:\d+\.)+\d*\s+\S.*)$"
+)
+
+
+class LatexAwareChunker:
+    """
+    LaTeXの数式を壊さずにテキストをチャンクに分割するクラス
+
+    数式環境の内部では分割せず、文末や改行の位置でのみ区切る。
+    隣り合うチャンクは指定した文字数だけ重複させ、直近の見出しをメタデータとして付与する。
+    """
+
+    def __init__(self, chunk_size: int = 1000, chunk_overlap: int = 150, max_heading_length: int = 80):
+        """
+        チャンカーを初期化
+
+        Args:
+            chunk_size (int): チャンクの目安の最大文字数（分割できない数式はこれを超えることがある）
+            chunk_overlap (int): 隣り合うチャンクで重複させる文字数
+            max_heading_length (int): 見出しとみなす行の最大文字数
+        """
+        if chunk_overlap >= chunk_size:
+            raise ValueError("chunk_overlapはchunk_sizeより小さくしてください")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.max_heading_length = max_heading_length
+
+    def _split_units(self, text: str):
+        """数式の内部を避けて、文や行の単位に分割する"""
+        math_spans = [m.span() for m in MATH_PATTERN.finditer(text)]
+        units = []
+        start = 0
+        span_index = 0
+        for match in BREAK_PATTERN.finditer(text):
+            pos = match.end()
+            # 分割候補より前に終わる数式を読み飛ばし、数式の内部であれば分割しない
+            while span_index < len(math_spans) and math_spans[span_index][1] <= match.start():
+                span_index += 1
+            if span_index < len(math_spans):
+                span_start, span_end = math_spans[span_index]
+                if span_start <= match.start() < span_end or span_start < pos < span_end:
+                    continue
+            units.append(text[start:pos])
+            start = pos
+        if start < len(text):
+            units.append(text[start:])
+        return [unit for unit in units if unit]
+
+    def _heading_of(self, unit: str):
+        """見出し行であれば見出しテキストを返す"""
+        line = unit.strip()
+        if line and len(line) <= self.max_heading_length and "\n" not in line and HEADING_PATTERN.match(line):
+            return line.lstrip("#").strip()
+        return None
+
+    def split(self, text: str, section: str = ""):
+        """
+        テキストをチャンクに分割する
+
+        Args:
+            text (str): 分割するテキスト
+            section (str): 直前のページから引き継ぐ見出し
+
+        Returns:
+            tuple: (チャンクのリスト [{"text": str, "section": str}], 最後の見出し)
+        """
+        chunks = []
+        current = []
+        current_len = 0
+        # 直前のチャンクから引き継いだ重複部分の長さ
+        overlap_len = 0
+
+        def emit():
+            nonlocal current, current_len, overlap_len
+            body = "".join(current).strip()
+            if body and current_len > overlap_len:
+                chunks.append({"text": body, "section": section})
+            # 末尾の単位を重複部分として次のチャンクに引き継ぐ
+            carried = []
+            carried_len = 0
+            for unit in reversed(current):
+                if carried_len + len(unit) > self.chunk_overlap:
+                    break
+                carried.insert(0, unit)
+                carried_len += len(unit)
+            current, current_len, overlap_len = carried, carried_len, carried_len
+
+        for unit in self._split_units(text):
+            heading = self._heading_of(unit)
+            if heading:
+                # 見出しでチャンクを区切り、重複は見出しをまたいで引き継がない
+                emit()
+                current, current_len, overlap_len = [], 0, 0
+                section = heading
+            elif current_len + len(unit) > self.chunk_size and current_len > overlap_len:
+                emit()
+            current.append(unit)
+            current_len += len(unit)
+
+        emit()
+        return chunks, section
@@ -0,0 +1,394 @@
+import math
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter
+from contextlib import contextmanager
+
+# 数式記号（Unicode）と同じ意味のLaTeXコマンド。テキストレイヤーから抽出したページ（記号）と
+# ビジョンOCRで書き起こしたページ（LaTeX）のどちらも同じトークンで検索できるようにする
+UNICODE_TO_LATEX = {
+    "∇": r"\nabla", "×": r"\times", "∂": r"\partial", "∫": r"\int", "∮": r"\oint", "∑": r"\sum",
+    "∏": r"\prod", "√": r"\sqrt", "∞": r"\infty", "≤": r"\leq", "≥": r"\geq", "≠": r"\neq",
+    "≈": r"\approx", "≡": r"\equiv", "∈": r"\in", "∉": r"\notin", "⊂": r"\subset", "⊆": r"\subseteq",
+    "∪": r"\cup", "∩": r"\cap", "∀": r"\forall", "∃": r"\exists", "∅": r"\emptyset", "→": r"\to",
+    "⇒": r"\Rightarrow", "⇔": r"\Leftrightarrow", "↦": r"\mapsto", "·": r"\cdot", "⋅": r"\cdot",
+    "±": r"\pm", "∘": r"\circ", "⊗": r"\otimes", "⊕": r"\oplus", "⟨": r"\langle", "⟩": r"\rangle",
+    "α": r"\alpha", "β": r"\beta", "γ": r"\gamma", "δ": r"\delta", "ε": r"\epsilon", "ζ": r"\zeta",
+    "η": r"\eta", "θ": r"\theta", "κ": r"\kappa", "λ": r"\lambda", "μ": r"\mu", "ν": r"\nu", "ξ": r"\xi",
+    "π": r"\pi", "ρ": r"\rho", "σ": r"\sigma", "τ": r"\tau", "φ": r"\phi", "ϕ": r"\phi", "χ": r"\chi",
+    "ψ": r"\psi", "ω": r"\omega", "Γ": r"\Gamma", "Δ": r"\Delta", "Θ": r"\Theta", "Λ": r"\Lambda",
+    "Π": r"\Pi", "Σ": r"\Sigma", "Φ": r"\Phi", "Ψ": r"\Psi", "Ω": r"\Omega",
+}
+# 同じ記号を表すLaTeXコマンドの別名
+LATEX_ALIASES = {
+    r"\le": r"\leq", r"\ge": r"\geq", r"\ne": r"\neq", r"\rightarrow": r"\to", r"\varepsilon": r"\epsilon",
+    r"\varphi": r"\phi", r"\implies": r"\Rightarrow", r"\iff": r"\Leftrightarrow",
+}
+
+# LaTeXコマンド、番号（"3.2"など）、英単語、日本語の連続、その他の記号1文字
+TOKEN_PATTERN = re.compile(
+    r"(\\[A-Za-z]+)|(\d+(?:\.\d+)*)|([A-Za-z]+)|([\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff々〆ー]+)|(\S)"
+)
+# テキストレイヤーで1文字ずつ空白が入った番号（"1 2 3 . 1"）をつなげる
+SPACED_NUMBER_PATTERN = re.compile(r"(?<=\d) (?=\d)|(?<=\d) ?\. ?(?=\d)")
+# 記号のうちトークンにするもの（数学演算子・矢印・ギリシャ文字など）
+MATH_SYMBOL_PATTERN = re.compile(r"[\u0370-\u03ff\u2190-\u21ff\u2200-\u22ff\u27c0-\u27ef\u2980-\u2aff]")
+
+# 番号を指し示す語（「定理 3.2」などのクエリでは、番号以外に意味のある語を含まない）
+REFERENCE_WORDS = re.compile(
+    r"定理|命題|補題|系|定義|例題|例|問題|演習|公式|式|章|節|図|表|の|"
+    r"theorem|lemma|proposition|corollary|definition|example|exercise|eq|section|chapter",
+    re.IGNORECASE,
+)
+
+# ストアのパス -> 取り込み中の数（同じストアを開いた別のインスタンスの間で共有する）
+_active_writers = Counter()
+_active_writers_lock = threading.Lock()
+
+
+def is_ingesting(store_path: str) -> bool:
+    """ストアへの取り込み（LexicalIndex.writingのブロック）が実行中かどうか"""
+    with _active_writers_lock:
+        return _active_writers[os.path.realpath(store_path)] > 0
+
+
+def tokenize(text: str) -> list:
+    """
+    テキストを検索用のトークンに分割する
+
+    - LaTeXコマンドは1つのトークンにする（"\\nabla"）。数式記号は対応するLaTeXコマンドに置き換える
+    - 定理番号や式番号はそのまま1つのトークンにする（"3.2"。数字の間の空白は詰める）
+    - 英単語は小文字にする
+    - 日本語は文字のバイグラムにする（1文字だけの場合はその文字）
+    """
+    tokens = []
+    text = SPACED_NUMBER_PATTERN.sub(lambda m: "." if "." in m.group() else "", unicodedata.normalize("NFKC", text))
+    for command, number, word, japanese, symbol in TOKEN_PATTERN.findall(text):
+        if command:
+            tokens.append(LATEX_ALIASES.get(command, command))
+        elif number:
+            tokens.append(number)
+        elif word:
+            tokens.append(word.lower())
+        elif japanese:
+            if len(japanese) == 1:
+                tokens.append(japanese)
+            else:
+                tokens.extend(japanese[i:i + 2] for i in range(len(japanese) - 1))
+        elif symbol in UNICODE_TO_LATEX:
+            tokens.append(UNICODE_TO_LATEX[symbol])
+        elif MATH_SYMBOL_PATTERN.match(symbol):
+            tokens.append(symbol)
+    return tokens
+
+
+def is_lexical_query(query: str) -> bool:
+    """
+    記法や番号だけからなるクエリ（"$\\nabla \\times$"、"定理 3.2"など）かどうかを判定する
+
+    このようなクエリは埋め込み検索では精度が低いため、転置インデックスだけで検索する。
+    """
+    text = unicodedata.normalize("NFKC", query)
+    if not re.search(r"\\[A-Za-z]+|\d", text) and not any(
+            char in UNICODE_TO_LATEX or MATH_SYMBOL_PATTERN.match(char) for char in text):
+        return False
+    rest = re.sub(r"\\[A-Za-z]+", " ", text)
+    rest = REFERENCE_WORDS.sub(" ", rest)
+    rest = re.sub(r"\d+(?:\.\d+)*", " ", rest)
+    # 1文字の英字は変数とみなす
+    rest = re.sub(r"(?<![A-Za-z])[A-Za-z](?![A-Za-z])", " ", rest)
+    rest = re.sub(r"[\W_]", "", rest)
+    return not rest
+
+
+class LexicalIndex:
+    """
+    ストアのチャンクのBM25検索用の転置インデックス
+
+    ストアのディレクトリ内のSQLiteに、チャンクごとのトークン数と、トークンごとの出現チャンクと
+    出現回数を保存する。チャンクの本文は保存せず、検索結果のIDでChromaから取得する。
+    取り込み時にChromaへの書き込みと合わせて更新し、インデックスを作る前に取り込まれたストアは
+    build_in_backgroundでChromaの内容から作成する。作成は同じストアへの取り込みが終わるまで行わず、
+    作成中にインデックスへの書き込みがあった場合は作成済みにしない（次の検索で作り直す）。
+    """
+
+    DB_FILE = "lexical_index.sqlite3"
+
+    def __init__(self, store_path: str, k1: float = 1.2, b: float = 0.75, max_df_ratio: float = 0.5):
+        """
+        Args:
+            store_path (str): ストアのディレクトリ
+            k1 (float): BM25の出現回数の飽和の度合い
+            b (float): BM25の文書長による正規化の度合い
+            max_df_ratio (float): これより多くのチャンクに出現するトークンは、他のトークンがあれば検索に使わない
+        """
+        self.k1 = k1
+        self.b = b
+        self.max_df_ratio = max_df_ratio
+        self._lock = threading.Lock()
+        self._build_thread = None
+        self._store_key = os.path.realpath(store_path)
+
+        os.makedirs(store_path, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(store_path, self.DB_FILE), timeout=30, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS docs (
+                    num INTEGER PRIMARY KEY,
+                    id TEXT UNIQUE NOT NULL,
+                    source TEXT,
+                    length INTEGER NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_docs_source ON docs(source)")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS postings (
+                    term TEXT NOT NULL,
+                    doc INTEGER NOT NULL,
+                    tf INTEGER NOT NULL,
+                    PRIMARY KEY (term, doc)
+                ) WITHOUT ROWID
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_postings_doc ON postings(doc)")
+            # チャンク数と合計トークン数（BM25の平均文書長の計算に使う）
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS stats (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    doc_count INTEGER NOT NULL,
+                    total_length INTEGER NOT NULL
+                )
+                """
+            )
+            self._conn.execute("INSERT OR IGNORE INTO stats (id, doc_count, total_length) VALUES (0, 0, 0)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @property
+    def ready(self) -> bool:
+        """ストアのすべてのチャンクがインデックスに登録済みかどうか"""
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM meta WHERE key = 'built'").fetchone() is not None
+
+    @contextmanager
+    def writing(self):
+        """ストアへの取り込み中であることを示す（この間は同じストアのインデックスの作成を始めない）"""
+        with _active_writers_lock:
+            _active_writers[self._store_key] += 1
+        try:
+            yield
+        finally:
+            with _active_writers_lock:
+                _active_writers[self._store_key] -= 1
+                if not _active_writers[self._store_key]:
+                    del _active_writers[self._store_key]
+
+    def _ingesting(self) -> bool:
+        return is_ingesting(self._store_key)
+
+    def _write_count(self) -> int:
+        """インデックスへの書き込み回数を返す（ロック取得済みで呼ぶこと）"""
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'writes'").fetchone()
+        return int(row[0]) if row else 0
+
+    def _count_write(self):
+        """書き込み回数を増やす（ロック取得済みで呼ぶこと。rebuildが作成中の変更を検出するのに使う）"""
+        self._conn.execute(
+            """
+            INSERT INTO meta (key, value) VALUES ('writes', 1)
+            ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+            """
+        )
+
+    def mark_built(self):
+        """インデックスがストアの内容と一致していることを記録する（空のストアの作成時など）"""
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('built', '1')")
+            self._conn.commit()
+
+    def _delete_nums(self, nums):
+        """チャンクをインデックスから削除する（ロック取得済みで呼ぶこと）"""
+        for num in nums:
+            row = self._conn.execute("SELECT length FROM docs WHERE num = ?", (num,)).fetchone()
+            if row is None:
+                continue
+            self._conn.execute("DELETE FROM postings WHERE doc = ?", (num,))
+            self._conn.execute("DELETE FROM docs WHERE num = ?", (num,))
+            self._conn.execute(
+                "UPDATE stats SET doc_count = doc_count - 1, total_length = total_length - ? WHERE id = 0", (row[0],)
+            )
+
+    def add(self, ids, texts, metadatas=None):
+        """
+        チャンクを登録する（同じIDのチャンクは置き換える）
+
+        Args:
+            ids (list): ChromaのドキュメントID
+            texts (list): チャンクの本文
+            metadatas (list): チャンクのメタデータ（sourceをソースごとの削除に使う）
+        """
+        self._insert(ids, texts, metadatas, count_write=True)
+
+    def _insert(self, ids, texts, metadatas, count_write: bool):
+        metadatas = metadatas or [{}] * len(ids)
+        tokenized = [Counter(tokenize(text)) for text in texts]
+        with self._lock:
+            for doc_id, counts, metadata in zip(ids, tokenized, metadatas):
+                row = self._conn.execute("SELECT num FROM docs WHERE id = ?", (doc_id,)).fetchone()
+                if row:
+                    self._delete_nums([row[0]])
+                length = sum(counts.values())
+                num = self._conn.execute(
+                    "INSERT INTO docs (id, source, length) VALUES (?, ?, ?)",
+                    (doc_id, (metadata or {}).get("source"), length),
+                ).lastrowid
+                self._conn.executemany(
+                    "INSERT INTO postings (term, doc, tf) VALUES (?, ?, ?)",
+                    [(term, num, tf) for term, tf in counts.items()],
+                )
+                self._conn.execute(
+                    "UPDATE stats SET doc_count = doc_count + 1, total_length = total_length + ? WHERE id = 0", (length,)
+                )
+            if count_write:
+                self._count_write()
+            self._conn.commit()
+
+    def delete(self, ids):
+        """チャンクをIDで削除する"""
+        with self._lock:
+            nums = []
+            for doc_id in ids:
+                row = self._conn.execute("SELECT num FROM docs WHERE id = ?", (doc_id,)).fetchone()
+                if row:
+                    nums.append(row[0])
+            self._delete_nums(nums)
+            self._count_write()
+            self._conn.commit()
+
+    def delete_source(self, source: str):
+        """ソースのチャンクをすべて削除する"""
+        with self._lock:
+            nums = [row[0] for row in self._conn.execute("SELECT num FROM docs WHERE source = ?", (source,))]
+            self._delete_nums(nums)
+            self._count_write()
+            self._conn.commit()
+
+    def search(self, query: str, limit: int = 10) -> list:
+        """
+        BM25でチャンクを検索する
+
+        Returns:
+            list: (ChromaのドキュメントID, スコア) のリスト（スコアの高い順）
+        """
+        query_terms = Counter(tokenize(query))
+        if not query_terms:
+            return []
+        with self._lock:
+            doc_count, total_length = self._conn.execute(
+                "SELECT doc_count, total_length FROM stats WHERE id = 0"
+            ).fetchone()
+            if not doc_count:
+                return []
+            terms = list(query_terms)
+            placeholders = ", ".join("?" * len(terms))
+            df = dict(self._conn.execute(
+                f"SELECT term, COUNT(*) FROM postings WHERE term IN ({placeholders}) GROUP BY term", terms
+            ).fetchall())
+
+            # ほとんどのチャンクに出現するトークンは、他のトークンがあれば使わない（スコアへの寄与が小さく、遅い）
+            terms = [term for term in terms if term in df]
+            rare_terms = [term for term in terms if df[term] <= self.max_df_ratio * doc_count]
+            terms = rare_terms or terms
+            if not terms:
+                return []
+
+            weights = []
+            for term in terms:
+                idf = math.log(1 + (doc_count - df[term] + 0.5) / (df[term] + 0.5))
+                weights.extend((term, idf * query_terms[term]))
+            values = ", ".join("(?, ?)" for _ in terms)
+            avg_length = total_length / doc_count
+            rows = self._conn.execute(
+                f"""
+                WITH weights(term, weight) AS (VALUES {values})
+                SELECT d.id, SUM(w.weight * p.tf * (? + 1) / (p.tf + ? * (1 - ? + ? * d.length / ?))) AS score
+                FROM weights w
+                JOIN postings p ON p.term = w.term
+                JOIN docs d ON d.num = p.doc
+                GROUP BY p.doc
+                ORDER BY score DESC
+                LIMIT ?
+                """,
+                (*weights, self.k1, self.k1, self.b, self.b, avg_length, limit),
+            ).fetchall()
+        return [(doc_id, score) for doc_id, score in rows]
+
+    def rebuild(self, collection, batch_size: int = 1000) -> int:
+        """
+        Chromaのコレクションのすべてのチャンクからインデックスを作り直す
+
+        作り直している間に取り込みや削除でインデックスが書き込まれた場合、読み込んだ内容と
+        Chromaが一致している保証がないため、作成済みにしない。
+
+        Returns:
+            int: 登録したチャンク数
+        """
+        with self._lock:
+            writes = self._write_count()
+            self._conn.execute("DELETE FROM postings")
+            self._conn.execute("DELETE FROM docs")
+            self._conn.execute("UPDATE stats SET doc_count = 0, total_length = 0 WHERE id = 0")
+            self._conn.commit()
+
+        indexed = 0
+        offset = 0
+        while True:
+            batch = collection.get(include=["documents", "metadatas"], limit=batch_size, offset=offset)
+            if batch["ids"]:
+                self._insert(batch["ids"], batch["documents"], batch["metadatas"], count_write=False)
+                indexed += len(batch["ids"])
+            if len(batch["ids"]) < batch_size:
+                break
+            offset += batch_size
+
+        with self._lock:
+            if self._write_count() != writes or self._ingesting():
+                print("転置インデックスの作成中にストアが更新されたため、次の検索で作り直します")
+                return indexed
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('built', '1')")
+            self._conn.commit()
+        return indexed
+
+    def build_in_background(self, collection):
+        """
+        インデックスが未作成の場合、バックグラウンドのスレッドでChromaの内容から作成する
+
+        同じストアへの取り込み中は作成しない（取り込みの完了後の検索で作成する）。
+        """
+        if self._ingesting():
+            return
+        with self._lock:
+            if self._build_thread is not None and self._build_thread.is_alive():
+                return
+
+            def run():
+                try:
+                    count = self.rebuild(collection)
+                    print(f"転置インデックスを作成しました（{count}チャンク）")
+                except Exception as e:
+                    print(f"転置インデックスの作成中にエラーが発生しました: {str(e)}")
+
+            self._build_thread = threading.Thread(target=run, name="lexical-index-build", daemon=True)
+            self._build_thread.start()
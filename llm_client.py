@@ -0,0 +1,440 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Any, List, Optional
+
+import openai
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.runnables import RunnableBinding, RunnableSequence
+
+from metrics import IN_FLIGHT, RATE_LIMIT_WAIT_SECONDS, TOKENS
+
+# OpenAIのAPIで一時的なエラーとみなし、待ってから再試行する例外
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+# 画像1枚あたりの入力トークン数の概算（GPT-4oの高詳細モードで縦長の1ページ）
+IMAGE_TOKENS = 1105
+
+
+class TokenBucket:
+    """
+    1分あたりの上限で補充されるトークンバケット
+
+    要求された量をその場で予約し（残量は負になり得る）、不足分が補充されるまでの待ち時間を返す。
+    予約した順に待ち時間が長くなるため、同時に待っている呼び出しの順序が保たれる。
+    """
+
+    def __init__(self, per_minute: float):
+        """
+        Args:
+            per_minute (float): 1分あたりに補充される量（バケットの容量も同じ）
+        """
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, amount: float) -> float:
+        """
+        量を予約し、使用できるまでの待ち時間（秒）を返す
+        """
+        with self._lock:
+            self._refill()
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def adjust(self, amount: float):
+        """予約した量と実際の使用量の差を反映する（正の値で追加消費、負の値で返却）"""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class ModelRateLimiter:
+    """1つのモデルに対する、1分あたりのリクエスト数とトークン数の制限"""
+
+    def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None, name: str = "default"):
+        """
+        Args:
+            requests_per_minute (float): 1分あたりのリクエスト数の上限（Noneの場合は制限しない）
+            tokens_per_minute (float): 1分あたりのトークン数の上限（Noneの場合は制限しない）
+            name (str): メトリクスに記録するモデル名
+        """
+        self.name = name
+        self.configure(requests_per_minute, tokens_per_minute)
+        # 制限のために待った回数と合計秒数
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+
+    def configure(self, requests_per_minute: float = None, tokens_per_minute: float = None):
+        """制限を変更する"""
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def _reserve(self, tokens: int) -> float:
+        wait = 0.0
+        if self.requests:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens:
+            wait = max(wait, self.tokens.reserve(tokens))
+        if wait > 0:
+            self.throttled += 1
+            self.throttled_seconds += wait
+            RATE_LIMIT_WAIT_SECONDS.inc(wait, model=self.name)
+        return wait
+
+    def acquire(self, tokens: int = 0):
+        """1リクエスト分と指定したトークン数を予約し、使用できるまで待つ"""
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, tokens: int = 0):
+        """acquireの非同期版。待っている間もイベントループは止まらない"""
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def record_usage(self, estimated: int, actual: int):
+        """推定したトークン数と実際の使用量の差をトークンバケットに反映する"""
+        if self.tokens and actual is not None:
+            self.tokens.adjust(actual - estimated)
+
+
+class RateLimiterRegistry:
+    """モデル名ごとのレート制限を共有するレジストリ"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._limiters = {}
+
+    def configure(self, model_name: str, requests_per_minute: float = None, tokens_per_minute: float = None):
+        """モデルの制限を設定する（作成済みのラッパーにも反映される）"""
+        self.get(model_name).configure(requests_per_minute, tokens_per_minute)
+
+    def get(self, model_name: str) -> ModelRateLimiter:
+        """モデルの制限を取得する（未設定のモデルは制限しない）"""
+        with self._lock:
+            if model_name not in self._limiters:
+                self._limiters[model_name] = ModelRateLimiter(name=model_name)
+            return self._limiters[model_name]
+
+
+# プロセス内で共有するレジストリ
+rate_limiters = RateLimiterRegistry()
+
+
+class RetryPolicy:
+    """ジッター付き指数バックオフによる再試行の設定"""
+
+    def __init__(self, max_attempts: int = 6, initial_delay: float = 1.0, max_delay: float = 60.0,
+                 retry_on=RETRYABLE_ERRORS):
+        """
+        Args:
+            max_attempts (int): 最初の呼び出しを含む最大試行回数
+            initial_delay (float): 1回目の再試行までの基準の待ち時間（秒）
+            max_delay (float): 待ち時間の上限（秒）
+            retry_on (tuple): 再試行する例外の型
+        """
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.retry_on = retry_on
+
+    def should_retry(self, error: Exception, attempt: int) -> bool:
+        return isinstance(error, self.retry_on) and attempt < self.max_attempts
+
+    def delay(self, attempt: int, error: Exception = None) -> float:
+        """
+        attempt回目の失敗後の待ち時間を返す
+
+        基準の待ち時間を試行ごとに倍にし、0.5〜1.5倍のジッターを掛ける。
+        サーバーがRetry-Afterを返した場合はそれより短くしない。
+        """
+        delay = min(self.max_delay, self.initial_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        try:
+            delay = max(delay, float(retry_after))
+        except (TypeError, ValueError):
+            pass
+        return delay
+
+
+def estimate_message_tokens(messages) -> int:
+    """メッセージの入力トークン数を概算する（日本語は1文字1トークン前後のため文字数を上限とみなす）"""
+    tokens = 0
+    for message in messages:
+        content = message.content if hasattr(message, "content") else message
+        if isinstance(content, str):
+            tokens += len(content)
+        elif isinstance(content, list):
+            for part in content:
+                if isinstance(part, dict) and part.get("type") == "image_url":
+                    tokens += IMAGE_TOKENS
+                elif isinstance(part, dict):
+                    tokens += len(part.get("text", ""))
+                else:
+                    tokens += len(str(part))
+    return max(1, tokens)
+
+
+class RateLimitedChatModel(BaseChatModel):
+    """
+    レート制限と再試行を行うチャットモデルのラッパー
+
+    モデル名ごとのトークンバケットで1分あたりのリクエスト数とトークン数を制限し、
+    429などの一時的なエラーはジッター付き指数バックオフで再試行する。
+    with_structured_outputやbind_toolsで作成したモデルも同じ制限を受ける。
+    """
+
+    model: BaseChatModel
+    limiter: Any
+    retry_policy: Any
+    # 出力トークン数の上限が設定されていないモデルで見込む出力トークン数
+    expected_output_tokens: int = 1000
+
+    @classmethod
+    def wrap(cls, model: BaseChatModel, registry: RateLimiterRegistry = rate_limiters,
+             retry_policy: RetryPolicy = None, **kwargs):
+        """
+        モデル名に対応するレジストリの制限を使うラッパーを作成する
+
+        Args:
+            model (BaseChatModel): ラップするチャットモデル（SDK側の再試行は無効にしておくこと）
+            registry (RateLimiterRegistry): モデルごとの制限を共有するレジストリ
+            retry_policy (RetryPolicy): 再試行の設定
+        """
+        model_name = getattr(model, "model_name", None) or getattr(model, "model", None) or model._llm_type
+        return cls(
+            model=model,
+            limiter=registry.get(model_name),
+            retry_policy=retry_policy or RetryPolicy(),
+            **kwargs,
+        )
+
+    @property
+    def _llm_type(self) -> str:
+        return f"rate-limited-{self.model._llm_type}"
+
+    @property
+    def model_name(self) -> str:
+        return getattr(self.model, "model_name", self._llm_type)
+
+    def _estimate(self, messages) -> int:
+        max_tokens = getattr(self.model, "max_tokens", None)
+        return estimate_message_tokens(messages) + (max_tokens or self.expected_output_tokens)
+
+    @staticmethod
+    def _actual_tokens(result) -> Optional[int]:
+        usage = (result.llm_output or {}).get("token_usage") or {}
+        return usage.get("total_tokens")
+
+    def _record_usage(self, estimated: int, result):
+        """実際の使用量をレート制限に反映し、トークン数をメトリクスに記録する"""
+        self.limiter.record_usage(estimated, self._actual_tokens(result))
+        usage = (result.llm_output or {}).get("token_usage") or {}
+        for kind in ("prompt", "completion"):
+            if usage.get(f"{kind}_tokens"):
+                TOKENS.inc(usage[f"{kind}_tokens"], model=self.limiter.name, kind=kind)
+
+    @staticmethod
+    def _chunk_chars(chunk) -> int:
+        """チャンクの出力の文字数（関数呼び出しの引数を含む）"""
+        chars = len(chunk.text)
+        extra = getattr(chunk.message, "additional_kwargs", {}) or {}
+        chars += len((extra.get("function_call") or {}).get("arguments") or "")
+        for tool_call in extra.get("tool_calls") or []:
+            chars += len((tool_call.get("function") or {}).get("arguments") or "")
+        return chars
+
+    def _record_stream_tokens(self, messages, completion_chars: int):
+        """ストリーミングでは使用量が返らないため、文字数から概算したトークン数を記録する"""
+        TOKENS.inc(estimate_message_tokens(messages), model=self.limiter.name, kind="prompt")
+        TOKENS.inc(completion_chars, model=self.limiter.name, kind="completion")
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        estimated = self._estimate(messages)
+        attempt = 0
+        while True:
+            attempt += 1
+            self.limiter.acquire(estimated)
+            try:
+                with IN_FLIGHT.track_inprogress(operation="llm"):
+                    result = self.model._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+                break
+            except Exception as e:
+                if not self.retry_policy.should_retry(e, attempt):
+                    raise
+                delay = self.retry_policy.delay(attempt, e)
+                print(f"LLMの呼び出しに失敗したため{delay:.1f}秒後に再試行します（{attempt}回目）: {str(e)}")
+                time.sleep(delay)
+        self._record_usage(estimated, result)
+        return result
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        estimated = self._estimate(messages)
+        attempt = 0
+        while True:
+            attempt += 1
+            await self.limiter.aacquire(estimated)
+            try:
+                with IN_FLIGHT.track_inprogress(operation="llm"):
+                    result = await self.model._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+                break
+            except Exception as e:
+                if not self.retry_policy.should_retry(e, attempt):
+                    raise
+                delay = self.retry_policy.delay(attempt, e)
+                print(f"LLMの呼び出しに失敗したため{delay:.1f}秒後に再試行します（{attempt}回目）: {str(e)}")
+                await asyncio.sleep(delay)
+        self._record_usage(estimated, result)
+        return result
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        estimated = self._estimate(messages)
+        attempt = 0
+        while True:
+            attempt += 1
+            self.limiter.acquire(estimated)
+            started = False
+            completion = 0
+            try:
+                with IN_FLIGHT.track_inprogress(operation="llm"):
+                    for chunk in self.model._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                        started = True
+                        completion += self._chunk_chars(chunk)
+                        yield chunk
+                self._record_stream_tokens(messages, completion)
+                return
+            except Exception as e:
+                # 出力を返し始めた後は再試行すると重複するため、そのままエラーにする
+                if started or not self.retry_policy.should_retry(e, attempt):
+                    raise
+                delay = self.retry_policy.delay(attempt, e)
+                print(f"LLMの呼び出しに失敗したため{delay:.1f}秒後に再試行します（{attempt}回目）: {str(e)}")
+                time.sleep(delay)
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        estimated = self._estimate(messages)
+        attempt = 0
+        while True:
+            attempt += 1
+            await self.limiter.aacquire(estimated)
+            started = False
+            completion = 0
+            try:
+                with IN_FLIGHT.track_inprogress(operation="llm"):
+                    async for chunk in self.model._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                        started = True
+                        completion += self._chunk_chars(chunk)
+                        yield chunk
+                self._record_stream_tokens(messages, completion)
+                return
+            except Exception as e:
+                # 出力を返し始めた後は再試行すると重複するため、そのままエラーにする
+                if started or not self.retry_policy.should_retry(e, attempt):
+                    raise
+                delay = self.retry_policy.delay(attempt, e)
+                print(f"LLMの呼び出しに失敗したため{delay:.1f}秒後に再試行します（{attempt}回目）: {str(e)}")
+                await asyncio.sleep(delay)
+
+    def _rebind(self, runnable):
+        """ラップしたモデルに結び付けられたRunnableを、このラッパーに結び付け直す"""
+        if isinstance(runnable, RunnableBinding) and runnable.bound is self.model:
+            return RunnableBinding(bound=self, kwargs=runnable.kwargs, config=runnable.config)
+        if isinstance(runnable, RunnableSequence):
+            return RunnableSequence(*(self._rebind(step) for step in runnable.steps))
+        return runnable
+
+    def bind_tools(self, tools, **kwargs):
+        return self._rebind(self.model.bind_tools(tools, **kwargs))
+
+    def with_structured_output(self, schema, **kwargs):
+        return self._rebind(self.model.with_structured_output(schema, **kwargs))
+
+
+class RateLimitedEmbeddings(Embeddings):
+    """
+    レート制限と再試行を行う埋め込みモデルのラッパー
+
+    RateLimitedChatModelと同じく、モデル名ごとのトークンバケットで制限し、一時的なエラーは再試行する。
+    """
+
+    def __init__(self, embedding_model, registry: RateLimiterRegistry = rate_limiters,
+                 retry_policy: RetryPolicy = None):
+        """
+        Args:
+            embedding_model: ラップする埋め込みモデル（SDK側の再試行は無効にしておくこと）
+            registry (RateLimiterRegistry): モデルごとの制限を共有するレジストリ
+            retry_policy (RetryPolicy): 再試行の設定
+        """
+        self.embedding_model = embedding_model
+        self.limiter = registry.get(self.model)
+        self.retry_policy = retry_policy or RetryPolicy()
+
+    @property
+    def model(self) -> str:
+        """埋め込みキャッシュのキーに使用するモデル名（ラップしたモデルと同じ）"""
+        return getattr(self.embedding_model, "model", type(self.embedding_model).__name__)
+
+    def _call(self, texts, func):
+        tokens = sum(max(1, len(text)) for text in texts)
+        attempt = 0
+        while True:
+            attempt += 1
+            self.limiter.acquire(tokens)
+            try:
+                with IN_FLIGHT.track_inprogress(operation="embedding"):
+                    result = func()
+                TOKENS.inc(tokens, model=self.model, kind="embedding")
+                return result
+            except Exception as e:
+                if not self.retry_policy.should_retry(e, attempt):
+                    raise
+                delay = self.retry_policy.delay(attempt, e)
+                print(f"埋め込みの計算に失敗したため{delay:.1f}秒後に再試行します（{attempt}回目）: {str(e)}")
+                time.sleep(delay)
+
+    async def _acall(self, texts, func):
+        tokens = sum(max(1, len(text)) for text in texts)
+        attempt = 0
+        while True:
+            attempt += 1
+            await self.limiter.aacquire(tokens)
+            try:
+                with IN_FLIGHT.track_inprogress(operation="embedding"):
+                    result = await func()
+                TOKENS.inc(tokens, model=self.model, kind="embedding")
+                return result
+            except Exception as e:
+                if not self.retry_policy.should_retry(e, attempt):
+                    raise
+                delay = self.retry_policy.delay(attempt, e)
+                print(f"埋め込みの計算に失敗したため{delay:.1f}秒後に再試行します（{attempt}回目）: {str(e)}")
+                await asyncio.sleep(delay)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._call(texts, lambda: self.embedding_model.embed_documents(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._call([text], lambda: self.embedding_model.embed_query(text))
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self._acall(texts, lambda: self.embedding_model.aembed_documents(texts))
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self._acall([text], lambda: self.embedding_model.aembed_query(text))
@@ -0,0 +1,346 @@
+import bisect
+import hmac
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# 所要時間のヒストグラムのバケット（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _label_key(label_names, labels: dict) -> tuple:
+    if set(labels) != set(label_names):
+        raise ValueError(f"ラベルが一致しません: {sorted(labels)}（必要なラベル: {list(label_names)}）")
+    return tuple(str(labels[name]) for name in label_names)
+
+
+def _escape(value) -> str:
+    """Prometheusのラベル値として使えるようにエスケープする"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(label_names, key, extra=None) -> str:
+    pairs = list(zip(label_names, key)) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    """単調に増加するカウンター"""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, description: str, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(self.label_names, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self) -> dict:
+        """ラベルの値のタプル -> 値"""
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> list:
+        return [f"{self.name}{_format_labels(self.label_names, key)} {value}" for key, value in self.values().items()]
+
+
+class Gauge(Counter):
+    """増減する値（処理中のリクエスト数など）"""
+
+    type_name = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = _label_key(self.label_names, labels)
+        with self._lock:
+            self._values[key] = value
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        """ブロックの実行中だけ値を1増やす"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram:
+    """
+    値の分布（所要時間など）
+
+    Prometheus形式の累積バケットに加え、/statsでパーセンタイルを表示するために
+    ラベルごとに直近のサンプルを保持する。
+    """
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, description: str, label_names=(), buckets=DEFAULT_BUCKETS,
+                 max_samples: int = 1000):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        # ラベルの値のタプル -> {"buckets": [...], "sum": float, "count": int, "samples": deque}
+        self._series = {}
+
+    def observe(self, value: float, **labels):
+        key = _label_key(self.label_names, labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {
+                    "buckets": [0] * len(self.buckets),
+                    "sum": 0.0,
+                    "count": 0,
+                    "samples": deque(maxlen=self.max_samples),
+                }
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series["buckets"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+            series["samples"].append(value)
+
+    @contextmanager
+    def time(self, **labels):
+        """ブロックの所要時間（秒）を記録する（asyncの処理をawaitするブロックにも使える）"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def summary(self) -> dict:
+        """
+        ラベルごとの集計を返す
+
+        Returns:
+            dict: ラベルの値のタプル -> {"count", "sum", "avg", "p50", "p95"}（パーセンタイルは直近のサンプルから計算）
+        """
+        with self._lock:
+            items = [(key, series["count"], series["sum"], sorted(series["samples"]))
+                     for key, series in self._series.items()]
+        result = {}
+        for key, count, total, samples in items:
+            result[key] = {
+                "count": count,
+                "sum": total,
+                "avg": total / count if count else 0.0,
+                "p50": samples[int(0.50 * (len(samples) - 1))] if samples else 0.0,
+                "p95": samples[int(0.95 * (len(samples) - 1))] if samples else 0.0,
+            }
+        return result
+
+    def render(self) -> list:
+        with self._lock:
+            items = [(key, list(series["buckets"]), series["sum"], series["count"])
+                     for key, series in self._series.items()]
+        lines = []
+        for key, buckets, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, buckets):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, {'le': bound})} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, {'le': '+Inf'})} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    プロセス内のメトリクスを管理するレジストリ
+
+    カウンター・ゲージ・ヒストグラムを名前で登録し、Prometheusのテキスト形式で出力する。
+    キャッシュのサイズなど取得時に計算する値は、コレクター関数で登録する。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = []
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, description: str, label_names=()) -> Counter:
+        return self._register(Counter(name, description, label_names))
+
+    def gauge(self, name: str, description: str, label_names=()) -> Gauge:
+        return self._register(Gauge(name, description, label_names))
+
+    def histogram(self, name: str, description: str, label_names=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, description, label_names, buckets))
+
+    def register_collector(self, collector):
+        """
+        取得時に値を更新する関数を登録する
+
+        Args:
+            collector (function): 引数なしで呼ばれ、ゲージなどに現在の値を設定する関数
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def collect(self):
+        """コレクターを実行して、取得時に計算する値を更新する"""
+        with self._lock:
+            collectors = list(self._collectors)
+        for collector in collectors:
+            try:
+                collector()
+            except Exception as e:
+                print(f"メトリクスの収集中にエラーが発生しました: {str(e)}")
+
+    def get(self, name: str):
+        with self._lock:
+            return self._metrics.get(name)
+
+    def render_prometheus(self) -> str:
+        """すべてのメトリクスをPrometheusのテキスト形式で返す"""
+        self.collect()
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# プロセス内で共有するレジストリ
+metrics = MetricsRegistry()
+
+# 処理段階ごとの所要時間
+# （render, encode, vision, embed, chroma_write, retrieval, generation, explain, chat）
+STAGE_SECONDS = metrics.histogram("mathgen_stage_seconds", "処理段階ごとの所要時間（秒）", ("stage",))
+# チャットコマンドごとのリクエスト数・所要時間・処理中の数
+REQUESTS = metrics.counter("mathgen_requests_total", "コマンドごとのリクエスト数", ("command",))
+REQUEST_SECONDS = metrics.histogram("mathgen_request_seconds", "コマンドごとの応答時間（秒）", ("command",))
+IN_FLIGHT = metrics.gauge("mathgen_in_flight", "処理中のリクエスト・API呼び出しの数", ("operation",))
+# キャッシュのヒット・ミス（resultはhitまたはmiss）
+CACHE_REQUESTS = metrics.counter("mathgen_cache_requests_total", "キャッシュの参照回数", ("cache", "result"))
+# モデルごとのトークン数（kindはprompt, completion, embedding）
+TOKENS = metrics.counter("mathgen_tokens_total", "モデルごとのトークン数", ("model", "kind"))
+# レート制限のために待った秒数
+RATE_LIMIT_WAIT_SECONDS = metrics.counter(
+    "mathgen_rate_limit_wait_seconds_total", "レート制限のために待った合計秒数", ("model",)
+)
+# 抽出方法ごとの取り込んだページ数（extractionはtext, vision, cache, failed）
+PAGES = metrics.counter("mathgen_pages_total", "取り込んだページ数", ("extraction",))
+# ビジョンLLMに送った画像の合計バイト数
+IMAGE_BYTES = metrics.counter("mathgen_image_bytes_total", "ビジョンLLMに送った画像の合計バイト数")
+
+
+def record_cache(cache: str, hit: bool):
+    """キャッシュのヒット・ミスを記録する"""
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+@contextmanager
+def track_request(command: str):
+    """チャットコマンドのリクエスト数・処理中の数・応答時間を記録する"""
+    REQUESTS.inc(command=command)
+    with IN_FLIGHT.track_inprogress(operation=f"command:{command}"), REQUEST_SECONDS.time(command=command):
+        yield
+
+
+def format_stats() -> str:
+    """/statsで表示するMarkdownを作成する"""
+    metrics.collect()
+
+    text = "## 📊 統計情報\n\n### ⏱️ 処理段階ごとの所要時間\n\n"
+    text += "| 段階 | 回数 | 平均 | p50 | p95 |\n|---|---:|---:|---:|---:|\n"
+    for histogram in (STAGE_SECONDS, REQUEST_SECONDS):
+        prefix = "/" if histogram is REQUEST_SECONDS else ""
+        for (name,), stats in sorted(histogram.summary().items()):
+            text += (
+                f"| {prefix}{name} | {stats['count']} | {stats['avg'] * 1000:.0f} ms"
+                f" | {stats['p50'] * 1000:.0f} ms | {stats['p95'] * 1000:.0f} ms |\n"
+            )
+
+    text += "\n### 🗃️ キャッシュのヒット率\n\n"
+    caches = {}
+    for (cache, result), value in CACHE_REQUESTS.values().items():
+        caches.setdefault(cache, {"hit": 0, "miss": 0})[result] += value
+    if caches:
+        for cache, counts in sorted(caches.items()):
+            total = counts["hit"] + counts["miss"]
+            text += f"- **{cache}**: {counts['hit'] / total:.0%}（{counts['hit']}/{total}）\n"
+    else:
+        text += "- まだ参照されていません\n"
+
+    text += "\n### 🔢 トークン数\n\n"
+    tokens = TOKENS.values()
+    if tokens:
+        for (model, kind), value in sorted(tokens.items()):
+            text += f"- {model} ({kind}): {int(value):,}\n"
+    else:
+        text += "- まだ記録されていません\n"
+    waits = RATE_LIMIT_WAIT_SECONDS.values()
+    for (model,), value in sorted(waits.items()):
+        text += f"- {model} のレート制限による待ち時間: {value:.1f}秒\n"
+
+    text += "\n### 🔄 処理中\n\n"
+    in_flight = {key: value for key, value in IN_FLIGHT.values().items() if value}
+    if in_flight:
+        for (operation,), value in sorted(in_flight.items()):
+            text += f"- {operation}: {int(value)}\n"
+    else:
+        text += "- なし\n"
+
+    pages = PAGES.values()
+    if pages:
+        text += "\n### 📄 取り込んだページ\n\n"
+        for (extraction,), value in sorted(pages.items()):
+            text += f"- {extraction}: {int(value)}\n"
+        text += f"- 画像の合計: {sum(IMAGE_BYTES.values().values()) / 1024 / 1024:.1f} MiB\n"
+    return text
+
+
+def mount_prometheus_endpoint(app, token: str, path: str = "/metrics"):
+    """
+    FastAPIのアプリにPrometheus形式のメトリクスを返すエンドポイントを追加する
+
+    Chainlitは全パスをフロントエンドに割り当てるため、ルートの先頭に追加する。
+    メトリクスにはストア名や利用状況が含まれるため、Bearerトークンを持つリクエストにだけ返す。
+
+    Args:
+        app: 追加先のFastAPIのアプリ
+        token (str): Authorizationヘッダーで要求するBearerトークン
+        path (str): エンドポイントのパス
+    """
+    from starlette.responses import PlainTextResponse
+    from starlette.routing import Route
+
+    if not token:
+        raise ValueError("メトリクスのエンドポイントにはトークンが必要です")
+    expected = f"Bearer {token}".encode()
+
+    async def prometheus_metrics(request):
+        authorization = request.headers.get("authorization", "").encode()
+        if not hmac.compare_digest(authorization, expected):
+            return PlainTextResponse("Unauthorized", status_code=401, headers={"WWW-Authenticate": "Bearer"})
+        return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+    app.router.routes.insert(0, Route(path, prometheus_metrics, methods=["GET"]))
@@ -0,0 +1,325 @@
+import asyncio
+import math
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz  # PyMuPDF
+
+# ワーカープロセスごとに開いているPDF（パス, 更新時刻） -> fitz.Document
+_worker_documents = OrderedDict()
+# ワーカープロセスで開いたままにしておくPDFの最大数
+_MAX_WORKER_DOCUMENTS = 2
+
+
+def render_page_image(page, dpi: int, jpeg_quality: int, policy=None) -> bytes:
+    """
+    ページをメモリ上でJPEGにラスタライズする（一時ファイルは使用しない）
+
+    Args:
+        page (fitz.Page): 画像化するページ
+        dpi (int): 解像度（policyを指定した場合は上限）
+        jpeg_quality (int): JPEG品質（policyを指定した場合は上限）
+        policy (AdaptiveRenderPolicy): ページの内容に応じて解像度と切り抜きを決めるポリシー
+
+    Returns:
+        bytes: JPEG画像のバイト列
+    """
+    if policy is not None:
+        return policy.render(page, dpi, jpeg_quality)["image"]
+    zoom = dpi / 72
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+    return pix.tobytes(output="jpeg", jpg_quality=jpeg_quality)
+
+
+class AdaptiveRenderPolicy:
+    """
+    ページの内容の密度に応じて解像度と切り抜き範囲を決めるポリシー
+
+    テキスト・画像・図形の領域から余白を切り抜き、最も小さい文字が読める解像度を選ぶ。
+    内容がまばらなページは解像度を下げ、ビジョンLLMが縮小してしまう大きさ以上の画像や、
+    トークン数・バイト数の上限を超える画像は送らない。
+    """
+
+    def __init__(self, min_dpi: int = 100, min_glyph_px: float = 20, margin_pt: float = 12,
+                 sparse_ratio: float = 0.2, sparse_scale: float = 0.75, max_tokens: int = 1105,
+                 max_bytes: int = 400_000, max_short_side: int = 768, max_long_side: int = 2048,
+                 min_jpeg_quality: int = 60):
+        """
+        Args:
+            min_dpi (int): 解像度の下限
+            min_glyph_px (float): 最も小さい文字の高さとして確保するピクセル数
+            margin_pt (float): 切り抜いた内容の周囲に残す余白（ポイント）
+            sparse_ratio (float): 内容の占める面積の割合がこれ未満のページをまばらとみなす
+            sparse_scale (float): まばらなページの解像度に掛ける倍率
+            max_tokens (int): 1ページの画像トークン数の上限（概算）
+            max_bytes (int): 1ページのJPEGのバイト数の上限
+            max_short_side (int): ビジョンLLMが縮小する短辺のピクセル数（これを超える解像度は送らない）
+            max_long_side (int): ビジョンLLMが縮小する長辺のピクセル数
+            min_jpeg_quality (int): バイト数の上限に収めるために下げるJPEG品質の下限
+        """
+        self.min_dpi = min_dpi
+        self.min_glyph_px = min_glyph_px
+        self.margin_pt = margin_pt
+        self.sparse_ratio = sparse_ratio
+        self.sparse_scale = sparse_scale
+        self.max_tokens = max_tokens
+        self.max_bytes = max_bytes
+        self.max_short_side = max_short_side
+        self.max_long_side = max_long_side
+        self.min_jpeg_quality = min_jpeg_quality
+
+    @staticmethod
+    def estimate_tokens(width: float, height: float) -> int:
+        """
+        画像の入力トークン数を概算する（GPT-4oの高詳細モードの計算方法）
+
+        2048x2048に収まるよう縮小し、さらに短辺が768以下になるよう縮小した後の
+        512ピクセル四方のタイル数から計算する。
+        """
+        scale = min(1.0, 2048 / max(width, height))
+        width, height = width * scale, height * scale
+        scale = min(1.0, 768 / min(width, height))
+        width, height = width * scale, height * scale
+        return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+    def analyze(self, page) -> dict:
+        """
+        ページの内容の領域を調べる
+
+        Returns:
+            dict: {"clip": 内容を囲む範囲, "coverage": 内容の占める面積の割合,
+                   "min_font_size": 最も小さい文字の大きさ（ポイント、文字がない場合はNone）}
+        """
+        rects = []
+        font_sizes = []
+        for block in page.get_text("dict")["blocks"]:
+            rects.append(fitz.Rect(block["bbox"]))
+            for line in block.get("lines", []):
+                for span in line["spans"]:
+                    if span["text"].strip():
+                        font_sizes.append(span["size"])
+        for drawing in page.get_drawings():
+            rects.append(fitz.Rect(drawing["rect"]))
+
+        page_rect = page.rect
+        rects = [rect & page_rect for rect in rects]
+        rects = [rect for rect in rects if not rect.is_empty]
+        if not rects:
+            return {"clip": page_rect, "coverage": 0.0, "min_font_size": None}
+
+        clip = fitz.Rect(rects[0])
+        for rect in rects[1:]:
+            clip |= rect
+        clip = (clip + (-self.margin_pt, -self.margin_pt, self.margin_pt, self.margin_pt)) & page_rect
+        coverage = min(1.0, sum(rect.get_area() for rect in rects) / max(clip.get_area(), 1.0))
+        # 極端に小さい文字（装飾や透かし）に引きずられないよう、下位5%の大きさを使う
+        font_sizes.sort()
+        min_font_size = font_sizes[len(font_sizes) // 20] if font_sizes else None
+        return {"clip": clip, "coverage": coverage, "min_font_size": min_font_size}
+
+    def plan(self, page, max_dpi: int) -> dict:
+        """
+        ページの切り抜き範囲と解像度を決める
+
+        Args:
+            page (fitz.Page): 対象のページ
+            max_dpi (int): 解像度の上限
+
+        Returns:
+            dict: {"clip", "dpi", "coverage", "min_font_size", "tokens"}
+        """
+        info = self.analyze(page)
+        clip = info["clip"]
+
+        # 最も小さい文字が読める解像度（文字がないページはスキャン画像とみなして上限を使う）
+        if info["min_font_size"]:
+            dpi = self.min_glyph_px * 72 / info["min_font_size"]
+        else:
+            dpi = max_dpi
+        # 内容がまばらなページは縮小する
+        if info["coverage"] < self.sparse_ratio:
+            dpi *= self.sparse_scale
+        # ビジョンLLMが縮小してしまう大きさを超える解像度は送らない
+        short_side, long_side = sorted((clip.width, clip.height))
+        if self.max_short_side:
+            dpi = min(dpi, self.max_short_side * 72 / short_side)
+        if self.max_long_side:
+            dpi = min(dpi, self.max_long_side * 72 / long_side)
+        dpi = max(self.min_dpi, min(max_dpi, dpi))
+
+        # トークン数の上限を超える場合は解像度を下げる
+        tokens = self.estimate_tokens(clip.width * dpi / 72, clip.height * dpi / 72)
+        while tokens > self.max_tokens and dpi > self.min_dpi:
+            dpi = max(self.min_dpi, dpi * 0.9)
+            tokens = self.estimate_tokens(clip.width * dpi / 72, clip.height * dpi / 72)
+
+        return {**info, "dpi": dpi, "tokens": tokens}
+
+    def render(self, page, max_dpi: int, jpeg_quality: int) -> dict:
+        """
+        ページを計画に従ってJPEGにラスタライズする
+
+        バイト数の上限を超える場合は、JPEG品質、解像度の順に下げて再エンコードする。
+
+        Returns:
+            dict: planの結果に{"image": JPEGのバイト列, "jpeg_quality": 使用したJPEG品質}を加えたもの
+        """
+        plan = self.plan(page, max_dpi)
+        dpi = plan["dpi"]
+        quality = jpeg_quality
+        while True:
+            zoom = dpi / 72
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=plan["clip"])
+            image = pix.tobytes(output="jpeg", jpg_quality=quality)
+            if len(image) <= self.max_bytes:
+                break
+            if quality > self.min_jpeg_quality:
+                quality = max(self.min_jpeg_quality, quality - 10)
+            elif dpi > self.min_dpi:
+                dpi = max(self.min_dpi, dpi * 0.85)
+            else:
+                break
+        plan["dpi"] = dpi
+        return {**plan, "image": image, "jpeg_quality": quality}
+
+
+def _open_worker_document(pdf_path: str):
+    """ワーカープロセス内でPDFを開く（同じPDFは開いたまま再利用する）"""
+    key = (pdf_path, os.path.getmtime(pdf_path))
+    doc = _worker_documents.pop(key, None)
+    if doc is None:
+        doc = fitz.open(pdf_path)
+    _worker_documents[key] = doc
+    while len(_worker_documents) > _MAX_WORKER_DOCUMENTS:
+        _, old_doc = _worker_documents.popitem(last=False)
+        old_doc.close()
+    return doc
+
+
+def _render_shard(pdf_path: str, page_numbers: list, dpi: int, jpeg_quality: int, policy=None) -> list:
+    """
+    ワーカープロセスで連続したページ範囲をラスタライズする
+
+    Returns:
+        list: [(ページ番号（0始まり）, JPEGのバイト列)]
+    """
+    doc = _open_worker_document(pdf_path)
+    return [(page_num, render_page_image(doc[page_num], dpi, jpeg_quality, policy)) for page_num in page_numbers]
+
+
+class PageRenderer:
+    """
+    ページのラスタライズをプロセスプールで行うレンダラー
+
+    同じイベントループの反復で要求されたページをPDFごとに連続したページ範囲（シャード）に
+    まとめてワーカープロセスに割り振る。各ワーカーは自分でPDFを開き、シャードが完了するたびに
+    画像のバイト列を呼び出し元に返すため、ラスタライズがイベントループを止めず、コア数に応じて並列化される。
+    プロセス内で共有するため、割り振り待ちのページはイベントループごとに分けて保持する
+    （Futureは作成したイベントループでしか完了できない）。
+    """
+
+    def __init__(self, max_workers: int = None, shard_size: int = 4):
+        """
+        Args:
+            max_workers (int): ワーカープロセス数（省略時はCPUコア数）
+            shard_size (int): 1つのワーカーにまとめて割り振る最大ページ数
+        """
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.shard_size = shard_size
+        self._executor = None
+        self._lock = threading.Lock()
+        # イベントループ -> {(PDFのパス, dpi, JPEG品質, ポリシー) -> {ページ番号: Future}}
+        # ループが登録されている間は、そのループで割り振りが予約されている
+        self._pending = {}
+
+    def _get_executor(self):
+        """プロセスプールを遅延生成する（スレッドを持つプロセスをforkしないようspawnで起動する）"""
+        with self._lock:
+            # ワーカーが異常終了して使えなくなったプールは作り直す
+            if self._executor is None or getattr(self._executor, "_broken", False):
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    async def render(self, pdf_path: str, page_num: int, dpi: int, jpeg_quality: int, policy=None) -> bytes:
+        """
+        ページをワーカープロセスでJPEGにラスタライズする
+
+        Args:
+            pdf_path (str): PDFファイルのパス
+            page_num (int): ページ番号（0始まり）
+            dpi (int): 解像度
+            jpeg_quality (int): JPEG品質
+            policy (AdaptiveRenderPolicy): ページの内容に応じて解像度と切り抜きを決めるポリシー
+
+        Returns:
+            bytes: JPEG画像のバイト列
+        """
+        loop = asyncio.get_running_loop()
+        key = (os.path.abspath(pdf_path), dpi, jpeg_quality, policy)
+        with self._lock:
+            schedule = loop not in self._pending
+            pages = self._pending.setdefault(loop, {}).setdefault(key, {})
+            future = pages.get(page_num)
+            if future is None:
+                future = pages[page_num] = loop.create_future()
+        # 同じ反復で要求されたページをまとめて割り振る
+        if schedule:
+            loop.call_soon(self._dispatch, loop)
+        return await future
+
+    def _shards(self, page_numbers: list) -> list:
+        """ページ番号を連続した範囲ごとに分け、ワーカー数に応じた大きさのシャードにする"""
+        size = max(1, min(self.shard_size, math.ceil(len(page_numbers) / self.max_workers)))
+        shards = []
+        for page_num in sorted(page_numbers):
+            if shards and page_num == shards[-1][-1] + 1 and len(shards[-1]) < size:
+                shards[-1].append(page_num)
+            else:
+                shards.append([page_num])
+        return shards
+
+    def _dispatch(self, loop):
+        with self._lock:
+            pending = self._pending.pop(loop, {})
+        executor = self._get_executor()
+        for (pdf_path, dpi, jpeg_quality, policy), pages in pending.items():
+            for shard in self._shards(list(pages)):
+                shard_future = loop.run_in_executor(
+                    executor, _render_shard, pdf_path, shard, dpi, jpeg_quality, policy
+                )
+                shard_future.add_done_callback(
+                    lambda done, futures={page_num: pages[page_num] for page_num in shard}: self._resolve(done, futures)
+                )
+
+    @staticmethod
+    def _resolve(shard_future, futures: dict):
+        """シャードの結果をページごとのFutureに渡す"""
+        if shard_future.cancelled():
+            for future in futures.values():
+                future.cancel()
+            return
+        error = shard_future.exception()
+        results = dict(shard_future.result()) if error is None else {}
+        for page_num, future in futures.items():
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(results[page_num])
+
+    def close(self):
+        """ワーカープロセスを終了する"""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+
+# プロセス内で共有するレンダラー
+page_renderer = PageRenderer()
@@ -1,29 +1,100 @@
-from langchain_chroma import Chroma
-from langchain_community.document_loaders import MathpixPDFLoader
+from langchain_core.messages import HumanMessage
+import fitz  # PyMuPDF
 import os
 import asyncio
+import base64
+import hashlib
+import re
 import traceback
-import uuid
+
+from document_catalog import DocumentCatalog
+from ingestion_cache import IngestionCache
+from ingestion_buffer import IngestionWriteBuffer
+from latex_chunker import LatexAwareChunker
+from lexical_index import LexicalIndex
+from metrics import IMAGE_BYTES, IN_FLIGHT, PAGES, STAGE_SECONDS
+from page_renderer import page_renderer, render_page_image
+from retrieval_cache import store_versions
+from store_registry import store_registry
+
+# 数式用フォントとみなすフォント名のパターン（TeX系、Unicode数式フォントなど）
+MATH_FONT_PATTERN = re.compile(
+    r"CMMI|CMSY|CMEX|CMBSY|MSAM|MSBM|EUFM|EUSM|RSFS|LMMath|Math|STIX|Symbol|MTEX|MTSY|TeXGyre.*Math",
+    re.IGNORECASE,
+)
+# 数式記号とみなす文字（数学演算子、矢印、数学用英数字記号など）と、対応付けできなかったグリフ
+MATH_CHAR_PATTERN = re.compile(r"[\u2190-\u21ff\u2200-\u22ff\u27c0-\u27ef\u2980-\u2aff\U0001d400-\U0001d7ff\ufffd]")
 
 class PDFProcessor:
-    def __init__(self, dir_db: str, embedding_model, llm):
+    # ビジョンLLMに渡すOCR用の指示
+    OCR_PROMPT = (
+        "この画像は数学の資料の1ページです。ページ内の文章と数式をすべて書き起こしてください。"
+        "数式はLaTeX形式で、$や$$を使用して記述してください。"
+    )
+
+    def __init__(self, dir_db: str, embedding_model, llm, max_concurrency: int = 4,
+                 render_dpi: int = 300, jpeg_quality: int = 95, text_fast_path: bool = True,
+                 min_text_chars: int = 100, max_math_ratio: float = 0.05, cache: IngestionCache = None,
+                 embedding_batch_size: int = 64, max_batch_tokens: int = 100_000,
+                 chunk_size: int = 1000, chunk_overlap: int = 150, registry=store_registry,
+                 renderer=page_renderer, render_ahead: int = None, render_policy=None,
+                 page_retry_rounds: int = 2, page_retry_delay: float = 5.0):
         self.llm = llm
         self.embedding_model = embedding_model
         self.dir_db = dir_db
-        
-        # ディレクトリが存在するか確認
-        os.makedirs(dir_db, exist_ok=True)
-        
-        # 更新されたChroma初期化方法
-        self.db = Chroma(
-            embedding_function=self.embedding_model,
-            persist_directory=self.dir_db
-        )
+        # 同時に処理するページ数の上限
+        self.max_concurrency = max_concurrency
+        # ページ画像化の解像度とJPEG品質
+        self.render_dpi = render_dpi
+        self.jpeg_quality = jpeg_quality
+        # ページの内容に応じて解像度と切り抜きを決めるポリシー（AdaptiveRenderPolicy）
+        # 指定した場合、render_dpiとjpeg_qualityは上限として扱われる
+        self.render_policy = render_policy
+        # テキストレイヤーを持つページはビジョンOCRを省略する
+        self.text_fast_path = text_fast_path
+        # これより文字数が少ないページはスキャン画像とみなす
+        self.min_text_chars = min_text_chars
+        # 数式文字の割合がこれを超えるページは数式が多いとみなす
+        self.max_math_ratio = max_math_ratio
+        # OCR結果と埋め込みベクトルのキャッシュ（全ストア共有）
+        self.cache = cache
+        # 埋め込みAPIに1回で送る最大件数と最大トークン数
+        self.embedding_batch_size = embedding_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        # ページのラスタライズを行うプロセスプール（Noneの場合はイベントループのスレッドで行う）
+        self.renderer = renderer
+        # OCRの完了を待たずに先行してラスタライズするページ数の上限（省略時は同時実行数の2倍）
+        self.render_ahead = render_ahead
+        # 処理に失敗したページを再試行する回数と、1回目の再試行までの待ち時間（秒、回数ごとに倍になる）
+        self.page_retry_rounds = page_retry_rounds
+        self.page_retry_delay = page_retry_delay
+        # ページのテキストを数式を壊さずにチャンクへ分割する
+        self.chunker = LatexAwareChunker(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+        # ストアのクライアントはレジストリで共有する
+        self.registry = registry
+        self.db = registry.acquire(self.dir_db, self.embedding_model)
+        # 取り込んだドキュメントの目録（ソースの一覧・削除と、変更されたページだけの置き換えに使う）
+        self.catalog = DocumentCatalog(self.dir_db)
+        # キーワード・記法検索用の転置インデックス（取り込み時にChromaへの書き込みと合わせて更新する）
+        self.lexical_index = LexicalIndex(self.dir_db)
+        if not self.lexical_index.ready and self.get_collection_size() == 0:
+            # 新しいストアはインデックスの作成が不要
+            self.lexical_index.mark_built()
+        self._closed = False
+
+    def close(self):
+        """ストアの参照を解放する"""
+        if not self._closed:
+            self._closed = True
+            self.catalog.close()
+            self.lexical_index.close()
+            self.registry.release(self.dir_db)
 
     def get_collection_size(self):
         """
         ベクトルストアのドキュメント数を取得する
-        
+
         Returns:
             int: ベクトルストアのドキュメント数
         """
@@ -34,159 +105,469 @@ class PDFProcessor:
             print(f"コレクションサイズの取得中にエラーが発生しました: {str(e)}")
             return 0
 
-    def process_pdf(self, pdf_path: str):
-        if not os.path.exists(pdf_path):
-            raise FileNotFoundError(f"PDFファイルが見つかりません: {pdf_path}")
-        
-        loader = MathpixPDFLoader(pdf_path)
-        
-        # PDFを開く
-        docs = loader.load()
-
-        self.db.add_documents(documents=docs, ids=uuids)
-        
-        for page_num in range(len(doc)):
-            # ページを取得
-            page = doc[page_num]
-            
-            # ページを画像として取得
-            pix = page.get_pixmap(matrix=fitz.Matrix(300/72, 300/72))
-            
-            # 画像をJPEGとして保存（一時的に）
-            temp_path = f"temp_page_{page_num}.jpg"
-            pix.save(temp_path)
-            
-            # 画像をbase64エンコード
-            with open(temp_path, "rb") as image_file:
-                encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-            
-            # 一時ファイルを削除
-            os.remove(temp_path)
-            
-            # 画像を処理
-            response = self.process_img(encoded_string)
-            
-            # ベクトルストアに保存
-            self.db.add_texts(
-                texts=[response.content],
-                metadatas=[{"source": pdf_path, "page": page_num + 1}]
+    @property
+    def embedding_model_name(self) -> str:
+        """埋め込みキャッシュのキーに使用するモデル名"""
+        return getattr(self.embedding_model, "model", type(self.embedding_model).__name__)
+
+    def list_documents(self) -> list:
+        """
+        ストアに取り込んだドキュメントの一覧を返す
+
+        Returns:
+            list: {"source", "pages", "chunks", "total_pages", "status", "ingested_at", "updated_at"} のリスト
+        """
+        # 目録を作る前に取り込まれたドキュメントも一覧に含める
+        self.catalog.backfill(self.db._collection)
+        return self.catalog.list_documents()
+
+    def delete_source(self, source: str) -> int:
+        """
+        ソースのチャンクをすべてベクトルストアから削除する
+
+        Args:
+            source (str): 削除するソース名
+
+        Returns:
+            int: 削除したチャンク数
+        """
+        collection = self.db._collection
+        count = len(collection.get(where={"source": source}, include=[])["ids"])
+        if count:
+            collection.delete(where={"source": source})
+            store_versions.bump(self.dir_db)
+        self.lexical_index.delete_source(source)
+        self.catalog.delete_source(source)
+        return count
+
+    def _remove_stale_chunks(self, source: str, written_ids: set, kept_pages: set) -> int:
+        """
+        取り込み直したソースの古いチャンクを削除する
+
+        今回書き込んだチャンクと、kept_pages（変更がなかったページ・処理済みで飛ばしたページ・
+        失敗したページ）の目録に記録されたチャンク以外を削除する。目録にページハッシュがない
+        ページ（目録を作る前に取り込まれたページ）は、ページ番号が一致するチャンクを残す。
+
+        Returns:
+            int: 削除したチャンク数
+        """
+        pages = self.catalog.get_pages(source)
+        kept_ids = set(written_ids)
+        kept_page_numbers = set()
+        for page in kept_pages:
+            record = pages.get(page)
+            if record and record["page_hash"]:
+                kept_ids.update(self.make_document_id(source, page, record["page_hash"], i)
+                                for i in range(record["chunks"]))
+            else:
+                kept_page_numbers.add(page)
+
+        collection = self.db._collection
+        existing = collection.get(where={"source": source}, include=["metadatas"])
+        stale = [doc_id for doc_id, metadata in zip(existing["ids"], existing["metadatas"])
+                 if doc_id not in kept_ids and (metadata or {}).get("page") not in kept_page_numbers]
+        if stale:
+            collection.delete(ids=stale)
+            self.lexical_index.delete(stale)
+            store_versions.bump(self.dir_db)
+        return len(stale)
+
+    @staticmethod
+    def make_document_id(source: str, page: int, page_hash: str, chunk_index: int = 0) -> str:
+        """
+        ソース名・ページ番号・ページハッシュ・チャンク番号から決定的なドキュメントIDを生成する
+
+        白紙のページなど内容が同じページが複数あっても、IDが重複しないようページ番号を含める。
+        """
+        return hashlib.sha256(f"{source}:{page}:{page_hash}:{chunk_index}".encode("utf-8")).hexdigest()
+
+    def classify_page(self, page) -> dict:
+        """
+        ページをテキストレイヤーから抽出できるか、ビジョンOCRが必要かを判定する
+
+        埋め込みテキストが少ないページ（スキャン画像）と、数式フォントや数式記号の
+        割合が高いページ（テキストレイヤーでは数式の構造が失われる）をOCR対象とする。
+
+        Args:
+            page (fitz.Page): 判定するページ
+
+        Returns:
+            dict: {"mode": "text" または "vision", "text": 抽出テキスト, "math_ratio": 数式文字の割合}
+        """
+        text = page.get_text().strip()
+        if not self.text_fast_path:
+            return {"mode": "vision", "text": text, "math_ratio": None}
+
+        total_chars = 0
+        math_chars = 0
+        for block in page.get_text("dict")["blocks"]:
+            for line in block.get("lines", []):
+                for span in line["spans"]:
+                    span_text = "".join(span["text"].split())
+                    total_chars += len(span_text)
+                    if MATH_FONT_PATTERN.search(span["font"]):
+                        math_chars += len(span_text)
+                    else:
+                        math_chars += len(MATH_CHAR_PATTERN.findall(span_text))
+
+        math_ratio = math_chars / total_chars if total_chars else 0.0
+        if total_chars < self.min_text_chars or math_ratio > self.max_math_ratio:
+            mode = "vision"
+        else:
+            mode = "text"
+        return {"mode": mode, "text": text, "math_ratio": math_ratio}
+
+    def render_page(self, page) -> bytes:
+        """
+        ページをメモリ上でJPEGにラスタライズする（一時ファイルは使用しない）
+
+        Args:
+            page (fitz.Page): 画像化するページ
+
+        Returns:
+            bytes: JPEG画像のバイト列
+        """
+        return render_page_image(page, self.render_dpi, self.jpeg_quality, self.render_policy)
+
+    async def arender_page(self, pdf_path: str, page) -> bytes:
+        """render_pageの非同期版。レンダラーのワーカープロセスでラスタライズする"""
+        with STAGE_SECONDS.time(stage="render"):
+            if self.renderer is None:
+                return self.render_page(page)
+            return await self.renderer.render(
+                pdf_path, page.number, self.render_dpi, self.jpeg_quality, self.render_policy
             )
-        
-        # PDFを閉じる
-        doc.close()
-        
-        # ベクトルストアを保存
-        self.db.persist()
-    
-    async def process_pdf_with_progress(self, pdf_path: str, progress_callback=None):
+
+    def encode_page(self, page) -> str:
+        """ページをJPEG化し、ビジョンLLMに渡すbase64文字列を返す"""
+        return base64.b64encode(self.render_page(page)).decode('utf-8')
+
+    def _build_ocr_message(self, encoded_image: str):
+        """base64エンコードされたページ画像からビジョンLLM用のメッセージを作成する"""
+        return [
+            HumanMessage(content=[
+                {"type": "text", "text": self.OCR_PROMPT},
+                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encoded_image}"}},
+            ])
+        ]
+
+    def process_img(self, encoded_image: str):
+        """
+        ページ画像をビジョンLLMで解析してテキスト化する
+
+        Args:
+            encoded_image (str): base64エンコードされたJPEG画像
+
+        Returns:
+            AIMessage: 書き起こし結果
+        """
+        return self.llm.invoke(self._build_ocr_message(encoded_image))
+
+    async def aprocess_img(self, encoded_image: str):
+        """process_imgの非同期版。イベントループをブロックせずにLLMを呼び出す"""
+        return await self.llm.ainvoke(self._build_ocr_message(encoded_image))
+
+    def process_pdf(self, pdf_path: str):
+        """
+        PDFを処理する同期関数（process_pdf_with_progressのラッパー）
+
+        Args:
+            pdf_path (str): 処理するPDFファイルのパス
+        """
+        return asyncio.run(self.process_pdf_with_progress(pdf_path))
+
+    async def process_pdf_with_progress(self, pdf_path: str, progress_callback=None, max_concurrency: int = None,
+                                        source_name: str = None, skip_pages=None, checkpoint_callback=None):
         """
         PDFを処理し、進捗状況をコールバック関数で報告する非同期関数
-        
+
+        最大max_concurrencyページを同時に処理し、結果はページ順にベクトルストアへ保存する。
+        テキストレイヤーで十分なページはビジョンOCRを使わずに埋め込みテキストを使用する。
+        各ページは数式を壊さないようにチャンクへ分割してから保存する。
+        キャッシュ済みのページはOCRと埋め込みを省略する。
+        取り込み済みのソースの場合は、ページハッシュが変わっていないページを飛ばし、
+        完了後に変更されたページ・無くなったページの古いチャンクを削除する。
+        処理に失敗したページは再試行キューに入れ、全ページの処理後に待ち時間を空けて再試行する。
+        再試行しても失敗したページは保存せず、結果のfailed_pagesで返す。
+
         Args:
             pdf_path (str): 処理するPDFファイルのパス
             progress_callback (function): 進捗状況を報告するコールバック関数
-                                         引数: (current_page, total_pages)
+                                         引数: (completed_pages, total_pages[, status_text])
+            max_concurrency (int): 同時に処理するページ数の上限（省略時はインスタンスの設定値）
+            source_name (str): メタデータに記録するソース名（省略時はファイル名）
+            skip_pages (set): 処理済みのため飛ばすページ番号（1始まり）。中断したジョブの再開に使用する
+            checkpoint_callback (function): ページの書き込みがベクトルストアに反映されるたびに
+                                            ページ番号（1始まり）を引数に呼ばれる関数
         """
+        # 取り込みが終わるまで、同じストアの転置インデックスの作成（rebuild）を始めないようにする
+        with self.lexical_index.writing():
+            return await self._process_pdf_with_progress(pdf_path, progress_callback, max_concurrency,
+                                                         source_name, skip_pages, checkpoint_callback)
+
+    async def _process_pdf_with_progress(self, pdf_path, progress_callback, max_concurrency,
+                                         source_name, skip_pages, checkpoint_callback):
+        """process_pdf_with_progressの本体"""
         if not os.path.exists(pdf_path):
             raise FileNotFoundError(f"PDFファイルが見つかりません: {pdf_path}")
-        
+
+        concurrency = max(1, max_concurrency or self.max_concurrency)
+        source = source_name or os.path.basename(pdf_path)
+        skip_pages = set(skip_pages or ())
+
         try:
             # PDFを開く
             doc = fitz.open(pdf_path)
             total_pages = len(doc)
-            
-            # ベクトルストアを定期的に保存するためのカウンター
-            page_count = 0
-            
-            for page_num in range(total_pages):
-                page_count += 1
-                current_page = page_num + 1
-                
-                # 進捗状況を報告
+            # ビジョンOCRを使用したページ数
+            vision_pages = 0
+            # ビジョンLLMに送った画像の合計バイト数
+            image_bytes = 0
+            # キャッシュからOCR結果を取得したページ数
+            cached_pages = 0
+
+            semaphore = asyncio.Semaphore(concurrency)
+            # 先行してラスタライズするページ数の上限（メモリ上に保持する画像の数を抑える）
+            prepare_slots = asyncio.Semaphore(max(concurrency, self.render_ahead or concurrency * 2))
+            # 埋め込みとベクトルストアへの書き込みをまとめて行うバッファ
+            write_buffer = IngestionWriteBuffer(
+                self.db._collection,
+                self.embedding_model,
+                cache=self.cache,
+                model_name=self.embedding_model_name,
+                batch_size=self.embedding_batch_size,
+                max_batch_tokens=self.max_batch_tokens,
+                # 書き込むたびにストアのバージョンを進め、検索キャッシュを無効化する
+                on_flush=lambda: store_versions.bump(self.dir_db),
+                index=self.lexical_index,
+            )
+            # 処理が完了したページ数（再開時は処理済みのページを含む）
+            completed = len([page for page in skip_pages if 1 <= page <= total_pages])
+            # 処理するページ（ページ順）
+            page_order = [page_num for page_num in range(total_pages) if page_num + 1 not in skip_pages]
+            # 前回取り込んだときのページ（変更がなかったページは処理を省略する）
+            previous_pages = self.catalog.get_pages(source)
+            unchanged_pages = set()
+            # バッファに追加したドキュメント数と、書き込みの完了を待っているページ
+            # （ページ番号, 追加済みドキュメント数, ページハッシュ, チャンク数, 次のページに引き継ぐ見出し）
+            documents_added = 0
+            uncommitted_pages = []
+            # 今回書き込んだドキュメントのID
+            written_ids = set()
+
+            def checkpoint():
+                """バッファから書き込み済みになったページを目録に記録して報告する"""
+                while uncommitted_pages and uncommitted_pages[0][1] <= write_buffer.documents_written:
+                    page_number, _, page_hash, chunk_count, section = uncommitted_pages.pop(0)
+                    self.catalog.record_page(source, page_number, page_hash, chunk_count, section)
+                    if checkpoint_callback:
+                        checkpoint_callback(page_number)
+
+            async def report(status_text=None):
                 if progress_callback:
-                    await progress_callback(current_page, total_pages)
-                    await asyncio.sleep(0.1)  # UIの更新を確実にするための短い待機
-                
-                try:
-                    # ページステップの開始を表示
-                    if progress_callback:
-                        await progress_callback(current_page, total_pages, f"ページ {current_page} の画像変換中...")
-                    
-                    # ページを取得
-                    page = doc[page_num]
-                    
-                    # ページを画像として取得
-                    pix = page.get_pixmap(matrix=fitz.Matrix(300/72, 300/72))
-                    
-                    # 画像をJPEGとして保存（一時的に）
-                    temp_path = f"temp_page_{page_num}.jpg"
-                    pix.save(temp_path)
-                    
-                    # 進捗状況の更新
-                    if progress_callback:
-                        await progress_callback(current_page, total_pages, f"ページ {current_page} のエンコード中...")
-                    
-                    # 画像をbase64エンコード
-                    with open(temp_path, "rb") as image_file:
-                        encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-                    
-                    # 一時ファイルを削除
-                    os.remove(temp_path)
-                    
-                    # 進捗状況の更新
-                    if progress_callback:
-                        await progress_callback(current_page, total_pages, f"ページ {current_page} の解析中...")
-                    
-                    # 画像を処理（非同期処理を考慮）
-                    response = self.process_img(encoded_string)
-                    
-                    # 進捗状況の更新
-                    if progress_callback:
-                        await progress_callback(current_page, total_pages, f"ページ {current_page} をベクトルストアに保存中...")
-                    
-                    # ベクトルストアに保存
-                    self.db.add_texts(
-                        texts=[response.content],
-                        metadatas=[{"source": pdf_path, "page": current_page}]
-                    )
-                    
-                    # 5ページごとにベクトルストアを保存する
-                    if page_count % 5 == 0:
-                        self.db.persist()
-                        if progress_callback:
-                            await progress_callback(current_page, total_pages, f"ページ {current_page} まで保存完了。ベクトルストア更新中...")
-                            await asyncio.sleep(0.1)
-                    
-                except Exception as page_error:
-                    # ページ処理中のエラーをキャッチ
-                    error_msg = f"ページ {current_page} の処理中にエラーが発生しましたが、続行します: {str(page_error)}"
-                    print(error_msg)
-                    print(traceback.format_exc())
-                    
-                    if progress_callback:
-                        await progress_callback(current_page, total_pages, error_msg)
-                        await asyncio.sleep(1)  # エラーメッセージを表示するための待機
-                    
-                    # エラーが発生したページの情報を記録
-                    self.db.add_texts(
-                        texts=[f"エラー: このページの処理中に問題が発生しました。{str(page_error)}"],
-                        metadatas=[{"source": pdf_path, "page": current_page, "error": True}]
+                    if status_text:
+                        await progress_callback(completed, total_pages, status_text)
+                    else:
+                        await progress_callback(completed, total_pages)
+
+            async def process_page(page_num):
+                """1ページのテキストを取得する。戻り値: (page_num, テキスト, 抽出方法, ページハッシュ, 例外)"""
+                nonlocal image_bytes
+                current_page = page_num + 1
+                async with prepare_slots:
+                    try:
+                        page = doc[page_num]
+                        page_hash = IngestionCache.hash_page(page)
+
+                        # 前回の取り込みから変更がないページは飛ばす
+                        previous = previous_pages.get(current_page)
+                        if previous and previous["page_hash"] == page_hash:
+                            await report(f"ページ {current_page} は変更がないため省略しました")
+                            return page_num, None, "unchanged", page_hash, None
+
+                        # 処理済みのページはキャッシュの結果を使う
+                        if self.cache:
+                            cached_text = self.cache.get_text(page_hash)
+                            if cached_text is not None:
+                                await report(f"ページ {current_page} はキャッシュ済みです")
+                                return page_num, cached_text, "cache", page_hash, None
+
+                        # テキストレイヤーで十分なページはOCRを省略する
+                        classification = self.classify_page(page)
+                        if classification["mode"] == "text":
+                            await report(f"ページ {current_page} をテキストレイヤーから抽出しました")
+                            if self.cache:
+                                self.cache.put_text(page_hash, classification["text"])
+                            return page_num, classification["text"], "text", page_hash, None
+
+                        await report(f"ページ {current_page} の画像変換中...")
+
+                        # ページをワーカープロセスで画像化してbase64エンコード（OCRの空きを待たずに先行して行う）
+                        image = await self.arender_page(pdf_path, page)
+                        image_bytes += len(image)
+                        IMAGE_BYTES.inc(len(image))
+                        with STAGE_SECONDS.time(stage="encode"):
+                            encoded_string = base64.b64encode(image).decode('utf-8')
+
+                        async with semaphore:
+                            await report(f"ページ {current_page} の解析中...")
+
+                            # 画像を処理（LLM呼び出しの間は他のページの処理が進む）
+                            with IN_FLIGHT.track_inprogress(operation="vision"), STAGE_SECONDS.time(stage="vision"):
+                                response = await self.aprocess_img(encoded_string)
+                        if self.cache:
+                            self.cache.put_text(page_hash, response.content)
+                        return page_num, response.content, "vision", page_hash, None
+                    except Exception as page_error:
+                        return page_num, None, None, None, page_error
+
+            async def write_page(page_num, text, extraction, page_hash, section):
+                """ページをチャンクに分割して書き込みバッファに追加し、次のページに引き継ぐ見出しを返す"""
+                nonlocal documents_added
+                current_page = page_num + 1
+                if extraction == "unchanged":
+                    # 書き込み済みのチャンクをそのまま使い、前回の見出しを次のページに引き継ぐ
+                    previous = previous_pages[current_page]
+                    section = previous["section"] if previous["section"] is not None else section
+                    uncommitted_pages.append((current_page, documents_added, page_hash, previous["chunks"], section))
+                    checkpoint()
+                    return section
+
+                # 上限に達したらまとめて埋め込み・保存される
+                chunks, section = self.chunker.split(text, section)
+                # 書き込みの途中で失敗しても、バッファに残ったチャンクが後で書き込まれたら記録されるよう先に登録する
+                uncommitted_pages.append((current_page, documents_added + len(chunks), page_hash, len(chunks), section))
+                flushed = False
+                for chunk_index, chunk in enumerate(chunks):
+                    documents_added += 1
+                    doc_id = self.make_document_id(source, current_page, page_hash, chunk_index)
+                    written_ids.add(doc_id)
+                    flushed |= await write_buffer.add(
+                        doc_id,
+                        chunk["text"],
+                        {
+                            "source": source,
+                            "page": current_page,
+                            "chunk": chunk_index,
+                            "section": chunk["section"],
+                            "extraction": extraction,
+                        },
                     )
-                
-                # 少し待機して、UIの更新を確実にする
-                await asyncio.sleep(0.2)
-            
-            # PDFを閉じる
-            doc.close()
-            
-            # ベクトルストアを保存
-            self.db.persist()
-            
-            return {"status": "success", "total_pages": total_pages}
-            
+                if flushed:
+                    await report(write_buffer.format_throughput())
+                checkpoint()
+                return section
+
+            def count_extraction(extraction, page_num):
+                nonlocal vision_pages, cached_pages
+                if extraction:
+                    PAGES.inc(extraction=extraction)
+                if extraction == "vision":
+                    vision_pages += 1
+                elif extraction == "cache":
+                    cached_pages += 1
+                elif extraction == "unchanged":
+                    unchanged_pages.add(page_num + 1)
+
+            async def log_page_error(page_num, page_error):
+                error_msg = f"ページ {page_num + 1} の処理中にエラーが発生したため、再試行キューに追加しました: {str(page_error)}"
+                print(error_msg)
+                print("".join(traceback.format_exception(type(page_error), page_error, page_error.__traceback__)))
+                await report(error_msg)
+
+            await report()
+
+            tasks = [asyncio.create_task(process_page(page_num)) for page_num in page_order]
+
+            # 完了したページを一時的に保持し、ページ順に連続した分からベクトルストアに保存する
+            finished = {}
+            next_index = 0
+            # ページをまたいで引き継ぐ直近の見出し
+            current_section = ""
+            # 再試行キュー: 失敗したページ -> (そのページの直前の見出し, 例外)
+            failed_pages = {}
+            # 処理の途中で発生した例外（最後の書き込みの失敗で隠さないようにする）
+            primary_error = None
+
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    page_num, text, extraction, page_hash, page_error = await next_done
+                    finished[page_num] = (text, extraction, page_hash, page_error)
+                    completed += 1
+                    count_extraction(extraction, page_num)
+
+                    while next_index < len(page_order) and page_order[next_index] in finished:
+                        page_num = page_order[next_index]
+                        text, extraction, page_hash, page_error = finished.pop(page_num)
+
+                        if page_error is None:
+                            current_section = await write_page(page_num, text, extraction, page_hash, current_section)
+                        else:
+                            # エラーの内容をドキュメントとして保存せず、後で再試行する
+                            failed_pages[page_num] = (current_section, page_error)
+                            await log_page_error(page_num, page_error)
+
+                        next_index += 1
+
+                    await report()
+
+                # 失敗したページを待ち時間を空けて再試行する（待ち時間は回数ごとに倍になる）
+                for retry_round in range(1, self.page_retry_rounds + 1):
+                    if not failed_pages:
+                        break
+                    await report(f"{len(failed_pages)}ページを再試行します（{retry_round}回目）")
+                    await asyncio.sleep(self.page_retry_delay * 2 ** (retry_round - 1))
+
+                    retry_tasks = [asyncio.create_task(process_page(page_num)) for page_num in sorted(failed_pages)]
+                    tasks.extend(retry_tasks)
+                    for next_done in asyncio.as_completed(retry_tasks):
+                        page_num, text, extraction, page_hash, page_error = await next_done
+                        section, _ = failed_pages[page_num]
+                        if page_error is None:
+                            del failed_pages[page_num]
+                            count_extraction(extraction, page_num)
+                            await write_page(page_num, text, extraction, page_hash, section)
+                        else:
+                            failed_pages[page_num] = (section, page_error)
+                            await log_page_error(page_num, page_error)
+                        await report()
+            except BaseException as error:
+                primary_error = error
+                raise
+            finally:
+                # 途中で中断された場合は残りのページ処理を取り消す
+                for task in tasks:
+                    task.cancel()
+                # PDFを閉じる
+                doc.close()
+                # 完了時もエラー時もバッファに残っているページを書き込む
+                try:
+                    await write_buffer.flush()
+                    checkpoint()
+                except Exception as flush_error:
+                    if primary_error is None:
+                        raise
+                    # 書き込めなかったページは目録に記録されないため、次の取り込みで処理し直される
+                    print(f"中断時のベクトルストアへの書き込みに失敗しました: {str(flush_error)}")
+
+            await report(write_buffer.format_throughput())
+            if failed_pages:
+                PAGES.inc(len(failed_pages), extraction="failed")
+
+            # 変更されたページ・無くなったページの古いチャンクを削除する（失敗したページは古いチャンクを残す）
+            kept_pages = unchanged_pages | skip_pages | {page_num + 1 for page_num in failed_pages}
+            removed_chunks = self._remove_stale_chunks(source, written_ids, kept_pages)
+            self.catalog.finish_source(source, total_pages, "partial" if failed_pages else "complete")
+
+            return {"status": "partial" if failed_pages else "success", "total_pages": total_pages,
+                    "vision_pages": vision_pages, "cached_pages": cached_pages, "image_bytes": image_bytes,
+                    "unchanged_pages": len(unchanged_pages), "removed_chunks": removed_chunks,
+                    "failed_pages": [page_num + 1 for page_num in sorted(failed_pages)],
+                    "throughput": write_buffer.throughput()}
+
         except Exception as e:
             # 全体的なエラー処理
             error_message = f"PDFの処理中に致命的なエラーが発生しました: {str(e)}"
             print(error_message)
             print(traceback.format_exc())
-            raise Exception(error_message)
\ No newline at end of file
+            raise Exception(error_message)
@@ -1,32 +1,61 @@
 from langchain_core.prompts import ChatPromptTemplate
-from langchain.schema.runnable import RunnablePassthrough
+from langchain.schema.runnable import RunnablePassthrough, RunnableLambda
 from langchain_openai import ChatOpenAI
-from langchain_chroma import Chroma
 from operator import itemgetter
-import os
+from difflib import SequenceMatcher
+import asyncio
+import re
 
 from pydantic import BaseModel, Field
 
+from hybrid_retriever import HybridRetriever
+from lexical_index import is_lexical_query
+from metrics import STAGE_SECONDS
+from store_registry import store_registry
+
 class MathProblem(BaseModel):
     """Math problem"""
     question: str = Field(..., description="LaTeX形式の数式を含む数学の問題文。$や$$を使用して数式を記述してください。")
     answer: str = Field(..., description="LaTeX形式の数式を含む解答と解説。$や$$を使用して数式を記述してください。")
 
 
+# ストリーミング用の関数スキーマ。辞書で渡すと部分的なJSONを順次パースできる
+MATH_PROBLEM_FUNCTION = {
+    "name": "MathProblem",
+    "description": MathProblem.__doc__,
+    "parameters": MathProblem.model_json_schema(),
+}
+
+
 class MathProblemGenerator:
-    def __init__(self, llm, embedding_model, dir_db="./chroma_db", k=3):
+    def __init__(self, llm, embedding_model, dir_db="./chroma_db", k=3, retrieval_cache=None,
+                 semantic_cache=None, registry=store_registry, retriever=None, lexical_index=None):
         self.model = llm
+        self.dir_db = dir_db
+        self.k = k
+        # 検索結果のキャッシュ（ストアへの書き込みで自動的に破棄される）
+        self.retrieval_cache = retrieval_cache
+        # 意味的に同じ質問への解説を再利用するキャッシュ（SemanticExplainCache）
+        self.semantic_cache = semantic_cache
+        # ストアの転置インデックス（LexicalIndex）。指定した場合はキーワード・記法検索と埋め込み検索を組み合わせる
+        self.lexical_index = lexical_index
         self.structured_model = self.model.with_structured_output(MathProblem)
+        # 生成途中のフィールドを辞書として順次返すモデル
+        self.streaming_model = self.model.with_structured_output(MATH_PROBLEM_FUNCTION)
 
-        # ディレクトリが存在するか確認
-        os.makedirs(dir_db, exist_ok=True)
-        
-        # 更新されたChroma初期化方法
-        self.db = Chroma(
-            persist_directory=dir_db,
-            embedding_function=embedding_model
-        )
-        self.retriever = self.db.as_retriever(k=k)
+        # ストアのクライアントはレジストリで共有する
+        self.registry = registry
+        self._closed = False
+        if retriever is None:
+            self.db = registry.acquire(dir_db, embedding_model)
+            if lexical_index is not None:
+                self.retriever = HybridRetriever(vectorstore=self.db, index=lexical_index, k=k)
+            else:
+                self.retriever = self.db.as_retriever(search_kwargs={"k": k})
+        else:
+            # 複数ストアの検索（FederatedRetriever）などを使う場合は、ストアの参照はリトリーバーが持つ
+            self.db = None
+            self.retriever = retriever
         
         self.generate_prompt = ChatPromptTemplate.from_messages([
             ("system", """
@@ -72,24 +101,270 @@ class MathProblemGenerator:
             """),
         ])
         
-        self.generate_chain = (
-            RunnablePassthrough.assign(
-                source=lambda x: self.retriever.invoke(x["topic"])
+        # 参考文書の検索（ainvoke経由の呼び出しでは検索も非同期で行う）
+        self.generate_inputs = RunnablePassthrough.assign(
+            source=RunnableLambda(
+                lambda x: self.retrieve(x["topic"]),
+                afunc=lambda x: self.aretrieve(x["topic"]),
             )
+        )
+        self.explain_inputs = RunnablePassthrough.assign(
+            source=RunnableLambda(
+                lambda x: self.retrieve(x["question"]),
+                afunc=lambda x: self.aretrieve(x["question"]),
+            )
+        )
+
+        self.generate_chain = (
+            self.generate_inputs
             | self.generate_prompt
             | self.structured_model
         )
 
         self.explain_chain = (
-            RunnablePassthrough.assign(
-                source=lambda x: self.retriever.invoke(x["question"])
-            )
+            self.explain_inputs
             | self.explain_prompt
             | self.structured_model
         )
 
+        # 同じ条件で複数の問題を生成する場合は、互いに異なる問題になるよう指示を追加する
+        self.batch_prompt = self.generate_prompt + ChatPromptTemplate.from_messages([
+            ("human", "同じ条件で{count}問の問題セットを作成しています。これは{index}問目です。"
+                      "他の問題と題材や解法が重複しない問題にしてください。"),
+        ])
+        self.batch_chain = self.batch_prompt | self.structured_model
+
+        self.generate_stream_chain = (
+            self.generate_inputs
+            | self.generate_prompt
+            | self.streaming_model
+        )
+
+        self.explain_stream_chain = (
+            self.explain_inputs
+            | self.explain_prompt
+            | self.streaming_model
+        )
+
+    def close(self):
+        """ストアとキャッシュの参照を解放する"""
+        if not self._closed:
+            self._closed = True
+            if self.db is not None:
+                self.registry.release(self.dir_db)
+            elif hasattr(self.retriever, "close"):
+                self.retriever.close()
+            if self.lexical_index is not None:
+                self.lexical_index.close()
+            if self.semantic_cache:
+                self.semantic_cache.close()
+
+    @staticmethod
+    def format_docs(docs) -> str:
+        """検索したチャンクを出典と見出し付きのテキストにまとめる"""
+        blocks = []
+        for doc in docs:
+            metadata = doc.metadata
+            header = f"[{metadata.get('source', '')} p.{metadata.get('page', '?')}]"
+            if metadata.get("store"):
+                # 複数のストアから検索した場合は取得元のストアを示す
+                header = f"[{metadata['store']}] {header}"
+            if metadata.get("section"):
+                header += f" {metadata['section']}"
+            blocks.append(f"{header}\n{doc.page_content}")
+        return "\n\n".join(blocks)
+
+    def _use_semantic_cache(self, question: str) -> bool:
+        """
+        意味的キャッシュを使うかどうか
+
+        記法や番号だけの質問は、転置インデックスだけで検索して埋め込みを計算しないため、
+        質問の埋め込みが必要な意味的キャッシュも使わない。
+        """
+        return bool(self.semantic_cache) and not (self.lexical_index is not None and is_lexical_query(question))
+
+    def retrieve(self, query: str) -> str:
+        """クエリに関連するチャンクを検索し、プロンプト用のテキストにまとめる"""
+        docs = self.retrieval_cache.get(self.dir_db, query, self.k) if self.retrieval_cache else None
+        if docs is None:
+            with STAGE_SECONDS.time(stage="retrieval"):
+                docs = self.retriever.invoke(query)
+            if self.retrieval_cache:
+                self.retrieval_cache.put(self.dir_db, query, self.k, docs)
+        return self.format_docs(docs)
+
+    async def aretrieve(self, query: str) -> str:
+        """retrieveの非同期版"""
+        docs = self.retrieval_cache.get(self.dir_db, query, self.k) if self.retrieval_cache else None
+        if docs is None:
+            with STAGE_SECONDS.time(stage="retrieval"):
+                docs = await self.retriever.ainvoke(query)
+            if self.retrieval_cache:
+                self.retrieval_cache.put(self.dir_db, query, self.k, docs)
+        return self.format_docs(docs)
+
     def generate_problem(self, topic: str, difficulty: str) -> MathProblem:
-        return self.generate_chain.invoke({"topic": topic, "difficulty": difficulty})
+        with STAGE_SECONDS.time(stage="generation"):
+            return self.generate_chain.invoke({"topic": topic, "difficulty": difficulty})
     
     def explain_problem(self, question: str) -> MathProblem:
-        return self.explain_chain.invoke({"question": question})
\ No newline at end of file
+        if self._use_semantic_cache(question):
+            cached = self.semantic_cache.lookup(question)
+            if cached:
+                return MathProblem(**cached)
+        with STAGE_SECONDS.time(stage="explain"):
+            result = self.explain_chain.invoke({"question": question})
+        if self._use_semantic_cache(question):
+            self.semantic_cache.store(question, result.model_dump())
+        return result
+
+    async def agenerate_problem(self, topic: str, difficulty: str) -> MathProblem:
+        """generate_problemの非同期版。イベントループをブロックせずに問題を生成する"""
+        with STAGE_SECONDS.time(stage="generation"):
+            return await self.generate_chain.ainvoke({"topic": topic, "difficulty": difficulty})
+
+    async def aexplain_problem(self, question: str) -> MathProblem:
+        """explain_problemの非同期版。イベントループをブロックせずに解説を生成する"""
+        if self._use_semantic_cache(question):
+            cached = await self.semantic_cache.alookup(question)
+            if cached:
+                return MathProblem(**cached)
+        with STAGE_SECONDS.time(stage="explain"):
+            result = await self.explain_chain.ainvoke({"question": question})
+        if self._use_semantic_cache(question):
+            await self.semantic_cache.astore(question, result.model_dump())
+        return result
+
+    async def astream_problem(self, topic: str, difficulty: str):
+        """
+        問題を生成しながら、生成済みのフィールドを含む辞書を順次返す
+
+        questionフィールドが先に生成されるため、辞書に"answer"が現れた時点で問題文は確定している。
+
+        Yields:
+            dict: {"question": 途中までの問題文, "answer": 途中までの解答}
+        """
+        with STAGE_SECONDS.time(stage="generation"):
+            async for partial in self.generate_stream_chain.astream({"topic": topic, "difficulty": difficulty}):
+                yield partial
+
+    async def astream_explanation(self, question: str):
+        """
+        解説を生成しながら、生成済みのフィールドを含む辞書を順次返す
+
+        キャッシュに類似した質問があれば、その解説を1回だけ返す。
+
+        Yields:
+            dict: {"question": 途中までの質問の整理, "answer": 途中までの解説}
+        """
+        if self._use_semantic_cache(question):
+            cached = await self.semantic_cache.alookup(question)
+            if cached:
+                yield cached
+                return
+        partial = {}
+        with STAGE_SECONDS.time(stage="explain"):
+            async for partial in self.explain_stream_chain.astream({"question": question}):
+                yield partial
+        if self._use_semantic_cache(question) and partial.get("question") and partial.get("answer"):
+            await self.semantic_cache.astore(question, partial)
+
+    @staticmethod
+    def _normalize_specs(specs):
+        """(topic, difficulty, count)のタプルまたは辞書のリストを辞書のリストにそろえる"""
+        normalized = []
+        for spec in specs:
+            if isinstance(spec, dict):
+                topic, difficulty, count = spec["topic"], spec["difficulty"], spec.get("count", 1)
+            else:
+                topic, difficulty, count = spec
+            normalized.append({"topic": topic, "difficulty": difficulty, "count": int(count)})
+        return normalized
+
+    @staticmethod
+    def is_similar(question_a: str, question_b: str, threshold: float) -> bool:
+        """空白を除いた問題文の類似度がthreshold以上であればTrue"""
+        a = re.sub(r"\s+", "", question_a)
+        b = re.sub(r"\s+", "", question_b)
+        return SequenceMatcher(None, a, b).ratio() >= threshold
+
+    def _build_batch_inputs(self, specs, sources):
+        inputs = []
+        for spec in specs:
+            for index in range(spec["count"]):
+                inputs.append({
+                    "topic": spec["topic"],
+                    "difficulty": spec["difficulty"],
+                    "source": sources[spec["topic"]],
+                    "count": spec["count"],
+                    "index": index + 1,
+                })
+        return inputs
+
+    def _collect_batch_results(self, inputs, outputs, accepted, similarity_threshold):
+        """
+        生成結果から失敗したものと、既存の問題とほぼ同じ問題を除いて追加する
+
+        Returns:
+            list: 作り直しが必要な入力
+        """
+        retry = []
+        for batch_input, output in zip(inputs, outputs):
+            if isinstance(output, Exception):
+                print(f"問題の生成中にエラーが発生しました（{batch_input['topic']} {batch_input['difficulty']}）: {str(output)}")
+                retry.append(batch_input)
+                continue
+            if any(self.is_similar(output.question, item["problem"].question, similarity_threshold) for item in accepted):
+                retry.append(batch_input)
+                continue
+            accepted.append({"topic": batch_input["topic"], "difficulty": batch_input["difficulty"], "problem": output})
+        return retry
+
+    def generate_batch(self, specs, max_concurrency: int = 4, similarity_threshold: float = 0.85,
+                       max_rounds: int = 2):
+        """
+        複数の条件で問題セットをまとめて生成する
+
+        同じ出題範囲の検索結果は共有し、LLMの呼び出しはmax_concurrencyまで並列に行う。
+        ほぼ同じ問題は除外し、除外・失敗した分はmax_roundsまで作り直す。
+
+        Args:
+            specs (list): (出題範囲, 難易度, 問題数)のタプル、または同じキーを持つ辞書のリスト
+            max_concurrency (int): 同時に実行するLLM呼び出しの上限
+            similarity_threshold (float): 問題文の類似度がこれ以上の場合は重複とみなす
+            max_rounds (int): 生成を繰り返す最大回数
+
+        Returns:
+            list: [{"topic": str, "difficulty": str, "problem": MathProblem}]
+        """
+        specs = self._normalize_specs(specs)
+        sources = {topic: self.retrieve(topic) for topic in {spec["topic"] for spec in specs}}
+
+        accepted = []
+        inputs = self._build_batch_inputs(specs, sources)
+        for _ in range(max_rounds):
+            if not inputs:
+                break
+            outputs = self.batch_chain.batch(
+                inputs, config={"max_concurrency": max_concurrency}, return_exceptions=True
+            )
+            inputs = self._collect_batch_results(inputs, outputs, accepted, similarity_threshold)
+        return accepted
+
+    async def agenerate_batch(self, specs, max_concurrency: int = 4, similarity_threshold: float = 0.85,
+                              max_rounds: int = 2):
+        """generate_batchの非同期版"""
+        specs = self._normalize_specs(specs)
+        topics = sorted({spec["topic"] for spec in specs})
+        sources = dict(zip(topics, await asyncio.gather(*(self.aretrieve(topic) for topic in topics))))
+
+        accepted = []
+        inputs = self._build_batch_inputs(specs, sources)
+        for _ in range(max_rounds):
+            if not inputs:
+                break
+            outputs = await self.batch_chain.abatch(
+                inputs, config={"max_concurrency": max_concurrency}, return_exceptions=True
+            )
+            inputs = self._collect_batch_results(inputs, outputs, accepted, similarity_threshold)
+        return accepted
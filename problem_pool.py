@@ -0,0 +1,259 @@
+import asyncio
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+import traceback
+
+from metrics import record_cache
+from problem_generator import MathProblem
+
+
+class ProblemPool:
+    """
+    生成済み問題のプール
+
+    (ストア, 出題範囲, 難易度)ごとに生成済みの問題を数問ずつ保持し、/generateで即座に返す。
+    取り出した分はバックグラウンドで補充する。内容はディスクに保存され、再起動後も利用できる。
+    1度しか要求されない組み合わせのために問題を生成しないよう、要求回数がmin_requests以上の
+    組み合わせと、warmで選んだよく要求される組み合わせだけを補充する。
+    ストアは絶対パスにそろえて扱うため、相対パスと絶対パスのどちらで指定してもよい。
+    """
+
+    POOL_FILE = "problem_pool.json"
+
+    def __init__(self, base_dir="./vector_stores", size_per_key: int = 2, max_keys: int = 50,
+                 ttl_seconds: float = 24 * 60 * 60, max_background: int = 2, save_delay: float = 5.0,
+                 min_requests: int = 2, refill_size: int = 1):
+        """
+        プールを初期化
+
+        Args:
+            base_dir (str): プールのファイルを保存するディレクトリ
+            size_per_key (int): 組み合わせごとに保持する問題数
+            max_keys (int): 保持する組み合わせの最大数（超えた分は最も古く要求されたものから削除）
+            ttl_seconds (float): 問題の有効期限（秒）
+            max_background (int): 同時に実行する補充処理の最大数
+            save_delay (float): 取り出しによる変更をまとめてファイルに保存するまでの秒数
+            min_requests (int): 補充の対象とする組み合わせの要求回数（プールに問題がなかった場合も含む）の下限
+            refill_size (int): 1回の補充で生成する問題数の上限
+        """
+        self.path = os.path.join(base_dir, self.POOL_FILE)
+        self.size_per_key = size_per_key
+        self.max_keys = max_keys
+        self.ttl_seconds = ttl_seconds
+        self.max_background = max_background
+        self.save_delay = save_delay
+        self.min_requests = min_requests
+        self.refill_size = refill_size
+
+        self._lock = threading.Lock()
+        # 補充中の組み合わせと、実行中のタスク（GCされないよう参照を保持する）
+        self._refilling = set()
+        self._tasks = set()
+        self._semaphore = None
+        # 予約中の保存（取り出しのたびに書き込まないよう、一定時間内の変更をまとめて保存する）
+        self._save_timer = None
+
+        os.makedirs(base_dir, exist_ok=True)
+        self._data = self._load()
+        atexit.register(self.flush)
+
+    def _load(self):
+        """プールをファイルから読み込み、期限切れの問題を取り除く"""
+        data = {"entries": {}, "generations": {}}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except Exception as e:
+                print(f"問題プールの読み込み中にエラーが発生しました: {str(e)}")
+        for entry in data["entries"].values():
+            entry["problems"] = [p for p in entry["problems"] if not self._expired(p)]
+        # 相対パスで保存された以前のプールのストアを絶対パスにそろえる
+        data["entries"] = {self._key(*json.loads(key)): entry for key, entry in data["entries"].items()}
+        data["generations"] = {self._normalize(store): generation
+                               for store, generation in data["generations"].items()}
+        return data
+
+    def _save(self):
+        """一時ファイルに書き込んでからリネームし、プールのファイルを置き換える（ロック取得済みで呼ぶこと）"""
+        if self._save_timer is not None:
+            self._save_timer.cancel()
+            self._save_timer = None
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".problem_pool.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(self._data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _schedule_save(self):
+        """save_delay秒後の保存を予約する。予約済みの場合は何もしない（ロック取得済みで呼ぶこと）"""
+        if self._save_timer is None:
+            self._save_timer = threading.Timer(self.save_delay, self.flush)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def flush(self):
+        """予約中の保存があればすぐに行う"""
+        with self._lock:
+            if self._save_timer is None:
+                return
+            try:
+                self._save()
+            except Exception as e:
+                print(f"問題プールの保存中にエラーが発生しました: {str(e)}")
+
+    def _expired(self, problem) -> bool:
+        return time.time() - problem["created_at"] > self.ttl_seconds
+
+    @staticmethod
+    def _normalize(store: str) -> str:
+        return os.path.abspath(store)
+
+    @classmethod
+    def _key(cls, store: str, topic: str, difficulty: str) -> str:
+        return json.dumps([cls._normalize(store), topic, difficulty], ensure_ascii=False)
+
+    def _generation(self, store: str) -> int:
+        return self._data["generations"].get(self._normalize(store), 0)
+
+    def pop(self, store: str, topic: str, difficulty: str):
+        """
+        プールから問題を1問取り出す（要求として記録される）
+
+        Returns:
+            MathProblem: 生成済みの問題。プールが空の場合はNone
+        """
+        store = self._normalize(store)
+        key = self._key(store, topic, difficulty)
+        with self._lock:
+            entry = self._data["entries"].setdefault(key, {"problems": [], "requests": 0})
+            entry["requests"] += 1
+            entry["last_requested"] = time.time()
+
+            problem = None
+            while entry["problems"]:
+                candidate = entry["problems"].pop(0)
+                if not self._expired(candidate) and candidate["generation"] == self._generation(store):
+                    problem = MathProblem(question=candidate["question"], answer=candidate["answer"])
+                    break
+
+            self._evict_keys()
+            self._schedule_save()
+        record_cache("problem_pool", problem is not None)
+        return problem
+
+    def _evict_keys(self):
+        """組み合わせ数が上限を超えたら、最も古く要求されたものから削除する（ロック取得済みで呼ぶこと）"""
+        entries = self._data["entries"]
+        if len(entries) <= self.max_keys:
+            return
+        oldest = sorted(entries, key=lambda k: entries[k].get("last_requested", 0))
+        for key in oldest[:len(entries) - self.max_keys]:
+            del entries[key]
+
+    def _add(self, store, topic, difficulty, problem: MathProblem, generation: int) -> bool:
+        """生成した問題をプールに追加する。生成中にストアが更新されていた場合は破棄する"""
+        key = self._key(store, topic, difficulty)
+        with self._lock:
+            entry = self._data["entries"].get(key)
+            if entry is None or generation != self._generation(store):
+                return False
+            entry["problems"].append({
+                "question": problem.question,
+                "answer": problem.answer,
+                "created_at": time.time(),
+                "generation": generation,
+            })
+            self._schedule_save()
+            return True
+
+    def _missing(self, key) -> int:
+        entry = self._data["entries"].get(key)
+        if entry is None:
+            return 0
+        return max(0, self.size_per_key - len(entry["problems"]))
+
+    def schedule_refill(self, store: str, topic: str, difficulty: str, generator_lease, force: bool = False):
+        """
+        不足している問題をバックグラウンドで補充する（実行中のイベントループが必要）
+
+        要求回数がmin_requestsに満たない組み合わせは補充しない。
+
+        Args:
+            generator_lease (function): storeに対応する問題ジェネレーターを補充の間だけ借りる関数
+                                        （ジェネレーターを返すコンテキストマネージャーを返す）
+            force (bool): 要求回数にかかわらず補充する
+        """
+        store = self._normalize(store)
+        key = self._key(store, topic, difficulty)
+        with self._lock:
+            if key in self._refilling or self._missing(key) == 0:
+                return
+            if not force and self._data["entries"][key]["requests"] < self.min_requests:
+                return
+            self._refilling.add(key)
+
+        task = asyncio.create_task(self._refill(store, topic, difficulty, generator_lease))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _refill(self, store, topic, difficulty, generator_lease):
+        key = self._key(store, topic, difficulty)
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_background)
+        try:
+            with generator_lease() as generator:
+                for _ in range(self.refill_size):
+                    with self._lock:
+                        generation = self._generation(store)
+                        if self._missing(key) == 0:
+                            break
+                    async with self._semaphore:
+                        problem = await generator.agenerate_problem(topic, difficulty)
+                    if not self._add(store, topic, difficulty, problem, generation):
+                        break
+        except Exception as e:
+            print(f"問題プールの補充中にエラーが発生しました: {str(e)}")
+            print(traceback.format_exc())
+        finally:
+            with self._lock:
+                self._refilling.discard(key)
+            # 補充した問題は補充の完了時にまとめて保存する
+            self.flush()
+
+    def warm(self, store: str, generator_lease, limit: int = 5):
+        """
+        よく要求される組み合わせのうち、不足しているものを補充する（要求回数にかかわらず補充する）
+
+        Args:
+            store (str): 対象のストア
+            generator_lease (function): storeに対応する問題ジェネレーターを補充の間だけ借りる関数
+            limit (int): 補充する組み合わせの最大数
+        """
+        store = self._normalize(store)
+        with self._lock:
+            candidates = []
+            for key, entry in self._data["entries"].items():
+                entry_store, topic, difficulty = json.loads(key)
+                if entry_store == store and self._missing(key) > 0:
+                    candidates.append((entry["requests"], topic, difficulty))
+        for _, topic, difficulty in sorted(candidates, reverse=True)[:limit]:
+            self.schedule_refill(store, topic, difficulty, generator_lease, force=True)
+
+    def invalidate_store(self, store: str):
+        """ストアに新しいドキュメントが追加された場合などに、そのストアの問題を破棄する"""
+        store = self._normalize(store)
+        with self._lock:
+            self._data["generations"][store] = self._generation(store) + 1
+            for key, entry in self._data["entries"].items():
+                if json.loads(key)[0] == store:
+                    entry["problems"] = []
+            self._save()
@@ -0,0 +1,167 @@
+import os
+import threading
+from collections import OrderedDict
+
+from langchain_core.embeddings import Embeddings
+
+from metrics import record_cache
+
+
+class StoreVersionRegistry:
+    """
+    ストアごとの書き込みバージョンを管理するクラス
+
+    PDFProcessorがストアに書き込むたびにバージョンを進め、登録されたリスナーに通知する。
+    キャッシュはバージョンをキーに含めることで、古い検索結果を返さないようにする。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._listeners = []
+
+    @staticmethod
+    def normalize(store_path: str) -> str:
+        """ストアのパスを比較可能な形にそろえる"""
+        return os.path.abspath(store_path)
+
+    def get(self, store_path: str) -> int:
+        """ストアの現在のバージョンを返す"""
+        with self._lock:
+            return self._versions.get(self.normalize(store_path), 0)
+
+    def bump(self, store_path: str) -> int:
+        """ストアのバージョンを進め、リスナーに通知する"""
+        store = self.normalize(store_path)
+        with self._lock:
+            version = self._versions.get(store, 0) + 1
+            self._versions[store] = version
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(store, version)
+        return version
+
+    def subscribe(self, listener):
+        """
+        バージョン更新時に呼ばれるリスナーを登録する
+
+        Args:
+            listener (function): 引数: (store_path, version)
+        """
+        with self._lock:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        """登録したリスナーを解除する"""
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+
+# プロセス内で共有するストアバージョン
+store_versions = StoreVersionRegistry()
+
+
+class RetrievalCache:
+    """
+    検索結果のLRUキャッシュ
+
+    (ストア, ストアのバージョン, クエリ, k)をキーに検索結果を保持する。
+    ストアに書き込みがあると、そのストアのエントリは自動的に破棄される。
+    """
+
+    def __init__(self, max_entries: int = 256, versions: StoreVersionRegistry = store_versions):
+        """
+        キャッシュを初期化
+
+        Args:
+            max_entries (int): 保持する検索結果の最大数
+            versions (StoreVersionRegistry): ストアのバージョン管理
+        """
+        self.max_entries = max_entries
+        self.versions = versions
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        versions.subscribe(lambda store, version: self.invalidate_store(store))
+
+    def _key(self, store_path, query, k):
+        store = self.versions.normalize(store_path)
+        return (store, self.versions.get(store), query, k)
+
+    def get(self, store_path: str, query: str, k: int):
+        """キャッシュされた検索結果を返す。ない場合はNone"""
+        key = self._key(store_path, query, k)
+        with self._lock:
+            docs = self._entries.get(key)
+            if docs is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        record_cache("retrieval", docs is not None)
+        return docs
+
+    def put(self, store_path: str, query: str, k: int, docs):
+        """検索結果を保存し、上限を超えた分は最も古く参照されたものから削除する"""
+        key = self._key(store_path, query, k)
+        with self._lock:
+            self._entries[key] = docs
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_store(self, store_path: str):
+        """ストアのエントリをすべて破棄する"""
+        store = self.versions.normalize(store_path)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == store]:
+                del self._entries[key]
+
+    def hit_rate(self) -> float:
+        """キャッシュのヒット率を返す"""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """
+    クエリの埋め込みをディスクにキャッシュする埋め込みモデルのラッパー
+
+    同じ出題範囲や質問が繰り返し検索される場合に、埋め込みAPIの呼び出しを省略する。
+    ドキュメントの埋め込みはキャッシュせずにそのまま委譲する。
+    """
+
+    def __init__(self, embedding_model, cache):
+        """
+        Args:
+            embedding_model: 元の埋め込みモデル
+            cache (IngestionCache): 埋め込みベクトルを保存するキャッシュ
+        """
+        self.embedding_model = embedding_model
+        self.cache = cache
+
+    @property
+    def model(self) -> str:
+        return getattr(self.embedding_model, "model", type(self.embedding_model).__name__)
+
+    def embed_documents(self, texts):
+        return self.embedding_model.embed_documents(texts)
+
+    async def aembed_documents(self, texts):
+        return await self.embedding_model.aembed_documents(texts)
+
+    def embed_query(self, text):
+        embedding = self.cache.get_embedding(self.model, text)
+        if embedding is None:
+            embedding = self.embedding_model.embed_query(text)
+            self.cache.put_embedding(self.model, text, embedding)
+        return embedding
+
+    async def aembed_query(self, text):
+        embedding = self.cache.get_embedding(self.model, text)
+        if embedding is None:
+            embedding = await self.embedding_model.aembed_query(text)
+            self.cache.put_embedding(self.model, text, embedding)
+        return embedding
@@ -0,0 +1,142 @@
+import asyncio
+import threading
+import uuid
+
+from lexical_index import is_ingesting
+from metrics import record_cache
+from retrieval_cache import store_versions
+from store_registry import store_registry
+
+
+class SemanticExplainCache:
+    """
+    /explainの回答を意味的に再利用するキャッシュ
+
+    質問を埋め込み、ストア内の専用コレクションから類似度がしきい値以上の
+    過去の質問を探して、その解説を返す。ストアに書き込みがあると、次の検索時に破棄される
+    （取り込み中は書き込みのたびに破棄せず、取り込みが終わってから1回だけ破棄する）。
+    見つからなかった質問の埋め込みは保持しておき、storeで解説と一緒に保存する（埋め込みは1回だけ計算する）。
+    """
+
+    COLLECTION_NAME = "explain_cache"
+    # storeを待っている質問の埋め込みを保持する最大数（解説の生成に失敗した質問の分が溜まらないようにする）
+    MAX_PENDING = 64
+
+    def __init__(self, dir_db: str, embedding_model, threshold: float = 0.92, registry=store_registry):
+        """
+        キャッシュを初期化
+
+        Args:
+            dir_db (str): 対象のベクトルストアのディレクトリ
+            embedding_model: 質問の埋め込みに使用するモデル
+            threshold (float): キャッシュを使用する類似度（コサイン類似度）の下限
+        """
+        self.dir_db = dir_db
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.embedding_model = embedding_model
+        # 質問 -> lookupで計算した埋め込み（storeで使う）
+        self._pending = {}
+
+        self.registry = registry
+        self.db = registry.acquire(
+            dir_db,
+            embedding_model,
+            collection_name=self.COLLECTION_NAME,
+            collection_metadata={"hnsw:space": "cosine"},
+        )
+        self._closed = False
+        # 解説が対応しているストアのバージョン
+        self._version = store_versions.get(dir_db)
+
+    def close(self):
+        """ストアの参照を解放する"""
+        if not self._closed:
+            self._closed = True
+            self.registry.release(self.dir_db)
+
+    def _refresh(self):
+        """ストアの内容が変わっていたら古い解説を破棄する（取り込み中の場合は取り込みの完了後に破棄する）"""
+        version = store_versions.get(self.dir_db)
+        if version == self._version or is_ingesting(self.dir_db):
+            return
+        with self._lock:
+            if version == self._version:
+                return
+            self._version = version
+        self.clear()
+
+    def _record(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        record_cache("semantic_explain", hit)
+
+    def _search(self, question: str, embedding):
+        """
+        埋め込みで最も類似した質問を探し、しきい値以上なら{"question", "answer"}の辞書にして返す
+
+        見つからなかった場合は、storeで使えるよう質問の埋め込みを保持する。
+        """
+        self._refresh()
+        if self.db._collection.count() > 0:
+            results = self.db.similarity_search_by_vector_with_relevance_scores(embedding, k=1)
+            if results:
+                doc, distance = results[0]
+                # 検索結果は距離なので、コレクションの距離関数に合わせて類似度に変換する
+                if self.db._select_relevance_score_fn()(distance) >= self.threshold:
+                    self._record(True)
+                    return {"question": doc.metadata["question"], "answer": doc.metadata["answer"]}
+        self._record(False)
+        with self._lock:
+            self._pending.pop(question, None)
+            self._pending[question] = embedding
+            while len(self._pending) > self.MAX_PENDING:
+                del self._pending[next(iter(self._pending))]
+        return None
+
+    def lookup(self, question: str):
+        """
+        類似した質問の解説を探す
+
+        Returns:
+            dict: {"question": str, "answer": str}。見つからない場合はNone
+        """
+        return self._search(question, self.embedding_model.embed_query(question))
+
+    async def alookup(self, question: str):
+        """lookupの非同期版"""
+        embedding = await self.embedding_model.aembed_query(question)
+        return await asyncio.get_running_loop().run_in_executor(None, self._search, question, embedding)
+
+    def store(self, question: str, result: dict):
+        """質問と解説を保存する（lookupで計算した埋め込みがあれば再利用する）"""
+        with self._lock:
+            embedding = self._pending.pop(question, None)
+        if embedding is None:
+            embedding = self.embedding_model.embed_query(question)
+        self.db._collection.upsert(
+            ids=[str(uuid.uuid4())],
+            embeddings=[embedding],
+            documents=[question],
+            metadatas=[{"question": result["question"], "answer": result["answer"]}],
+        )
+
+    async def astore(self, question: str, result: dict):
+        """storeの非同期版（埋め込みとChromaへの書き込みをイベントループの外で行う）"""
+        await asyncio.get_running_loop().run_in_executor(None, self.store, question, result)
+
+    def clear(self):
+        """キャッシュをすべて破棄する"""
+        ids = self.db.get(include=[])["ids"]
+        if ids:
+            self.db.delete(ids=ids)
+
+    def hit_rate(self) -> float:
+        """キャッシュのヒット率を返す"""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
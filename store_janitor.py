@@ -0,0 +1,221 @@
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+from store_registry import store_registry
+
+# Chromaがセグメント（HNSWインデックス）ごとに作成するディレクトリの名前
+SEGMENT_DIR_PATTERN = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+
+def directory_size(path: str) -> int:
+    """ディレクトリ以下のファイルの合計サイズ（バイト）"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class StoreJanitor:
+    """
+    ストアのディレクトリの削除とディスク容量の回収を行うクラス
+
+    削除するストアはクライアントを閉じてからゴミ箱ディレクトリへリネームし、バックグラウンドで消去する。
+    リネームは即座に完了するため、同じ名前のストアを追加し直しても古いデータは復活しない。
+    """
+
+    TRASH_DIR = "_trash"
+
+    def __init__(self, base_dir="./vector_stores", registry=store_registry):
+        """
+        Args:
+            base_dir (str): ベクトルストアの基本ディレクトリ
+            registry (StoreHandleRegistry): ストアのクライアントを共有するレジストリ
+        """
+        self.base_dir = os.path.abspath(base_dir)
+        self.trash_dir = os.path.join(self.base_dir, self.TRASH_DIR)
+        self.registry = registry
+        self._threads = set()
+        self._lock = threading.Lock()
+
+    def remove_store(self, store_path: str, background: bool = True):
+        """
+        ストアのクライアントを閉じ、ディレクトリをゴミ箱に移してから消去する
+
+        Args:
+            store_path (str): 削除するストアのディレクトリ
+            background (bool): Trueの場合、消去はバックグラウンドのスレッドで行う
+
+        Returns:
+            str: ゴミ箱に移したパス（ディレクトリが存在しない場合はNone）
+
+        Raises:
+            ValueError: 基本ディレクトリの直下のストアのディレクトリではない場合
+        """
+        path = os.path.abspath(store_path)
+        self._check_store_path(path)
+        self.registry.close(store_path, force=True)
+        if not os.path.isdir(path):
+            return None
+
+        os.makedirs(self.trash_dir, exist_ok=True)
+        trash_path = os.path.join(self.trash_dir, f"{os.path.basename(path)}-{int(time.time())}-{uuid.uuid4().hex[:8]}")
+        try:
+            os.replace(path, trash_path)
+        except FileNotFoundError:
+            # 他のプロセスが先に削除した
+            return None
+
+        if background:
+            self._purge_in_background(trash_path)
+        else:
+            self._purge(trash_path)
+        return trash_path
+
+    def _check_store_path(self, path: str):
+        """基本ディレクトリの直下にあり、内部ディレクトリ（"_"や"."で始まるもの）ではないことを確認する"""
+        real_path = os.path.realpath(path)
+        name = os.path.basename(real_path)
+        if os.path.dirname(real_path) != os.path.realpath(self.base_dir) or not name or name.startswith(("_", ".")):
+            raise ValueError(f"{path} はストアのディレクトリではないため削除できません")
+
+    def _purge(self, path: str) -> int:
+        """ディレクトリを消去し、回収したバイト数を返す"""
+        size = directory_size(path)
+        try:
+            shutil.rmtree(path)
+        except FileNotFoundError:
+            return 0
+        except Exception as e:
+            print(f"{path} の削除中にエラーが発生しました: {str(e)}")
+            return size - directory_size(path)
+        return size
+
+    def _purge_in_background(self, path: str):
+        def run():
+            try:
+                self._purge(path)
+            finally:
+                with self._lock:
+                    self._threads.discard(thread)
+
+        thread = threading.Thread(target=run, name=f"purge-{os.path.basename(path)}", daemon=True)
+        with self._lock:
+            self._threads.add(thread)
+        thread.start()
+
+    def empty_trash(self) -> int:
+        """ゴミ箱に残っているディレクトリ（中断された削除など）を消去し、回収したバイト数を返す"""
+        if not os.path.isdir(self.trash_dir):
+            return 0
+        with self._lock:
+            purging = {thread.name for thread in self._threads}
+        reclaimed = 0
+        for entry in os.listdir(self.trash_dir):
+            if f"purge-{entry}" not in purging:
+                reclaimed += self._purge(os.path.join(self.trash_dir, entry))
+        return reclaimed
+
+    def find_orphans(self, store_paths, min_age: float = 600) -> list:
+        """
+        設定に登録されていないストアのディレクトリを探す
+
+        "_"や"."で始まるディレクトリ（キャッシュ・ジョブ・ゴミ箱など）とファイルは対象外。
+        他のプロセスが追加した直後のストアを消さないよう、最近更新されたディレクトリも対象外にする。
+
+        Args:
+            store_paths (iterable): 登録されているストアのディレクトリ
+            min_age (float): 対象にするディレクトリの最終更新からの経過秒数
+
+        Returns:
+            list: 孤立したディレクトリのパス
+        """
+        known = {os.path.abspath(path) for path in store_paths}
+        orphans = []
+        for entry in sorted(os.listdir(self.base_dir)):
+            path = os.path.join(self.base_dir, entry)
+            if entry.startswith(("_", ".")) or not os.path.isdir(path) or path in known:
+                continue
+            if time.time() - os.path.getmtime(path) < min_age:
+                continue
+            orphans.append(path)
+        return orphans
+
+    def compact_store(self, store_path: str) -> dict:
+        """
+        ストアのディスク容量を回収する
+
+        使われていないストアはクライアントを閉じてから、Chromaのセグメント表に載っていない
+        インデックスのディレクトリ（削除したコレクションの残りなど）を消去し、SQLiteをVACUUMする。
+        使用中のストアはVACUUMだけを試みる。
+
+        Returns:
+            dict: {"segments": 消去したセグメントのバイト数, "vacuum": VACUUMで減ったバイト数}
+        """
+        db_path = os.path.join(store_path, "chroma.sqlite3")
+        result = {"segments": 0, "vacuum": 0}
+        if not os.path.exists(db_path):
+            return result
+
+        idle = self.registry.close(store_path, force=False)
+        conn = sqlite3.connect(db_path, timeout=10)
+        try:
+            if idle:
+                live_segments = {row[0] for row in conn.execute("SELECT id FROM segments")}
+                for entry in os.listdir(store_path):
+                    path = os.path.join(store_path, entry)
+                    if SEGMENT_DIR_PATTERN.match(entry) and os.path.isdir(path) and entry not in live_segments:
+                        result["segments"] += self._purge(path)
+
+            before = os.path.getsize(db_path)
+            try:
+                conn.execute("VACUUM")
+            except sqlite3.OperationalError as e:
+                # 他の接続が書き込み中などでVACUUMできない場合は次回に回す
+                print(f"{db_path} をVACUUMできませんでした: {str(e)}")
+            result["vacuum"] = max(0, before - os.path.getsize(db_path))
+        finally:
+            conn.close()
+        return result
+
+    def collect(self, store_paths, min_age: float = 600) -> dict:
+        """
+        孤立したディレクトリとゴミ箱を消去し、登録されているストアを圧縮する
+
+        Args:
+            store_paths (dict): ストア名 -> 登録されているストアのディレクトリ
+            min_age (float): 孤立したディレクトリとみなす最終更新からの経過秒数
+
+        Returns:
+            dict: {"orphans": [(パス, バイト数)], "trash": バイト数,
+                   "stores": {ストア名: compact_storeの結果}, "total": 回収した合計バイト数}
+        """
+        report = {"orphans": [], "trash": 0, "stores": {}, "total": 0}
+        for path in self.find_orphans(store_paths.values(), min_age):
+            self.registry.close(path, force=True)
+            size = self._purge(path)
+            report["orphans"].append((path, size))
+            report["total"] += size
+
+        report["trash"] = self.empty_trash()
+        report["total"] += report["trash"]
+
+        for name, path in store_paths.items():
+            try:
+                result = self.compact_store(path)
+            except Exception as e:
+                print(f"ストア「{name}」の圧縮中にエラーが発生しました: {str(e)}")
+                continue
+            report["stores"][name] = result
+            report["total"] += result["segments"] + result["vacuum"]
+        return report
@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import chromadb
+from chromadb.api.client import SharedSystemClient
+from langchain_chroma import Chroma
+
+
+class StoreHandle:
+    """1つのストアのディレクトリに対応するChromaクライアントと、そのコレクションのラッパー"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.client = chromadb.PersistentClient(path=path)
+        # (コレクション名, 埋め込みモデルのid) -> Chroma
+        self.vectorstores = {}
+        self.refcount = 0
+        self.last_used = time.time()
+
+    def close(self):
+        """クライアントを閉じ、SQLiteやHNSWインデックスのリソースを解放する"""
+        self.vectorstores.clear()
+        # chromadbは同じパスのシステムをプロセス内で共有するため、キャッシュから外してから停止する
+        system = SharedSystemClient._identifer_to_system.pop(self.client._identifier, None)
+        if system is not None:
+            try:
+                system.stop()
+            except Exception as e:
+                print(f"ベクトルストアのクローズ中にエラーが発生しました: {str(e)}")
+
+
+class StoreHandleRegistry:
+    """
+    ストアごとのChromaクライアントを共有するレジストリ
+
+    1つのストアのディレクトリにつきクライアントを1つだけ遅延生成し、参照カウントで管理する。
+    参照されなくなったストアはアイドル状態として保持し、上限を超えたら最も古いものから閉じる。
+    """
+
+    def __init__(self, max_idle: int = 4):
+        """
+        Args:
+            max_idle (int): 開いたまま保持するアイドル状態のストアの最大数
+        """
+        self.max_idle = max_idle
+        self._lock = threading.RLock()
+        self._handles = {}
+        # アイドル状態のストア（LRU順）
+        self._idle = OrderedDict()
+
+    @staticmethod
+    def normalize(store_path: str) -> str:
+        return os.path.abspath(store_path)
+
+    def acquire(self, store_path: str, embedding_function=None, collection_name: str = "langchain",
+                collection_metadata: dict = None) -> Chroma:
+        """
+        ストアのコレクションを取得し、参照カウントを増やす（使い終わったらreleaseを呼ぶこと）
+
+        Args:
+            store_path (str): ストアのディレクトリ
+            embedding_function: コレクションで使用する埋め込みモデル
+            collection_name (str): コレクション名
+            collection_metadata (dict): コレクション作成時のメタデータ
+
+        Returns:
+            Chroma: 共有クライアントに接続されたベクトルストア
+        """
+        path = self.normalize(store_path)
+        with self._lock:
+            handle = self._handles.get(path)
+            if handle is None:
+                os.makedirs(path, exist_ok=True)
+                handle = StoreHandle(path)
+                self._handles[path] = handle
+            self._idle.pop(path, None)
+            handle.refcount += 1
+            handle.last_used = time.time()
+
+            key = (collection_name, id(embedding_function))
+            vectorstore = handle.vectorstores.get(key)
+            if vectorstore is None:
+                vectorstore = Chroma(
+                    client=handle.client,
+                    collection_name=collection_name,
+                    embedding_function=embedding_function,
+                    collection_metadata=collection_metadata,
+                )
+                handle.vectorstores[key] = vectorstore
+            return vectorstore
+
+    def release(self, store_path: str):
+        """参照カウントを減らし、参照されなくなったストアをアイドル状態にする"""
+        path = self.normalize(store_path)
+        with self._lock:
+            handle = self._handles.get(path)
+            if handle is None or handle.refcount == 0:
+                return
+            handle.refcount -= 1
+            if handle.refcount == 0:
+                self._idle[path] = handle
+                self._evict_idle()
+
+    def _evict_idle(self):
+        """アイドル状態のストアが上限を超えたら、最も古いものから閉じる（ロック取得済みで呼ぶこと）"""
+        while len(self._idle) > self.max_idle:
+            path, handle = self._idle.popitem(last=False)
+            del self._handles[path]
+            handle.close()
+
+    def close(self, store_path: str, force: bool = False) -> bool:
+        """
+        ストアのクライアントを閉じる
+
+        Args:
+            store_path (str): ストアのディレクトリ
+            force (bool): 参照中であっても閉じる場合はTrue
+
+        Returns:
+            bool: 閉じた場合True（参照中で閉じなかった場合False）
+        """
+        path = self.normalize(store_path)
+        with self._lock:
+            handle = self._handles.get(path)
+            if handle is None:
+                return True
+            if handle.refcount > 0 and not force:
+                return False
+            del self._handles[path]
+            self._idle.pop(path, None)
+            handle.close()
+            return True
+
+    def open_stores(self) -> dict:
+        """開いているストアと参照カウントを返す"""
+        with self._lock:
+            return {path: handle.refcount for path, handle in self._handles.items()}
+
+
+# プロセス内で共有するレジストリ
+store_registry = StoreHandleRegistry()
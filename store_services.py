@@ -0,0 +1,155 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class StoreServicePool:
+    """
+    ストアごとのPDFプロセッサと問題ジェネレーターを共有するプール
+
+    インスタンスはストアのパスごとに1つだけ遅延生成し、全セッションで共有する。
+    セッションはストア名だけを保持し、リクエストごとにプールからインスタンスを借りて、使い終わったら返す。
+    どこからも使われていないインスタンスはアイドル状態として保持し、上限を超えたら最も古いものから閉じる
+    （閉じたインスタンスはストアの参照を解放するため、レジストリがChromaのクライアントを閉じられる）。
+    """
+
+    def __init__(self, processor_factory, generator_factory, federated_generator_factory=None, max_idle: int = 4):
+        """
+        Args:
+            processor_factory (function): ストアのパスからPDFProcessorを作成する関数
+            generator_factory (function): ストアのパスからMathProblemGeneratorを作成する関数
+            federated_generator_factory (function): ストア名 -> パスの辞書から、複数のストアを
+                検索するMathProblemGeneratorを作成する関数
+            max_idle (int): 開いたまま保持するアイドル状態のインスタンスの最大数
+        """
+        self.processor_factory = processor_factory
+        self.generator_factory = generator_factory
+        self.federated_generator_factory = federated_generator_factory
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        # キー -> {"instance", "refcount", "last_used"}
+        # キーは("processor", パス)、("generator", パス)、("federated", (ストア名, パス)の組)
+        self._entries = {}
+        # アイドル状態のインスタンスのキー（LRU順）
+        self._idle = OrderedDict()
+        # 貸し出し中のインスタンスのid -> エントリ（破棄されたストアのインスタンスも返却まで保持する）
+        self._leased = {}
+
+    @staticmethod
+    def _key(store_path: str) -> str:
+        return os.path.abspath(store_path)
+
+    def _acquire(self, key, create):
+        """インスタンスを借りる（初回のみ作成）。使い終わったらreleaseを呼ぶこと"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = {"instance": create(), "refcount": 0, "last_used": time.time()}
+                self._entries[key] = entry
+            self._idle.pop(key, None)
+            entry["refcount"] += 1
+            entry["last_used"] = time.time()
+            self._leased[id(entry["instance"])] = entry
+            return entry["instance"]
+
+    def acquire_processor(self, store_path: str):
+        """ストアのPDFProcessorを借りる（使い終わったらreleaseを呼ぶこと）"""
+        return self._acquire(("processor", self._key(store_path)), lambda: self.processor_factory(store_path))
+
+    def acquire_generator(self, store_path: str):
+        """ストアのMathProblemGeneratorを借りる（使い終わったらreleaseを呼ぶこと）"""
+        return self._acquire(("generator", self._key(store_path)), lambda: self.generator_factory(store_path))
+
+    def acquire_federated_generator(self, store_paths: dict):
+        """
+        複数のストアを検索するMathProblemGeneratorを借りる（使い終わったらreleaseを呼ぶこと）
+
+        Args:
+            store_paths (dict): ストア名 -> ストアのパス
+        """
+        key = ("federated", frozenset((name, self._key(path)) for name, path in store_paths.items()))
+        return self._acquire(key, lambda: self.federated_generator_factory(dict(store_paths)))
+
+    def release(self, instance):
+        """借りたインスタンスを返す。どこからも使われなくなったものはアイドル状態にする"""
+        with self._lock:
+            entry = self._leased.get(id(instance))
+            if entry is None:
+                return
+            entry["refcount"] -= 1
+            if entry["refcount"] > 0:
+                return
+            del self._leased[id(instance)]
+            key = next((key for key, value in self._entries.items() if value is entry), None)
+            if key is None:
+                # 使用中に破棄されたストアのインスタンスは、返却されたときに閉じる
+                closing = [instance]
+            else:
+                entry["last_used"] = time.time()
+                self._idle[key] = entry
+                closing = self._evict_idle()
+        self._close(closing)
+
+    def _evict_idle(self) -> list:
+        """アイドル状態のインスタンスが上限を超えた分をプールから外す（ロック取得済みで呼ぶこと）"""
+        evicted = []
+        while len(self._idle) > self.max_idle:
+            key, entry = self._idle.popitem(last=False)
+            del self._entries[key]
+            evicted.append(entry["instance"])
+        return evicted
+
+    @staticmethod
+    def _close(instances):
+        for instance in instances:
+            try:
+                instance.close()
+            except Exception as e:
+                print(f"ストアのインスタンスのクローズ中にエラーが発生しました: {str(e)}")
+
+    @contextmanager
+    def processor(self, store_path: str):
+        """ストアのPDFProcessorをwithブロックの間だけ借りる"""
+        processor = self.acquire_processor(store_path)
+        try:
+            yield processor
+        finally:
+            self.release(processor)
+
+    @contextmanager
+    def generator(self, store_path: str):
+        """ストアのMathProblemGeneratorをwithブロックの間だけ借りる"""
+        generator = self.acquire_generator(store_path)
+        try:
+            yield generator
+        finally:
+            self.release(generator)
+
+    @contextmanager
+    def federated_generator(self, store_paths: dict):
+        """複数のストアを検索するMathProblemGeneratorをwithブロックの間だけ借りる"""
+        generator = self.acquire_federated_generator(store_paths)
+        try:
+            yield generator
+        finally:
+            self.release(generator)
+
+    def discard(self, store_path: str):
+        """
+        ストアのインスタンスを破棄し、ストアの参照を解放する（ストア削除時など）
+
+        このストアを含む複数ストアのジェネレーターも破棄する。使用中のインスタンスは返却されたときに閉じる。
+        """
+        path = self._key(store_path)
+        with self._lock:
+            keys = [key for key in self._entries
+                    if key[1] == path or (key[0] == "federated" and any(p == path for _, p in key[1]))]
+            closing = []
+            for key in keys:
+                entry = self._entries.pop(key)
+                self._idle.pop(key, None)
+                if entry["refcount"] == 0:
+                    closing.append(entry["instance"])
+        self._close(closing)
@@ -0,0 +1,15 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# リポジトリ直下のモジュール（pdf_processor など）を読み込めるようにする
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture(scope="session", autouse=True)
+def close_page_renderer():
+    """ラスタライズのワーカープロセスを止めないと、テストのプロセスが終了できない"""
+    yield
+    from page_renderer import page_renderer
+    page_renderer.close()
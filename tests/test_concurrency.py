@@ -0,0 +1,39 @@
+import asyncio
+import time
+
+from benchmarks.bench_concurrency import heartbeat
+from benchmarks.fakes import FakeChatModel, FakeEmbeddings
+from benchmarks.sample_pdf import make_sample_pdf
+from pdf_processor import PDFProcessor
+
+PAGES = 8
+LATENCY = 0.2
+
+
+async def ingest(pdf_path, db_dir, max_concurrency):
+    """サンプルPDFを取り込み、所要時間とイベントループの最大停止（秒）を返す"""
+    processor = PDFProcessor(db_dir, FakeEmbeddings(latency=0), FakeChatModel(LATENCY),
+                             max_concurrency=max_concurrency, render_dpi=72, text_fast_path=False)
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(heartbeat(stop, interval=0.01))
+    start = time.perf_counter()
+    try:
+        await processor.process_pdf_with_progress(pdf_path)
+    finally:
+        processor.close()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    return elapsed, await monitor
+
+
+def test_ingestion_runs_ocr_concurrently_without_blocking_the_event_loop(tmp_path):
+    pdf_path = make_sample_pdf(str(tmp_path / "sample.pdf"), PAGES)
+
+    # 1ページずつOCRする場合を基準にする（ワーカープロセスの起動もここで済ませる）
+    sequential, _ = asyncio.run(ingest(pdf_path, str(tmp_path / "sequential"), 1))
+    elapsed, worst_stall = asyncio.run(ingest(pdf_path, str(tmp_path / "concurrent"), PAGES))
+
+    assert sequential >= PAGES * LATENCY
+    assert elapsed < sequential / 2
+    # LLMの応答待ちやラスタライズでイベントループが止まっていない
+    assert worst_stall < LATENCY
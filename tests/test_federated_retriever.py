@@ -0,0 +1,74 @@
+import asyncio
+import threading
+import time
+
+from langchain_core.documents import Document
+
+from benchmarks.fakes import FakeEmbeddings
+from federated_retriever import FEDERATED_TIMEOUTS, FederatedRetriever
+from hybrid_retriever import HybridRetriever
+
+
+def chunk(text, source="lecture.pdf", page=1, chunk_index=0):
+    return Document(page_content=text, metadata={"source": source, "page": page, "chunk": chunk_index})
+
+
+def test_same_source_page_chunk_in_different_stores_are_kept_apart():
+    retriever = FederatedRetriever(stores={"calculus": None, "algebra": None}, embedding_model=None,
+                                   store_paths={"calculus": "/stores/calculus", "algebra": "/stores/algebra"}, k=5)
+
+    fused = retriever.fuse({
+        "calculus": [chunk("微分の定義")],
+        "algebra": [chunk("群の定義")],
+    })
+
+    assert sorted(doc.page_content for doc in fused) == ["微分の定義", "群の定義"]
+    assert {doc.metadata["store"] for doc in fused} == {"calculus", "algebra"}
+
+
+def test_hybrid_results_from_one_store_are_merged():
+    retriever = HybridRetriever(vectorstore=None, index=None, k=5)
+    same = chunk("微分の定義")
+
+    fused = retriever._combine([same], [same, chunk("積分の定義", page=2)])
+
+    assert [doc.page_content for doc in fused] == ["微分の定義", "積分の定義"]
+
+
+class FakeStore:
+    def __init__(self, text, release=None):
+        self.text = text
+        self.release = release
+        self.calls = 0
+
+    def similarity_search_by_vector(self, embedding, k=4):
+        self.calls += 1
+        if self.release is not None:
+            self.release.wait(10)
+        return [chunk(self.text)]
+
+
+def test_store_with_stalled_search_is_skipped_until_it_finishes():
+    release = threading.Event()
+    slow = FakeStore("遅いストア", release)
+    retriever = FederatedRetriever(stores={"slow": slow, "fast": FakeStore("速いストア")},
+                                   embedding_model=FakeEmbeddings(latency=0), timeout=0.2, k=5)
+    timeouts = FEDERATED_TIMEOUTS.values().get(("slow",), 0)
+    try:
+        assert [doc.page_content for doc in retriever.invoke("微分")] == ["速いストア"]
+
+        # 前回の検索がスレッドを使っている間は、待たずに時間切れとして扱う
+        start = time.perf_counter()
+        fused = asyncio.run(retriever.ainvoke("微分"))
+        assert time.perf_counter() - start < 0.2
+        assert [doc.page_content for doc in fused] == ["速いストア"]
+        assert slow.calls == 1
+        assert FEDERATED_TIMEOUTS.values()[("slow",)] == timeouts + 2
+
+        release.set()
+        retriever._stalled["slow"].result(10)
+        fused = asyncio.run(retriever.ainvoke("微分"))
+        assert sorted(doc.page_content for doc in fused) == ["速いストア", "遅いストア"]
+    finally:
+        release.set()
+        retriever.close()
@@ -0,0 +1,27 @@
+import asyncio
+
+import chromadb
+import pytest
+
+from benchmarks.fakes import FakeEmbeddings
+from ingestion_buffer import IngestionWriteBuffer
+
+
+def test_failed_flush_keeps_documents_for_the_next_flush():
+    collection = chromadb.EphemeralClient().get_or_create_collection("buffer_retry")
+    buffer = IngestionWriteBuffer(collection, FakeEmbeddings(fail_calls={1}), batch_size=10)
+
+    async def scenario():
+        await buffer.add("a", "最初のチャンク", {"page": 1})
+        with pytest.raises(RuntimeError):
+            await buffer.flush()
+        assert len(buffer) == 1 and buffer.documents_written == 0
+
+        await buffer.add("b", "次のチャンク", {"page": 2})
+        await buffer.flush()
+
+    asyncio.run(scenario())
+
+    assert len(buffer) == 0
+    assert buffer.documents_written == 2
+    assert sorted(collection.get()["ids"]) == ["a", "b"]
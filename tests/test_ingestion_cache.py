@@ -0,0 +1,29 @@
+from ingestion_cache import IngestionCache
+
+TEXT = "x" * 95  # キー（"text:" + 2桁）と合わせて1エントリ102バイト
+
+
+def test_eviction_removes_least_recently_used_entries(tmp_path):
+    cache = IngestionCache(str(tmp_path), max_bytes=1020)
+    for i in range(10):
+        cache.put_text(f"{i:02d}", TEXT)
+    # 参照したエントリは削除の対象から外れる
+    assert cache.get_text("00") == TEXT
+
+    cache.put_text("10", TEXT)
+
+    assert cache.size() <= 1020 * IngestionCache.EVICT_TO_RATIO
+    assert cache.get_text("00") == TEXT
+    assert cache.get_text("01") is None
+    assert cache.get_text("10") == TEXT
+
+
+def test_size_tracks_replaced_entries_and_reopen(tmp_path):
+    cache = IngestionCache(str(tmp_path))
+    cache.put_text("00", TEXT)
+    cache.put_text("00", TEXT + "y")
+    cache.put_text("01", TEXT)
+
+    assert cache.size() == 205
+    assert cache.size() == cache._sum_size()
+    assert IngestionCache(str(tmp_path)).size() == 205
@@ -0,0 +1,45 @@
+import asyncio
+
+from ingestion_jobs import IngestionJobQueue
+
+
+class SlowProcessor:
+    """取り消されるまで処理を続け、後処理に時間がかかる偽プロセッサ"""
+
+    def __init__(self):
+        self.started = asyncio.Event()
+        self.events = []
+
+    async def process_pdf_with_progress(self, pdf_path, progress_callback=None, source_name=None,
+                                        skip_pages=None, checkpoint_callback=None):
+        self.started.set()
+        try:
+            await asyncio.sleep(3600)
+        finally:
+            # バッファに残ったページの書き込みなど
+            await asyncio.sleep(0.05)
+            self.events.append("flushed")
+
+
+def test_cancel_store_waits_for_the_running_job_to_finish(tmp_path):
+    processor = SlowProcessor()
+    queue = IngestionJobQueue(lambda store_path: processor, str(tmp_path / "jobs"),
+                              release_processor=lambda released: processor.events.append("released"))
+    pdf_path = tmp_path / "upload.pdf"
+    pdf_path.write_bytes(b"%PDF-1.4")
+
+    async def scenario():
+        queue.start()
+        try:
+            job = queue.submit(str(pdf_path), "math", str(tmp_path / "math"), "upload.pdf")
+            await asyncio.wait_for(processor.started.wait(), 10)
+
+            assert await queue.cancel_store(str(tmp_path / "math")) == 1
+            # 取り消しが返った時点でジョブの後処理とプロセッサの返却が終わっている
+            assert processor.events == ["flushed", "released"]
+            assert queue.get(job["id"])["status"] == IngestionJobQueue.CANCELLED
+        finally:
+            for worker in queue._workers:
+                worker.cancel()
+
+    asyncio.run(scenario())
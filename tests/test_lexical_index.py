@@ -0,0 +1,54 @@
+from lexical_index import LexicalIndex
+
+IDS = ["a", "b", "c"]
+TEXTS = ["定理 3.2 の証明", "ベクトル場の回転 $\\nabla \\times F$", "積分の定義"]
+
+
+class FakeCollection:
+    """Chromaのコレクションの代わり。最初の読み込みの直後にon_getを呼ぶ"""
+
+    def __init__(self, on_get=None):
+        self.on_get = on_get
+
+    def get(self, include=None, limit=None, offset=0):
+        if self.on_get:
+            self.on_get()
+            self.on_get = None
+        ids = IDS[offset:offset + limit]
+        return {"ids": ids, "documents": TEXTS[offset:offset + limit], "metadatas": [{"source": "a.pdf"}] * len(ids)}
+
+
+def test_rebuild_marks_built(tmp_path):
+    index = LexicalIndex(str(tmp_path))
+
+    assert index.rebuild(FakeCollection(), batch_size=2) == 3
+
+    assert index.ready
+    assert [doc_id for doc_id, _ in index.search("定理 3.2")] == ["a"]
+
+
+def test_rebuild_is_not_marked_built_when_another_instance_writes(tmp_path):
+    index = LexicalIndex(str(tmp_path))
+    # 取り込み中のPDFProcessorが持つ、同じストアの別のインスタンス
+    ingest_index = LexicalIndex(str(tmp_path))
+
+    index.rebuild(FakeCollection(on_get=lambda: ingest_index.delete(["a"])), batch_size=2)
+
+    assert not index.ready
+    index.rebuild(FakeCollection(), batch_size=2)
+    assert index.ready
+
+
+def test_build_waits_until_ingest_into_the_store_finishes(tmp_path):
+    index = LexicalIndex(str(tmp_path))
+    ingest_index = LexicalIndex(str(tmp_path))
+
+    with ingest_index.writing():
+        index.build_in_background(FakeCollection())
+        assert index._build_thread is None
+        index.rebuild(FakeCollection())
+        assert not index.ready
+
+    index.build_in_background(FakeCollection())
+    index._build_thread.join()
+    assert index.ready
@@ -0,0 +1,22 @@
+import pytest
+from fastapi import FastAPI
+from starlette.testclient import TestClient
+
+from metrics import mount_prometheus_endpoint
+
+
+def test_metrics_endpoint_requires_bearer_token():
+    app = FastAPI()
+    mount_prometheus_endpoint(app, "secret")
+    client = TestClient(app)
+
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    response = client.get("/metrics", headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+
+
+def test_metrics_endpoint_is_not_mounted_without_token():
+    with pytest.raises(ValueError):
+        mount_prometheus_endpoint(FastAPI(), "")
@@ -0,0 +1,50 @@
+import asyncio
+import threading
+import time
+
+import fitz
+
+from page_renderer import PageRenderer
+
+
+def make_pdf(path, pages):
+    doc = fitz.open()
+    for i in range(pages):
+        doc.new_page().insert_text((72, 72), f"page {i + 1}")
+    doc.save(path)
+    doc.close()
+    return str(path)
+
+
+def test_pages_requested_from_another_event_loop_are_resolved_on_that_loop(tmp_path):
+    pdf_path = make_pdf(tmp_path / "sample.pdf", 2)
+    renderer = PageRenderer(max_workers=1)
+    results = {}
+
+    def render_in_other_loop():
+        # debugモードでは、別のスレッドからFutureを完了させるとエラーになる
+        try:
+            results["other"] = asyncio.run(asyncio.wait_for(renderer.render(pdf_path, 1, 72, 80), 10), debug=True)
+        except BaseException as error:
+            results["other"] = error
+
+    async def render_in_this_loop():
+        task = asyncio.create_task(renderer.render(pdf_path, 0, 72, 80))
+        await asyncio.sleep(0)
+        # このループの割り振りが予約された状態で、別のループからページを要求する
+        thread = threading.Thread(target=render_in_other_loop)
+        thread.start()
+        time.sleep(0.2)
+        image = await task
+        await asyncio.to_thread(thread.join)
+        return image
+
+    try:
+        results["this"] = asyncio.run(render_in_this_loop())
+    finally:
+        renderer.close()
+
+    assert results["this"].startswith(b"\xff\xd8")
+    assert isinstance(results["other"], bytes), results["other"]
+    assert results["other"].startswith(b"\xff\xd8")
+    assert renderer._pending == {}
@@ -0,0 +1,98 @@
+import asyncio
+
+import fitz  # PyMuPDF
+import pytest
+
+from benchmarks.fakes import FakeChatModel, FakeEmbeddings
+from pdf_processor import PDFProcessor
+
+PAGE_TEXT = "第1節 区切り\n\n" + "定理 1.1 関数 f が閉区間 [a, b] で連続ならば最大値と最小値をとる。" * 5
+
+
+def make_duplicate_pdf(path, num_pages=3):
+    """全ページが同じ内容のPDFを作成する（白紙や区切りのページが繰り返される資料を模す）"""
+    doc = fitz.open()
+    for _ in range(num_pages):
+        page = doc.new_page()
+        page.insert_textbox(fitz.Rect(72, 72, 500, 700), PAGE_TEXT, fontname="japan", fontsize=11)
+    doc.save(path)
+    doc.close()
+    return str(path)
+
+
+def make_processor(tmp_path):
+    return PDFProcessor(str(tmp_path / "db"), FakeEmbeddings(latency=0), FakeChatModel(0), renderer=None)
+
+
+def test_duplicate_pages_are_stored_separately(tmp_path):
+    pdf_path = make_duplicate_pdf(tmp_path / "handout.pdf")
+    processor = make_processor(tmp_path)
+    try:
+        result = asyncio.run(processor.process_pdf_with_progress(pdf_path))
+
+        assert result["status"] == "success"
+        stored = processor.db._collection.get(include=["metadatas"])
+        assert sorted(metadata["page"] for metadata in stored["metadatas"]) == [1, 2, 3]
+    finally:
+        processor.close()
+
+
+def test_reingesting_duplicate_pages_keeps_all_chunks(tmp_path):
+    pdf_path = make_duplicate_pdf(tmp_path / "handout.pdf")
+    processor = make_processor(tmp_path)
+    try:
+        asyncio.run(processor.process_pdf_with_progress(pdf_path))
+        result = asyncio.run(processor.process_pdf_with_progress(pdf_path))
+
+        assert result["unchanged_pages"] == 3
+        assert result["removed_chunks"] == 0
+        assert processor.get_collection_size() == 3
+    finally:
+        processor.close()
+
+
+def make_pdf(path, texts):
+    doc = fitz.open()
+    for text in texts:
+        page = doc.new_page()
+        page.insert_textbox(fitz.Rect(72, 72, 500, 700), text, fontname="japan", fontsize=11)
+    doc.save(path)
+    doc.close()
+    return str(path)
+
+
+def make_flaky_processor(tmp_path, fail_calls):
+    return PDFProcessor(str(tmp_path / "db"), FakeEmbeddings(latency=0, fail_calls=fail_calls), FakeChatModel(0),
+                        renderer=None, embedding_batch_size=1, max_concurrency=1)
+
+
+def test_failed_batch_is_written_by_the_final_flush(tmp_path):
+    pdf_path = make_pdf(tmp_path / "lecture.pdf", [f"第{i}節\n\n" + PAGE_TEXT for i in range(1, 4)])
+    # 2ページ目の書き込みだけが失敗し、中断時の書き込みで再試行される
+    processor = make_flaky_processor(tmp_path, {2})
+    recorded = []
+    try:
+        with pytest.raises(Exception, match="2 回目"):
+            asyncio.run(processor.process_pdf_with_progress(pdf_path, checkpoint_callback=recorded.append))
+
+        assert recorded == [1, 2]
+        assert processor.get_collection_size() == 2
+    finally:
+        processor.close()
+
+
+def test_pages_whose_embedding_failed_are_not_recorded(tmp_path):
+    pdf_path = make_pdf(tmp_path / "lecture.pdf", [f"第{i}節\n\n" + PAGE_TEXT for i in range(1, 4)])
+    # 2ページ目の書き込みと、中断時の書き込みの再試行がどちらも失敗する
+    processor = make_flaky_processor(tmp_path, {2, 3})
+    recorded = []
+    try:
+        # 中断時の書き込みの失敗で、最初の例外が隠されない
+        with pytest.raises(Exception, match="2 回目"):
+            asyncio.run(processor.process_pdf_with_progress(pdf_path, checkpoint_callback=recorded.append))
+
+        assert recorded == [1]
+        assert list(processor.catalog.get_pages("lecture.pdf")) == [1]
+        assert processor.get_collection_size() == 1
+    finally:
+        processor.close()
@@ -0,0 +1,109 @@
+import asyncio
+import os
+from contextlib import nullcontext
+
+from ingestion_jobs import IngestionJobQueue
+from problem_generator import MathProblem
+from problem_pool import ProblemPool
+
+STORE = os.path.join("vector_stores", "math")
+
+
+class FakeGenerator:
+    async def agenerate_problem(self, topic, difficulty):
+        return MathProblem(question=f"{topic}の問題", answer="解答")
+
+
+class FakeProcessor:
+    async def process_pdf_with_progress(self, pdf_path, progress_callback=None, source_name=None,
+                                        skip_pages=None, checkpoint_callback=None):
+        return {"status": "success", "failed_pages": []}
+
+
+async def fill_pool(pool):
+    """/generateと同じく相対パスのストアで補充の対象になるまで要求し、補充が終わるまで待つ"""
+    for _ in range(pool.min_requests):
+        assert pool.pop(STORE, "微分", "標準") is None
+    pool.schedule_refill(STORE, "微分", "標準", lambda: nullcontext(FakeGenerator()))
+    await asyncio.gather(*pool._tasks)
+
+
+def test_completed_job_invalidates_pool_for_relative_store(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pool = ProblemPool(str(tmp_path / "pool"))
+
+    async def scenario():
+        await fill_pool(pool)
+        completed = asyncio.Event()
+
+        def on_complete(job):
+            pool.invalidate_store(job["store_path"])
+            completed.set()
+
+        queue = IngestionJobQueue(lambda store_path: FakeProcessor(), str(tmp_path / "jobs"), on_complete=on_complete)
+        pdf_path = tmp_path / "upload.pdf"
+        pdf_path.write_bytes(b"%PDF-1.4")
+        queue.start()
+        try:
+            queue.submit(str(pdf_path), "math", STORE, "upload.pdf")
+            await asyncio.wait_for(completed.wait(), 10)
+        finally:
+            for worker in queue._workers:
+                worker.cancel()
+
+    asyncio.run(scenario())
+
+    assert pool.pop(STORE, "微分", "標準") is None
+
+
+def test_relative_and_absolute_store_share_entries(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pool = ProblemPool(str(tmp_path / "pool"))
+    asyncio.run(fill_pool(pool))
+
+    problem = pool.pop(os.path.abspath(STORE), "微分", "標準")
+
+    assert problem is not None
+    assert problem.question == "微分の問題"
+
+
+def test_pop_is_saved_after_save_delay_not_on_every_call(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pool = ProblemPool(str(tmp_path / "pool"), save_delay=3600)
+    asyncio.run(fill_pool(pool))
+    key = ProblemPool._key(STORE, "積分", "標準")
+
+    for _ in range(5):
+        pool.pop(STORE, "積分", "標準")
+    assert key not in ProblemPool(str(tmp_path / "pool"))._data["entries"]
+
+    pool.flush()
+
+    assert ProblemPool(str(tmp_path / "pool"))._data["entries"][key]["requests"] == 5
+    assert os.listdir(tmp_path / "pool") == [ProblemPool.POOL_FILE]
+
+
+def test_refills_only_repeated_or_warm_requests(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pool = ProblemPool(str(tmp_path / "pool"), size_per_key=3, refill_size=2)
+    lease = lambda: nullcontext(FakeGenerator())  # noqa: E731
+
+    async def scenario():
+        # 1度しか要求されていない組み合わせは補充しない
+        assert pool.pop(STORE, "積分", "標準") is None
+        assert pool.pop(STORE, "極限", "標準") is None
+        pool.schedule_refill(STORE, "積分", "標準", lease)
+        assert not pool._tasks
+
+        # 2度目の要求で補充し、1回の補充ではrefill_size問まで生成する
+        assert pool.pop(STORE, "積分", "標準") is None
+        pool.schedule_refill(STORE, "積分", "標準", lease)
+        await asyncio.gather(*pool._tasks)
+        assert len(pool._data["entries"][ProblemPool._key(STORE, "積分", "標準")]["problems"]) == 2
+
+        # warmで選ばれた組み合わせは要求回数にかかわらず補充する
+        pool.warm(STORE, lease)
+        await asyncio.gather(*pool._tasks)
+        assert len(pool._data["entries"][ProblemPool._key(STORE, "極限", "標準")]["problems"]) == 2
+
+    asyncio.run(scenario())
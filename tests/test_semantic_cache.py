@@ -0,0 +1,68 @@
+import asyncio
+
+from benchmarks.fakes import FakeEmbeddings
+from lexical_index import LexicalIndex
+from retrieval_cache import store_versions
+from semantic_cache import SemanticExplainCache
+from store_registry import StoreHandleRegistry
+
+QUESTION = "関数 $f(x) = x^2$ の導関数を求めよ。"
+RESULT = {"question": "導関数を求める問題", "answer": "$f'(x) = 2x$"}
+
+
+def make_cache(tmp_path):
+    embeddings = FakeEmbeddings(latency=0)
+    registry = StoreHandleRegistry()
+    return SemanticExplainCache(str(tmp_path / "db"), embeddings, registry=registry), embeddings, registry
+
+
+def test_miss_then_store_embeds_the_question_once(tmp_path):
+    cache, embeddings, registry = make_cache(tmp_path)
+    try:
+        assert cache.lookup(QUESTION) is None
+        cache.store(QUESTION, RESULT)
+        assert embeddings.tokens == len(QUESTION)
+
+        assert cache.lookup(QUESTION) == RESULT
+        assert cache.hits == 1 and cache.misses == 1
+    finally:
+        cache.close()
+        registry.close(cache.dir_db, force=True)
+
+
+def test_async_lookup_reuses_embedding_for_store(tmp_path):
+    cache, embeddings, registry = make_cache(tmp_path)
+    try:
+        async def miss_then_store():
+            assert await cache.alookup(QUESTION) is None
+            await cache.astore(QUESTION, RESULT)
+
+        asyncio.run(miss_then_store())
+
+        assert embeddings.tokens == len(QUESTION)
+        assert asyncio.run(cache.alookup(QUESTION)) == RESULT
+    finally:
+        cache.close()
+        registry.close(cache.dir_db, force=True)
+
+
+def test_store_update_clears_once_after_ingestion_finishes(tmp_path):
+    cache, _, registry = make_cache(tmp_path)
+    index = LexicalIndex(cache.dir_db)
+    try:
+        cache.lookup(QUESTION)
+        cache.store(QUESTION, RESULT)
+
+        with index.writing():
+            # 取り込み中は書き込みのたびに破棄しない
+            store_versions.bump(cache.dir_db)
+            store_versions.bump(cache.dir_db)
+            assert cache.db._collection.count() == 1
+            assert cache.lookup(QUESTION) == RESULT
+
+        assert cache.lookup(QUESTION) is None
+        assert cache.db._collection.count() == 0
+    finally:
+        index.close()
+        cache.close()
+        registry.close(cache.dir_db, force=True)
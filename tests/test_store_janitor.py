@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+from store_janitor import StoreJanitor
+from vectorstore_manager import VectorStoreManager
+
+
+@pytest.fixture
+def base_dir(tmp_path):
+    base = tmp_path / "vector_stores"
+    # 実行中のジョブのデータベースと共有キャッシュを模す
+    for internal in ("_jobs", "_cache"):
+        os.makedirs(base / internal)
+        (base / internal / "data.sqlite3").write_bytes(b"live")
+    return base
+
+
+@pytest.mark.parametrize("name", ["_jobs", "_cache", ".hidden", "..", "../outside", "a/b", "a..b"])
+def test_add_store_rejects_reserved_and_escaping_names(base_dir, name):
+    janitor = StoreJanitor(str(base_dir))
+    manager = VectorStoreManager(str(base_dir), on_stale_directory=janitor.remove_store)
+
+    with pytest.raises(ValueError):
+        manager.add_store(name)
+
+    assert (base_dir / "_jobs" / "data.sqlite3").read_bytes() == b"live"
+    assert (base_dir / "_cache" / "data.sqlite3").read_bytes() == b"live"
+    assert all(store["name"] != name for store in manager.get_all_stores())
+
+
+def test_remove_store_refuses_paths_outside_store_directories(base_dir, tmp_path):
+    janitor = StoreJanitor(str(base_dir))
+    outside = tmp_path / "outside"
+    os.makedirs(outside)
+
+    for path in (base_dir / "_jobs", base_dir / "_cache", outside, base_dir / "store" / ".." / "_jobs"):
+        with pytest.raises(ValueError):
+            janitor.remove_store(str(path), background=False)
+
+    assert os.path.isdir(base_dir / "_jobs") and os.path.isdir(outside)
+
+
+def test_readding_a_deleted_store_discards_its_old_data(base_dir):
+    janitor = StoreJanitor(str(base_dir))
+    manager = VectorStoreManager(str(base_dir), on_stale_directory=lambda path: janitor.remove_store(path, background=False))
+    store_dir = base_dir / "lecture"
+    os.makedirs(store_dir)
+    (store_dir / "chroma.sqlite3").write_bytes(b"old")
+
+    manager.add_store("lecture")
+
+    assert os.listdir(store_dir) == []
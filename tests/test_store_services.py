@@ -0,0 +1,54 @@
+from benchmarks.fakes import FakeChatModel, FakeEmbeddings
+from pdf_processor import PDFProcessor
+from store_registry import StoreHandleRegistry
+from store_services import StoreServicePool
+
+
+class FakeService:
+    def __init__(self, path):
+        self.path = path
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_opening_more_than_max_idle_stores_closes_handles(tmp_path):
+    registry = StoreHandleRegistry(max_idle=1)
+    pool = StoreServicePool(
+        lambda path: PDFProcessor(path, FakeEmbeddings(latency=0), FakeChatModel(0), renderer=None, registry=registry),
+        None,
+        max_idle=2,
+    )
+    paths = [str(tmp_path / f"store{i}") for i in range(4)]
+    processors = []
+    for path in paths:
+        with pool.processor(path) as processor:
+            processors.append(processor)
+
+    # プールから外れたプロセッサは閉じられ、レジストリもアイドル状態の上限を超えたクライアントを閉じる
+    assert [processor._closed for processor in processors] == [True, True, False, False]
+    assert registry.normalize(paths[0]) not in registry._handles
+    assert registry.close(paths[1])
+    with pool.processor(paths[3]) as processor:
+        assert processor is processors[3]
+
+    for path in paths[2:]:
+        pool.discard(path)
+    assert all(handle.refcount == 0 for handle in registry._handles.values())
+    assert registry.close(paths[3])
+
+
+def test_leased_instances_are_not_evicted_and_discard_waits_for_release(tmp_path):
+    pool = StoreServicePool(FakeService, FakeService, max_idle=0)
+
+    held = pool.acquire_generator("calculus")
+    with pool.generator("algebra") as other:
+        pass
+    pool.discard("calculus")
+
+    assert other.closed
+    assert not held.closed
+    pool.release(held)
+    assert held.closed
+    assert pool.acquire_generator("calculus") is not held
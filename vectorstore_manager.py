@@ -1,172 +1,327 @@
 import os
+import copy
 import json
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
 from pathlib import Path
 
+try:
+    import fcntl
+except ImportError:  # Windowsではプロセス間のロックを行わない
+    fcntl = None
+
+DEFAULT_STORE_NAME = "デフォルトストア"
+
+
+def _default_store():
+    return {
+        "name": DEFAULT_STORE_NAME,
+        "path": "default_store",
+        "description": "デフォルトのベクトルストア"
+    }
+
+
 class VectorStoreManager:
-    """ベクトルストアの管理を行うクラス"""
-    
+    """
+    ベクトルストアの管理を行うクラス
+
+    設定は一時ファイルへの書き込みとリネームで置き換えるため、書き込み中に異常終了しても壊れない。
+    更新はファイルロックを取ってから最新の設定を読み直して行うため、複数のプロセスから同時に更新できる。
+    読み込んだ設定はファイルの更新日時が変わるまでメモリ上の名前の索引とともに再利用し、
+    変更（他のプロセスによる変更を含む）は登録されたリスナーに通知する。
+    """
+
     CONFIG_FILE = "vectorstore_config.json"
-    
-    def __init__(self, base_dir="./vector_stores"):
+    LOCK_FILE = "vectorstore_config.json.lock"
+
+    def __init__(self, base_dir="./vector_stores", on_stale_directory=None):
         """
         ベクトルストアマネージャーを初期化
-        
+
         Args:
             base_dir (str): ベクトルストアの基本ディレクトリ
+            on_stale_directory (function): 追加するストアのディレクトリに以前のデータが残っていた場合に
+                そのパスを受け取って片付ける関数（省略時はそのまま使用する）
         """
         self.base_dir = Path(base_dir)
+        self.on_stale_directory = on_stale_directory
         self.config_path = self.base_dir / self.CONFIG_FILE
+        self.lock_path = self.base_dir / self.LOCK_FILE
         self.current_store = None
-        
+
+        self._lock = threading.RLock()
+        # ファイルロックの入れ子の深さ（同じプロセス内で二重にflockすると待ち続けるため）
+        self._lock_depth = 0
+        self._listeners = []
+        # 読み込んだ設定と、そのときのファイルの状態（更新日時・サイズ・inode）
+        self._config = None
+        self._signature = None
+        # ストア名 -> ストア情報
+        self._index = {}
+
         # 基本ディレクトリが存在しない場合は作成
         os.makedirs(self.base_dir, exist_ok=True)
-        
-        # 設定ファイルの読み込み
-        self.config = self._load_config()
-        
-        # デフォルトのストアをセット
-        self._set_default_if_needed()
-    
-    def _load_config(self):
-        """設定ファイルを読み込む"""
-        if not os.path.exists(self.config_path):
-            # デフォルト設定を作成
-            default_config = {
-                "stores": [
-                    {
-                        "name": "デフォルトストア",
-                        "path": "default_store",
-                        "description": "デフォルトのベクトルストア"
-                    }
-                ],
-                "current_store": "デフォルトストア"
-            }
-            
-            # 設定を保存
-            with open(self.config_path, "w", encoding="utf-8") as f:
-                json.dump(default_config, f, ensure_ascii=False, indent=2)
-            
-            return default_config
-        
-        # 既存の設定を読み込む
+
+        # 設定ファイルの読み込み（ない場合は作成し、現在のストアが無効な場合は直す）
+        self._refresh()
+        if self._ensure_default(copy.deepcopy(self._config)):
+            self._update(self._ensure_default)
+
+    @property
+    def config(self):
+        """現在の設定（ファイルが更新されていれば読み直す）"""
+        self._refresh()
+        return self._config
+
+    @contextmanager
+    def _locked(self):
+        """プロセス内とプロセス間の両方で設定の更新を排他する"""
+        with self._lock:
+            if fcntl is None or self._lock_depth > 0:
+                self._lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self._lock_depth -= 1
+                return
+            with open(self.lock_path, "a") as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                self._lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self._lock_depth -= 1
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _file_signature(self):
         try:
-            with open(self.config_path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"設定ファイルの読み込み中にエラーが発生しました: {str(e)}")
-            # デフォルト設定を返す
-            return {
-                "stores": [
-                    {
-                        "name": "デフォルトストア",
-                        "path": "default_store",
-                        "description": "デフォルトのベクトルストア"
-                    }
-                ],
-                "current_store": "デフォルトストア"
-            }
-    
-    def _save_config(self):
-        """設定ファイルを保存する"""
-        with open(self.config_path, "w", encoding="utf-8") as f:
-            json.dump(self.config, f, ensure_ascii=False, indent=2)
-    
-    def _set_default_if_needed(self):
-        """デフォルトストアが未設定の場合はセット"""
-        if not self.config.get("current_store") or not self.get_store_by_name(self.config["current_store"]):
-            if len(self.config["stores"]) > 0:
-                self.config["current_store"] = self.config["stores"][0]["name"]
-            else:
-                # ストアがない場合はデフォルトを追加
-                self.config["stores"].append({
-                    "name": "デフォルトストア",
-                    "path": "default_store",
-                    "description": "デフォルトのベクトルストア"
-                })
-                self.config["current_store"] = "デフォルトストア"
-            
-            self._save_config()
-    
+            stat = os.stat(self.config_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _read_config(self):
+        """設定ファイルを読み込む（読み込めない場合は例外）"""
+        with open(self.config_path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        if not isinstance(config.get("stores"), list):
+            raise ValueError("storesがリストではありません")
+        return config
+
+    def _write_config(self, config):
+        """一時ファイルに書き込んでからリネームし、設定ファイルを置き換える（ロック取得済みで呼ぶこと）"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.base_dir, prefix=".vectorstore_config.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(config, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.config_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _recover_config(self):
+        """
+        読み込めない設定ファイルを退避し、ストアのディレクトリから設定を作り直す
+
+        ストア名はディレクトリ名になる。説明は復元できない。
+        """
+        backup_path = f"{self.config_path}.corrupt-{time.strftime('%Y%m%d%H%M%S')}"
+        os.replace(self.config_path, backup_path)
+        stores = [_default_store()]
+        for entry in sorted(os.listdir(self.base_dir)):
+            store_dir = self.base_dir / entry
+            if (entry.startswith((".", "_")) or entry == "default_store"
+                    or not (store_dir / "chroma.sqlite3").exists()):
+                continue
+            stores.append({"name": entry, "path": entry, "description": ""})
+        print(f"設定ファイルが壊れていたため {backup_path} に退避し、{len(stores)}個のストアから設定を作り直しました")
+        return {"stores": stores, "current_store": DEFAULT_STORE_NAME}
+
+    def _load_config(self):
+        """設定ファイルを読み込む。ない場合はデフォルト設定を作成し、壊れている場合は作り直す"""
+        with self._locked():
+            if not os.path.exists(self.config_path):
+                # 読み込み済みの設定があれば書き戻し、なければデフォルト設定を作成する
+                config = self._config or {"stores": [_default_store()], "current_store": DEFAULT_STORE_NAME}
+                self._write_config(config)
+                return config
+            try:
+                return self._read_config()
+            except Exception as e:
+                print(f"設定ファイルの読み込み中にエラーが発生しました: {str(e)}")
+                if self._config is not None:
+                    # 読み込み済みの設定があれば、それを書き戻す
+                    config = self._config
+                else:
+                    config = self._recover_config()
+                self._write_config(config)
+                return config
+
+    def _set_config(self, config, signature):
+        """読み込んだ設定と索引を更新し、変更があればリスナーに通知する"""
+        with self._lock:
+            previous = self._config
+            self._config = config
+            self._signature = signature
+            self._index = {store["name"]: store for store in config["stores"]}
+            listeners = list(self._listeners) if previous is not None and previous != config else []
+        for listener in listeners:
+            try:
+                listener(previous, config)
+            except Exception as e:
+                print(f"ベクトルストアの変更の通知中にエラーが発生しました: {str(e)}")
+
+    def _refresh(self):
+        """設定ファイルが更新されていれば読み直す（更新されていなければファイルの状態を確認するだけ）"""
+        signature = self._file_signature()
+        if signature is not None and signature == self._signature:
+            return
+        with self._lock:
+            if self._file_signature() == self._signature and self._config is not None:
+                return
+            config = self._load_config()
+            self._set_config(config, self._file_signature())
+
+    def _update(self, mutate):
+        """
+        最新の設定に変更を加えて保存する
+
+        Args:
+            mutate (function): 設定の辞書を受け取って変更する関数。戻り値はそのまま返す
+        """
+        with self._locked():
+            # 他のプロセスの変更を失わないよう、ロックを取ってから読み直す
+            config = copy.deepcopy(self._load_config())
+            result = mutate(config)
+            self._write_config(config)
+            signature = self._file_signature()
+        self._set_config(config, signature)
+        return result
+
+    def _ensure_default(self, config):
+        """現在のストアが無効な場合はデフォルトに戻す。変更した場合True"""
+        names = {store["name"] for store in config["stores"]}
+        if config.get("current_store") in names:
+            return False
+        if not config["stores"]:
+            # ストアがない場合はデフォルトを追加
+            config["stores"].append(_default_store())
+        config["current_store"] = config["stores"][0]["name"]
+        return True
+
+    def subscribe(self, listener):
+        """
+        設定の変更時に呼ばれるリスナーを登録する（他のプロセスによる変更は次の読み込み時に通知される）
+
+        Args:
+            listener (function): 引数: (変更前の設定, 変更後の設定)
+        """
+        with self._lock:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        """登録したリスナーを解除する"""
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
     def get_current_store_path(self):
         """現在のストアのパスを取得"""
-        store = self.get_store_by_name(self.config["current_store"])
+        return self.get_store_path(self.get_current_store_name())
+
+    def get_store_path(self, name):
+        """名前からストアのパスを取得"""
+        store = self.get_store_by_name(name)
         if store:
             return str(self.base_dir / store["path"])
         return None
-    
+
     def get_store_by_name(self, name):
         """名前からストア情報を取得"""
-        for store in self.config["stores"]:
-            if store["name"] == name:
-                return store
-        return None
-    
+        self._refresh()
+        return self._index.get(name)
+
     def get_all_stores(self):
         """全てのストア情報を取得"""
-        return self.config["stores"]
-    
+        return list(self.config["stores"])
+
     def get_current_store_name(self):
         """現在のストア名を取得"""
         return self.config["current_store"]
-    
+
+    @staticmethod
+    def _validate_store_path(name, path):
+        """
+        ストアのディレクトリ名を検証する
+
+        キャッシュ・ジョブ・ゴミ箱などの内部ディレクトリ（"_"や"."で始まるもの）と、
+        基本ディレクトリの外を指す名前は使用できない。
+        """
+        separators = [sep for sep in (os.sep, os.altsep, "/", "\\") if sep]
+        if (not path or path.startswith(("_", ".")) or ".." in path
+                or any(sep in path for sep in separators) or os.path.basename(path) != path):
+            raise ValueError(f"'{name}'はストア名として使用できません（\"_\"や\".\"で始まる名前、\"/\"や\"..\"を含む名前は使用できません）")
+
     def add_store(self, name, description=""):
         """新しいストアを追加"""
-        # 名前の重複チェック
-        if self.get_store_by_name(name):
-            raise ValueError(f"'{name}'という名前のストアは既に存在します")
-        
         # パス名の生成（名前をスネークケースに変換）
         path = name.lower().replace(" ", "_").replace("-", "_")
-        
+        self._validate_store_path(name, path)
+
         # 新しいストアの情報
         new_store = {
             "name": name,
             "path": path,
             "description": description
         }
-        
-        # ストアの追加
-        self.config["stores"].append(new_store)
-        
-        # ディレクトリ作成
-        os.makedirs(self.base_dir / path, exist_ok=True)
-        
-        # 設定を保存
-        self._save_config()
-        
+
+        def add(config):
+            # 名前とディレクトリの重複チェック
+            for store in config["stores"]:
+                if store["name"] == name:
+                    raise ValueError(f"'{name}'という名前のストアは既に存在します")
+                if store["path"] == path:
+                    raise ValueError(f"'{name}'は既存のストア「{store['name']}」と同じディレクトリになるため使用できません")
+            config["stores"].append(new_store)
+            # 削除済みのストアのデータが残っていれば、復活しないよう先に片付ける
+            store_dir = self.base_dir / path
+            if store_dir.exists() and not store_dir.is_dir():
+                raise ValueError(f"'{name}'はストア名として使用できません（同じ名前のファイルがあります）")
+            if self.on_stale_directory and store_dir.is_dir() and any(store_dir.iterdir()):
+                self.on_stale_directory(str(store_dir))
+            # ディレクトリ作成
+            os.makedirs(store_dir, exist_ok=True)
+
+        self._update(add)
         return new_store
-    
+
     def set_current_store(self, name):
         """現在のストアを設定"""
-        store = self.get_store_by_name(name)
-        if not store:
-            raise ValueError(f"'{name}'という名前のストアは存在しません")
-        
-        # 現在のストアを更新
-        self.config["current_store"] = name
-        
-        # 設定を保存
-        self._save_config()
-        
-        return store
-    
+        def select(config):
+            store = next((s for s in config["stores"] if s["name"] == name), None)
+            if not store:
+                raise ValueError(f"'{name}'という名前のストアは存在しません")
+            config["current_store"] = name
+            return store
+
+        return self._update(select)
+
     def delete_store(self, name):
         """ストアを削除"""
-        if name == "デフォルトストア":
+        if name == DEFAULT_STORE_NAME:
             raise ValueError("デフォルトストアは削除できません")
-        
-        store = self.get_store_by_name(name)
-        if not store:
-            raise ValueError(f"'{name}'という名前のストアは存在しません")
-        
-        # 現在のストアが削除対象の場合はデフォルトに戻す
-        if self.config["current_store"] == name:
-            self._set_default_if_needed()
-        
-        # ストアの削除
-        self.config["stores"] = [s for s in self.config["stores"] if s["name"] != name]
-        
-        # 設定を保存
-        self._save_config()
-        
-        return True 
\ No newline at end of file
+
+        def delete(config):
+            if not any(s["name"] == name for s in config["stores"]):
+                raise ValueError(f"'{name}'という名前のストアは存在しません")
+            config["stores"] = [s for s in config["stores"] if s["name"] != name]
+            # 現在のストアが削除対象の場合はデフォルトに戻す
+            self._ensure_default(config)
+
+        self._update(delete)
+        return True